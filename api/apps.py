@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Connects the catalog cache invalidation receivers
+        from . import cache  # noqa: F401
+        # Registers the order/payment tasks with storeapp.taskqueue
+        from . import tasks  # noqa: F401
+        from django.core import checks
+        from .hotcache import check_shared_cache
+        checks.register(check_shared_cache)
@@ -0,0 +1,123 @@
+"""
+ASGI-native read endpoints for catalog browsing
+
+Async counterparts of the read-only product, category and review
+list/retrieve endpoints, mounted under ``/api/async/``. Under an ASGI
+server (``ecommerce.asgi``) they run on the event loop instead of
+holding a worker thread for the whole request:
+
+- rows are fetched with ``aiterator()`` / ``aget()``
+- serializers only see prefetched rows, so they never touch the database
+- lists use keyset pagination (``?cursor=``, ``?page_size=``, ``?count=true``)
+  and accept the same filter, search and ordering params as the sync viewsets
+- responses are rendered with DRF's JSONRenderer, so payloads match the
+  sync endpoints
+
+Writes and page-number pagination stay on the sync viewsets in api.views.
+"""
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.views import View
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework.exceptions import APIException, NotFound
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from storeapp.models import Category, Product, Review
+from .filter import ProductFilter, ProductSearchFilter
+from .pagination import KeysetPagination
+from .serializer import CategorySerializer, ProductSerializer, ReviewSerializer
+
+
+class AsyncReadView(View):
+    """
+    Base class: ``GET`` without ``pk`` lists, with ``pk`` retrieves
+
+    Subclasses set ``queryset`` and ``serializer_class`` like a DRF
+    GenericAPIView; ``filter_backends`` are the DRF filter backends and
+    run in a worker thread since they may validate params against the DB.
+    """
+    http_method_names = ['get', 'head', 'options']
+    queryset = None
+    serializer_class = None
+    filter_backends = []
+    filterset_class = None
+    ordering_fields = None
+    keyset_tiebreaker = 'id'
+    pagination_class = KeysetPagination
+    renderer = JSONRenderer()
+
+    async def get(self, request, pk=None, **kwargs):
+        self.request = Request(request)
+        try:
+            if pk is None:
+                return await self.list()
+            return await self.retrieve(pk)
+        except APIException as exc:
+            detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+            return self.render(detail, status=exc.status_code)
+
+    async def list(self):
+        queryset = self.get_queryset()
+        if self.has_filter_params():
+            queryset = await sync_to_async(self.filter_queryset)(queryset)
+        paginator = self.pagination_class()
+        rows = await paginator.apaginate_queryset(queryset, self.request, view=self)
+        return self.render(paginator.get_paginated_response(self.serialize(rows, many=True)).data)
+
+    async def retrieve(self, pk):
+        try:
+            row = await self.get_queryset().aget(pk=pk)
+        except self.queryset.model.DoesNotExist:
+            raise NotFound('No %s matches the given query.' % self.queryset.model._meta.object_name)
+        return self.render(self.serialize(row))
+
+    def get_queryset(self):
+        return self.queryset.all()
+
+    def filter_queryset(self, queryset):
+        for backend in self.filter_backends:
+            queryset = backend().filter_queryset(self.request, queryset, self)
+        return queryset
+
+    def has_filter_params(self):
+        paginator = self.pagination_class
+        ignored = {
+            paginator.cursor_query_param, paginator.page_size_query_param,
+            paginator.count_query_param, paginator.ordering_param,
+        }
+        return bool(self.filter_backends) and any(
+            name not in ignored for name in self.request.query_params
+        )
+
+    def serialize(self, data, many=False):
+        return self.serializer_class(data, many=many, context={'request': self.request}).data
+
+    def render(self, data, status=200):
+        return HttpResponse(
+            self.renderer.render(data), status=status,
+            content_type=self.renderer.media_type,
+        )
+
+
+class AsyncProductView(AsyncReadView):
+    queryset = Product.objects.all().prefetch_related('images')
+    serializer_class = ProductSerializer
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter]
+    filterset_class = ProductFilter
+    ordering_fields = ['old_price', 'effective_price']
+
+
+class AsyncCategoryView(AsyncReadView):
+    queryset = Category.objects.all()
+    serializer_class = CategorySerializer
+    keyset_tiebreaker = 'pk'
+
+
+class AsyncReviewView(AsyncReadView):
+    queryset = Review.objects.all()
+    serializer_class = ReviewSerializer
+
+    def get_queryset(self):
+        return self.queryset.filter(product_id=self.kwargs['product_pk'])
@@ -0,0 +1,376 @@
+"""
+Reproducible API benchmark suite (``python manage.py bench``)
+
+- ``seed()`` fills the database with a deterministic catalog, shoppers,
+  carts and orders (everything it creates is marked "bench" and removed
+  again by ``clear()``)
+- SCENARIOS are the hot paths: browsing, searching and filtering the
+  catalog, product detail, add-to-cart, viewing a cart, checkout and the
+  staff order list. Each iteration is prepared up front (checkout carts
+  included) so only the measured request is timed.
+- The same scenarios run in-process through the DRF test client
+  (``InProcessClient``, queries counted with an execute wrapper) or
+  against a live server (``LiveClient``, queries read from the
+  ``Server-Timing`` header of api.instrumentation when it is enabled)
+- Results (p50/p95/p99, requests/sec, queries per request and, in
+  process, CPU time per request) are saved as JSON baselines and compared
+  with ``compare()``
+"""
+
+import json
+import platform
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.utils import timezone
+
+from storeapp.models import Cart, Cartitems, Category, Order, OrderItem, Product, ProductImage, Review
+from .loadgen import LoadResult
+
+PREFIX = 'bench'
+PASSWORD = 'bench-password'
+STAFF_EMAIL = f'{PREFIX}-staff@example.com'
+WORDS = [
+    'phone', 'laptop', 'camera', 'speaker', 'headphones', 'charger', 'monitor', 'keyboard',
+    'mouse', 'tablet', 'watch', 'router', 'drone', 'console', 'printer', 'cable',
+]
+ADJECTIVES = ['wireless', 'smart', 'compact', 'pro', 'ultra', 'portable', 'gaming', 'classic']
+
+
+@dataclass
+class SeedSizes:
+    products: int = 1000
+    categories: int = 20
+    images: int = 2
+    reviews: int = 2
+    users: int = 20
+    carts: int = 200
+    orders: int = 200
+
+
+def clear():
+    """Delete everything ``seed()`` created"""
+    users = get_user_model().objects.filter(email__startswith=f'{PREFIX}-')
+    products = Product.objects.filter(slug__startswith=f'{PREFIX}-')
+    with transaction.atomic():
+        OrderItem.objects.filter(order__owner__in=users).delete()
+        Order.objects.filter(owner__in=users).delete()
+        Cart.objects.filter(session_id=PREFIX).delete()
+        Cartitems.objects.filter(product__in=products).delete()
+        products.delete()
+        Category.objects.filter(slug__startswith=f'{PREFIX}-').delete()
+        users.delete()
+
+
+def seed(sizes=None, seed=0, batch_size=1000):
+    """Create a deterministic data set of ``sizes``; returns the counts created"""
+    sizes = sizes or SeedSizes()
+    rng = random.Random(seed)
+    User = get_user_model()
+    with transaction.atomic():
+        # One hash for every shopper: hashing per user would dominate seeding
+        password = make_password(PASSWORD)
+        users = User.objects.bulk_create([
+            User(email=f'{PREFIX}-{index}@example.com', password=password) for index in range(sizes.users)
+        ] + [User(email=STAFF_EMAIL, password=password, is_staff=True)])
+        shoppers = list(User.objects.filter(email__startswith=f'{PREFIX}-', is_staff=False).order_by('email'))
+
+        categories = Category.objects.bulk_create([
+            Category(title=f'Bench {ADJECTIVES[index % len(ADJECTIVES)]} {index}', slug=f'{PREFIX}-{index}')
+            for index in range(sizes.categories)
+        ])
+        products = []
+        for index in range(sizes.products):
+            name = f'{rng.choice(ADJECTIVES)} {rng.choice(WORDS)} {index}'
+            products.append(Product(
+                name=name.title(), slug=f'{PREFIX}-{index}',
+                description=f'A {name} from the benchmark catalog, {rng.choice(WORDS)} ready.',
+                old_price=round(rng.uniform(5, 1000), 2), discount=rng.random() < 0.3,
+                category=rng.choice(categories) if categories else None,
+                inventory=1_000_000, top_deal=rng.random() < 0.1, flash_sales=rng.random() < 0.1,
+            ))
+        products = Product.objects.bulk_create(products, batch_size=batch_size)
+        ProductImage.objects.bulk_create([
+            ProductImage(product=product, image=f'img/{PREFIX}-{index}-{number}.jpg')
+            for index, product in enumerate(products) for number in range(sizes.images)
+        ], batch_size=batch_size)
+        Review.objects.bulk_create([
+            Review(product=product, name=f'Reviewer {number}', description=f'Great {rng.choice(WORDS)}')
+            for product in products for number in range(sizes.reviews)
+        ], batch_size=batch_size)
+
+        carts = Cart.objects.bulk_create([Cart(session_id=PREFIX) for _ in range(sizes.carts)])
+        Cartitems.objects.bulk_create([
+            Cartitems(cart=cart, product=product, quantity=rng.randint(1, 3))
+            for cart in carts for product in rng.sample(products, min(3, len(products)))
+        ], batch_size=batch_size)
+        Cart.objects.filter(session_id=PREFIX).refresh_totals()
+
+        orders = Order.objects.bulk_create([
+            Order(owner=rng.choice(shoppers), pending_status=rng.choice('PPCCCF')) for _ in range(sizes.orders)
+        ]) if shoppers else []
+        lines = []
+        for order in orders:
+            for product in rng.sample(products, min(2, len(products))):
+                lines.append(OrderItem(order=order, product=product, quantity=rng.randint(1, 3),
+                                       unit_price=product.effective_price, product_name=product.name))
+        OrderItem.objects.bulk_create(lines, batch_size=batch_size)
+    return {
+        'users': len(users), 'categories': len(categories), 'products': len(products),
+        'carts': len(carts), 'orders': len(orders), 'order_items': len(lines),
+    }
+
+
+def load_context():
+    """Ids the scenarios pick from; None if the database was never seeded"""
+    User = get_user_model()
+    products = list(Product.objects.filter(slug__startswith=f'{PREFIX}-').order_by('slug').values_list('pk', flat=True))
+    if not products:
+        return None
+    return {
+        'products': products,
+        'categories': list(Category.objects.filter(slug__startswith=f'{PREFIX}-').order_by('slug')
+                           .values_list('pk', flat=True)),
+        'carts': list(Cart.objects.filter(session_id=PREFIX).order_by('created', 'pk').values_list('pk', flat=True)),
+        'shoppers': list(User.objects.filter(email__startswith=f'{PREFIX}-', is_staff=False)
+                         .order_by('email').values_list('email', flat=True)),
+        'staff': STAFF_EMAIL,
+    }
+
+
+# A scenario returns the request to time: (method, path, data, user email)
+
+def browse(client, ctx, rng):
+    pages = max(1, len(ctx['products']) // 20)
+    return 'GET', f'/api/products/?page={rng.randint(1, min(pages, 50))}', None, None
+
+
+def search(client, ctx, rng):
+    return 'GET', f'/api/products/?search={rng.choice(WORDS)}', None, None
+
+
+def filter_products(client, ctx, rng):
+    category = rng.choice(ctx['categories'])
+    return 'GET', f'/api/products/?category={category}&effective_price__lte=500&ordering=-effective_price', None, None
+
+
+def product_detail(client, ctx, rng):
+    return 'GET', f"/api/products/{rng.choice(ctx['products'])}/", None, None
+
+
+def add_to_cart(client, ctx, rng):
+    data = {'product_id': str(rng.choice(ctx['products'])), 'quantity': 1}
+    return 'POST', f"/api/carts/{rng.choice(ctx['carts'])}/items/", data, None
+
+
+def view_cart(client, ctx, rng):
+    return 'GET', f"/api/carts/{rng.choice(ctx['carts'])}/", None, None
+
+
+def checkout(client, ctx, rng):
+    # Each checkout consumes a fresh cart, built before the clock starts
+    cart = client.send('POST', '/api/carts/', {})[1]['cart_id']
+    for product in rng.sample(ctx['products'], min(2, len(ctx['products']))):
+        client.send('POST', f'/api/carts/{cart}/items/', {'product_id': str(product), 'quantity': 1})
+    return 'POST', '/api/orders/', {'cart_id': cart}, rng.choice(ctx['shoppers'])
+
+
+def staff_orders(client, ctx, rng):
+    return 'GET', '/api/orders/', None, ctx['staff']
+
+
+SCENARIOS = {
+    'browse': browse,
+    'search': search,
+    'filter': filter_products,
+    'product_detail': product_detail,
+    'add_to_cart': add_to_cart,
+    'view_cart': view_cart,
+    'checkout': checkout,
+    'staff_orders': staff_orders,
+}
+
+
+class ScenarioResult(LoadResult):
+    def __init__(self, name, target, concurrency):
+        super().__init__(name, concurrency)
+        self.target = target
+        self.queries = []
+        self.cpu = []
+        self.lock = threading.Lock()
+
+    def record(self, status, latency, queries=None, cpu=None):
+        with self.lock:
+            super().record(status, latency)
+            if queries is not None:
+                self.queries.append(queries)
+            if cpu is not None:
+                self.cpu.append(cpu)
+
+    def as_dict(self):
+        data = super().as_dict()
+        data['scenario'] = data.pop('url')
+        data['errors'] = sum(count for status, count in self.statuses.items() if status >= 400) + self.errors
+        data['queries_per_request'] = round(sum(self.queries) / len(self.queries), 2) if self.queries else None
+        data['cpu_ms_per_request'] = round(sum(self.cpu) / len(self.cpu) * 1000, 3) if self.cpu else None
+        return data
+
+
+class InProcessClient:
+    """Django test client; one thread, queries counted per request"""
+    target = 'in-process'
+    # The request runs on the calling thread, so its CPU time is the server's
+    measures_cpu = True
+
+    def __init__(self):
+        from rest_framework.test import APIClient
+
+        self.client = APIClient()
+        self.users = {}
+
+    def send(self, method, path, data=None, user=None):
+        if user is not None and user not in self.users:
+            self.users[user] = get_user_model().objects.get(email=user)
+        self.client.force_authenticate(self.users.get(user))
+        count = [0]
+
+        def counter(execute, *args):
+            count[0] += 1
+            return execute(*args)
+
+        with connection.execute_wrapper(counter):
+            if method == 'GET':
+                response = self.client.get(path)
+            else:
+                response = getattr(self.client, method.lower())(path, data, format='json')
+        body = response.json() if response.get('Content-Type', '').startswith('application/json') else None
+        return response.status_code, body, count[0]
+
+
+class LiveClient:
+    """HTTP against a running server; JWT login with the seeded password"""
+    target = 'live'
+    measures_cpu = False
+    queries_pattern = re.compile(r'desc="(\d+) queries"')
+
+    def __init__(self, base_url, auth_header_type='JWT'):
+        import requests
+
+        self.base_url = base_url.rstrip('/')
+        self.auth_header_type = auth_header_type
+        self.local = threading.local()
+        self.tokens = {}
+        self.requests = requests
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = self.requests.Session()
+        return self.local.session
+
+    def token(self, email):
+        if email not in self.tokens:
+            response = self.session.post(f'{self.base_url}/auth/jwt/create/',
+                                         json={'email': email, 'password': PASSWORD})
+            response.raise_for_status()
+            self.tokens[email] = response.json()['access']
+        return self.tokens[email]
+
+    def send(self, method, path, data=None, user=None):
+        headers = {'Authorization': f'{self.auth_header_type} {self.token(user)}'} if user else {}
+        response = self.session.request(method, self.base_url + path, json=data, headers=headers)
+        match = self.queries_pattern.search(response.headers.get('Server-Timing', ''))
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return response.status_code, body, int(match.group(1)) if match else None
+
+
+def run_scenario(client, ctx, name, iterations=200, warmup=20, concurrency=1, seed=0):
+    """Prepare ``warmup + iterations`` requests, replay the warmup, time the rest"""
+    rng = random.Random(f'{seed}:{name}')
+    requests = [SCENARIOS[name](client, ctx, rng) for _ in range(warmup + iterations)]
+    for request in requests[:warmup]:
+        client.send(*request)
+
+    result = ScenarioResult(name, client.target, concurrency)
+
+    def timed(request):
+        cpu_started = time.thread_time()
+        started = time.perf_counter()
+        try:
+            status, _, queries = client.send(*request)
+        except Exception:
+            with result.lock:
+                result.errors += 1
+            return
+        latency = time.perf_counter() - started
+        cpu = time.thread_time() - cpu_started if client.measures_cpu else None
+        result.record(status, latency, queries, cpu)
+
+    started = time.monotonic()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(timed, requests[warmup:]))
+    else:
+        for request in requests[warmup:]:
+            timed(request)
+    result.elapsed = time.monotonic() - started
+    return result
+
+
+def environment(client, sizes, iterations, concurrency, seed):
+    return {
+        'target': client.target,
+        'database': connection.vendor,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'sizes': sizes,
+        'iterations': iterations,
+        'concurrency': concurrency,
+        'seed': seed,
+        'created_at': timezone.now().isoformat(),
+    }
+
+
+def save_baseline(path, meta, results):
+    with open(path, 'w') as fh:
+        json.dump({'meta': meta, 'results': {row['scenario']: row for row in results}}, fh, indent=2)
+
+
+def load_baseline(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def compare(results, baseline, tolerance=0.10):
+    """
+    One row per scenario present in both runs, with its regressions
+
+    p95 latency may grow and requests/sec may drop by ``tolerance`` (a
+    fraction) before they count; any extra query per request counts.
+    """
+    rows = []
+    for row in results:
+        base = baseline['results'].get(row['scenario'])
+        if base is None:
+            continue
+        regressions = []
+        if base['p95_ms'] and row['p95_ms'] and row['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append('p95')
+        if base['rps'] and row['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append('rps')
+        if (base.get('queries_per_request') is not None and row['queries_per_request'] is not None
+                and row['queries_per_request'] > base['queries_per_request']):
+            regressions.append('queries')
+        rows.append({'scenario': row['scenario'], 'current': row, 'baseline': base, 'regressions': regressions})
+    return rows
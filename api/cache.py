@@ -0,0 +1,139 @@
+"""
+Read-through response cache for catalog endpoints
+
+Cached entries are keyed by a catalog *generation* plus the view, the
+URL kwargs and the normalized query params. Any write to Product,
+ProductImage or Category (API, admin or bulk queryset writes) bumps the
+generation, so stale entries are never read again and simply expire.
+Stock moves (``inventory_changed``) do not: a cached page can show an
+``inventory`` up to API_CACHE_TIMEOUT seconds old.
+
+Entries store the serialized ``response.data`` with its ETag and
+Last-Modified (from api.conditional when the view has it, else a hash
+of the data), so a hit skips both the queries and the serializers, and
+a matching ``If-None-Match`` / ``If-Modified-Since`` gets a 304 without
+rendering anything.
+
+Settings:
+- API_CACHE_ALIAS: Django cache to use (default 'default')
+- API_CACHE_TIMEOUT: seconds an entry lives (default 300)
+"""
+
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+from rest_framework.response import Response
+from rest_framework.status import HTTP_200_OK
+from rest_framework.utils.encoders import JSONEncoder
+
+from storeapp.models import Category, Product, ProductImage
+from storeapp.signals import products_bulk_changed
+from .conditional import set_validators
+from .instrumentation import registry, timed
+
+GENERATION_KEY = 'api:catalog:generation'
+# Bumped when the layout of the cached entries changes
+ENTRY_VERSION = 2
+
+
+def get_cache():
+    return caches[getattr(settings, 'API_CACHE_ALIAS', 'default')]
+
+
+def get_generation():
+    cache = get_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from the clock so an evicted counter never reuses old keys
+        cache.add(GENERATION_KEY, time.time_ns(), timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation(**kwargs):
+    cache = get_cache()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, time.time_ns(), timeout=None)
+
+
+def invalidate_catalog(**kwargs):
+    """Signal receiver: drop cached catalog responses now and after commit"""
+    bump_generation()
+    # A request may re-cache old rows before this transaction commits
+    transaction.on_commit(bump_generation)
+
+
+def compute_etag(data):
+    payload = json.dumps(data, cls=JSONEncoder, sort_keys=True).encode()
+    return 'W/"%s"' % hashlib.sha1(payload).hexdigest()
+
+
+class CachedResponseMixin:
+    """
+    Serve ``list`` and ``retrieve`` from the catalog response cache
+
+    Only successful responses are cached. The data must not depend on
+    the requesting user, since the key does not include it.
+    """
+    cache_timeout = None
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        cache = get_cache()
+        with timed('cache'):
+            key = self.get_cache_key(request)
+            entry = cache.get(key, version=ENTRY_VERSION)
+        registry.inc('api_cache_lookups_total', {'view': self.basename, 'result': 'miss' if entry is None else 'hit'},
+                     help='Catalog response cache lookups')
+        if entry is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != HTTP_200_OK:
+                return response
+            with timed('cache'):
+                etag = response.get('ETag') or compute_etag(response.data)
+                entry = (etag, parse_http_date_safe(response.get('Last-Modified')), response.data)
+                cache.set(key, entry, self.get_cache_timeout(), version=ENTRY_VERSION)
+        etag, last_modified, data = entry
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        return set_validators(response or Response(data), etag, last_modified)
+
+    def get_cache_timeout(self):
+        if self.cache_timeout is not None:
+            return self.cache_timeout
+        return getattr(settings, 'API_CACHE_TIMEOUT', 300)
+
+    def get_cache_key(self, request):
+        params = sorted(
+            (name, value)
+            for name in request.query_params
+            for value in request.query_params.getlist(name)
+        )
+        parts = [
+            request.get_host(),
+            self.basename,
+            self.action,
+            sorted(self.kwargs.items()),
+            params,
+        ]
+        digest = hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+        return f'api:response:{get_generation()}:{digest}'
+
+
+for model in (Product, ProductImage, Category):
+    post_save.connect(invalidate_catalog, sender=model, dispatch_uid=f'api-cache-save-{model.__name__}')
+    post_delete.connect(invalidate_catalog, sender=model, dispatch_uid=f'api-cache-delete-{model.__name__}')
+products_bulk_changed.connect(invalidate_catalog, dispatch_uid='api-cache-bulk')
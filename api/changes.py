@@ -0,0 +1,123 @@
+"""
+Change feed endpoint for downstream sync (admin only)
+
+GET /api/changes/?since=<cursor>&limit=<n>&wait=<seconds>&models=product,order
+
+Returns entries in ``seq`` order plus ``next``, the ``since`` to send on
+the following call. ``since`` is ``0`` (or any ``seq``) to start with;
+``next`` is an opaque token that also carries the gaps still pending
+(ChangeLogQuerySet.read), so a write that commits late is delivered on
+a later call instead of being skipped.
+
+- ``wait`` long-polls (up to ``max_wait`` seconds) until there is
+  something new. The view is async: under ASGI a waiting consumer holds
+  no worker thread.
+- ``models`` only filters the returned entries; ``next`` still advances
+  past the skipped ones.
+"""
+
+import asyncio
+import base64
+import binascii
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from storeapp.models import ChangeLog
+from .serializer import ChangeLogSerializer
+
+
+def encode_position(since, gaps):
+    if not gaps:
+        return str(since)
+    raw = json.dumps({'s': since, 'g': sorted(gaps.items())}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_position(token):
+    """``(since, gaps)`` from a ``next`` token or a plain ``seq``"""
+    if token.isdigit():
+        return int(token), {}
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        since = position['s']
+        gaps = {int(seq): mark for seq, mark in position['g']}
+        if not isinstance(since, int) or since < 0:
+            raise ValueError(position)
+    except (TypeError, ValueError, KeyError, binascii.Error):
+        raise ValidationError({'since': 'Not a position returned by this feed.'})
+    return since, gaps
+
+
+class ChangeFeedView(APIView):
+    """
+    DRF's authentication, permissions, renderers and error responses, with
+    an async ``get``: ``dispatch`` runs the sync parts (authentication may
+    hit the session and user tables) through sync_to_async
+    """
+    http_method_names = ['get', 'head', 'options']
+    permission_classes = [IsAdminUser]
+    default_limit = 100
+    max_limit = 1000
+    max_wait = 30
+    poll_interval = 0.5
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def get(self, request):
+        params = request.query_params
+        since, gaps = decode_position(params.get('since', '0'))
+        limit = min(self.get_int_param('limit', self.default_limit), self.max_limit) or self.default_limit
+        wait = min(self.get_int_param('wait', 0), self.max_wait)
+        models = {name for name in params.get('models', '').split(',') if name}
+
+        deadline = time.monotonic() + wait
+        while True:
+            entries, next_since, gaps = await sync_to_async(ChangeLog.objects.read)(since, limit, gaps)
+            if entries or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(self.poll_interval)
+
+        has_more = sum(entry.seq > since for entry in entries) == limit
+        if models:
+            entries = [entry for entry in entries if entry.model in models]
+        return Response({
+            'next': encode_position(next_since, gaps),
+            'has_more': has_more,
+            'results': ChangeLogSerializer(entries, many=True).data,
+        })
+
+    def get_int_param(self, name, default):
+        value = self.request.query_params.get(name)
+        if value is None:
+            return default
+        try:
+            number = int(value)
+        except ValueError:
+            raise ValidationError({name: 'A non-negative integer is required.'})
+        if number < 0:
+            raise ValidationError({name: 'A non-negative integer is required.'})
+        return number
@@ -0,0 +1,104 @@
+"""
+Conditional GET for list and detail endpoints
+
+ConditionalGetMixin answers ``If-None-Match`` / ``If-Modified-Since``
+before anything is serialized:
+
+- The validators come from one aggregate query over the filtered
+  queryset (the one object for ``retrieve``): ``MAX(updated_at)`` and
+  ``COUNT(*)``. The weak ETag hashes both, so an update, an insert or a
+  delete changes it. ``Last-Modified`` is the newest ``updated_at``.
+- A match gets a 304 without further queries. Otherwise the response
+  carries ``ETag`` and ``Last-Modified``.
+- ``list``/``retrieve`` responses get the viewset's ``Cache-Control``.
+
+Under CachedResponseMixin (api.cache) the cached entries keep these
+validators, so revalidating a cached page costs no query at all.
+
+Settings:
+- API_CACHE_CONTROL: ``{basename: header}`` overriding a viewset's
+  ``cache_control``, e.g. ``{'product': 'public, max-age=300'}``
+"""
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.status import HTTP_200_OK, HTTP_304_NOT_MODIFIED
+
+
+def make_etag(*parts):
+    payload = json.dumps(parts, default=str).encode()
+    return 'W/"%s"' % hashlib.sha1(payload).hexdigest()
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+class ConditionalGetMixin:
+    """
+    ETag / Last-Modified validators and Cache-Control for ``list`` and ``retrieve``
+
+    The model needs a ``last_modified_field`` (``updated_at``) that changes
+    whenever its representation does.
+    """
+    last_modified_field = 'updated_at'
+    # Default for user data; catalog viewsets allow shared caches
+    cache_control = 'private, no-cache'
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        validators = self.get_validators()
+        if validators is None:
+            return handler(request, *args, **kwargs)
+        etag, last_modified = validators
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (HTTP_200_OK, HTTP_304_NOT_MODIFIED):
+            set_validators(response, etag, last_modified)
+        return response
+
+    def get_validators(self):
+        """``(etag, last-modified timestamp)`` from one aggregate query, or None"""
+        queryset = self.filter_queryset(self.get_queryset())
+        try:
+            if self.action == 'retrieve':
+                lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+                queryset = queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+            stats = queryset.aggregate(count=Count('pk'), last_modified=Max(self.last_modified_field))
+        except (TypeError, ValueError, ValidationError):
+            # A malformed lookup: the handler answers it (404)
+            return None
+        if self.action == 'retrieve' and not stats['count']:
+            return None
+        last_modified = stats['last_modified']
+        etag = make_etag(self.basename, self.action, self.request.accepted_renderer.format,
+                         stats['count'], last_modified)
+        return etag, int(last_modified.timestamp()) if last_modified is not None else None
+
+    def get_cache_control(self):
+        return getattr(settings, 'API_CACHE_CONTROL', {}).get(self.basename, self.cache_control)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if (
+            self.action in ('list', 'retrieve')
+            and response.status_code in (HTTP_200_OK, HTTP_304_NOT_MODIFIED)
+            and not response.has_header('Cache-Control')
+        ):
+            response['Cache-Control'] = self.get_cache_control()
+        return response
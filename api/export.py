@@ -0,0 +1,159 @@
+"""
+Streaming product catalog export
+
+Walks ``Product`` in ``(updated_at, id)`` order with ``.iterator()`` so
+only one chunk of rows (plus its prefetched images) is in memory at a
+time, and renders each row as a JSON line or a CSV record.
+
+Incremental and resumable:
+- ``updated_since`` only exports products changed at or after that time
+- ``updated_since`` + ``after`` (a product id) resumes strictly after the
+  row ``(updated_since, after)``; pass the ``updated_at`` and ``id`` of the
+  last row received to continue an interrupted export
+
+Products changed while an export runs move to the end of the scan, so
+they are exported again rather than missed.
+"""
+
+import csv
+import io
+import json
+import uuid
+import zlib
+
+from django.db.models import Prefetch, Q
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware
+
+from storeapp.models import Product, ProductImage
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+COLUMNS = [
+    'id', 'name', 'slug', 'description', 'category_id', 'category',
+    'old_price', 'price', 'discount', 'inventory', 'top_deal', 'flash_sales',
+    'image', 'images', 'updated_at',
+]
+CHUNK_SIZE = 2000
+BUFFER_SIZE = 64 * 1024
+
+
+class ExportError(ValueError):
+    pass
+
+
+def parse_position(updated_since=None, after=None):
+    """Validate the ``updated_since`` / ``after`` params"""
+    since = None
+    if updated_since:
+        since = parse_datetime(updated_since)
+        if since is None:
+            raise ExportError('updated_since must be an ISO 8601 datetime')
+        if is_naive(since):
+            since = make_aware(since)
+    if after:
+        if since is None:
+            raise ExportError('after requires updated_since')
+        try:
+            after = uuid.UUID(after)
+        except ValueError:
+            raise ExportError('after must be a product id')
+    return since, after or None
+
+
+def export_queryset(since=None, after=None):
+    queryset = (
+        Product.objects.select_related('category')
+        .prefetch_related(Prefetch('images', queryset=ProductImage.objects.order_by('id')))
+        .order_by('updated_at', 'id')
+    )
+    if since is not None and after is not None:
+        queryset = queryset.filter(
+            Q(updated_at__gt=since) | Q(updated_at=since, id__gt=after)
+        )
+    elif since is not None:
+        queryset = queryset.filter(updated_at__gte=since)
+    return queryset
+
+
+def product_row(product, build_url=str):
+    category = product.category
+    return {
+        'id': str(product.pk),
+        'name': product.name,
+        'slug': product.slug,
+        'description': product.description,
+        'category_id': str(category.pk) if category else None,
+        'category': category.title if category else None,
+        'old_price': product.old_price,
+        'price': product.effective_price,
+        'discount': product.discount,
+        'inventory': product.inventory,
+        'top_deal': product.top_deal,
+        'flash_sales': product.flash_sales,
+        'image': build_url(product.image.url) if product.image else None,
+        'images': [build_url(image.image.url) for image in product.images.all() if image.image],
+        'updated_at': product.updated_at.isoformat().replace('+00:00', 'Z'),
+    }
+
+
+def iter_rows(queryset, build_url=str, chunk_size=CHUNK_SIZE):
+    for product in queryset.iterator(chunk_size=chunk_size):
+        yield product_row(product, build_url)
+
+
+def render_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+
+def render_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({**row, 'images': ' '.join(row['images'])})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+RENDERERS = {
+    'ndjson': render_ndjson,
+    'csv': render_csv,
+}
+
+
+def buffered(chunks, size=BUFFER_SIZE):
+    """Join small text chunks into ~``size`` byte blocks"""
+    parts, length = [], 0
+    for chunk in chunks:
+        data = chunk.encode()
+        parts.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(parts)
+            parts, length = [], 0
+    if parts:
+        yield b''.join(parts)
+
+
+def gzipped(blocks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(fmt='ndjson', since=None, after=None, gzip=False, build_url=str, chunk_size=CHUNK_SIZE):
+    """Yield the encoded export as bytes blocks"""
+    if fmt not in RENDERERS:
+        raise ExportError(f"format must be one of: {', '.join(RENDERERS)}")
+    rows = iter_rows(export_queryset(since, after), build_url, chunk_size)
+    blocks = buffered(RENDERERS[fmt](rows))
+    return gzipped(blocks) if gzip else blocks
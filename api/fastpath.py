@@ -0,0 +1,289 @@
+"""
+Read-only fast path for list endpoints
+
+On a list page, ModelSerializer spends most of its time building model
+instances and walking its fields one at a time. A RowSerializer produces
+the same ``response.data`` straight from ``.values()`` rows:
+
+- Extractors are compiled once per class from the ModelSerializer it
+  mirrors. Plain columns reuse that serializer field's own
+  ``to_representation``, and file fields reuse its URL rules. Any other
+  readable field needs an ``extract_<name>(row)`` method. A field added
+  to the serializer without one raises ImproperlyConfigured instead of
+  silently drifting from it.
+- Related rows (images, order lines) are fetched once per page by
+  ``prepare()``, like prefetch_related.
+
+FastListMixin serves a viewset's ``list`` this way and renders with
+FastJSONRenderer. That renderer produces the same bytes as JSONRenderer
+through one shared encoder. storeapp's tests check every row serializer
+byte for byte against its ModelSerializer.
+
+Settings:
+- API_FAST_LISTS: serve list endpoints from the fast path (default True)
+"""
+
+import functools
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import FileField as ModelFileField
+from django.utils.encoding import force_str
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.compat import LONG_SEPARATORS, SHORT_SEPARATORS
+
+from storeapp.models import Order, OrderItem, Product, ProductImage
+from .instrumentation import current, registry, timed
+from .serializer import (
+    ImageSrcsetField, OrderItemSerializer, ProductImageSerializer, ProductSerializer, orderSerializer,
+)
+
+# Serializer fields whose to_representation only depends on the value.
+# Exact types: a subclass may override it to read the context.
+PLAIN_FIELDS = {
+    serializers.BooleanField, serializers.CharField, serializers.ChoiceField, serializers.DateField,
+    serializers.DateTimeField, serializers.DecimalField, serializers.EmailField, serializers.FloatField,
+    serializers.IntegerField, serializers.SlugField, serializers.UUIDField, serializers.ReadOnlyField,
+}
+
+
+def column(source, to_representation):
+    def extract(serializer, row):
+        value = row[source]
+        return None if value is None else to_representation(value)
+    return extract
+
+
+def related_column(source):
+    # PrimaryKeyRelatedField renders the pk, which is what .values() returns
+    def extract(serializer, row):
+        return row[source]
+    return extract
+
+
+def file_column(source, storage, use_url):
+    def extract(serializer, row):
+        name = row[source]
+        if not name:
+            return None
+        if not use_url:
+            return name
+        url = storage.url(name)
+        request = serializer.request
+        return request.build_absolute_uri(url) if request is not None else url
+    return extract
+
+
+def srcset_column(source, field_class):
+    def extract(serializer, row):
+        return field_class.build(row[source], serializer.request)
+    return extract
+
+
+class RowSerializer:
+    """
+    Serialize ``.values()`` rows exactly as ``serializer_class`` serializes instances
+
+    Subclasses set ``serializer_class`` and define ``extract_<name>(row)``
+    for each readable field that is not a plain column. ``columns`` are
+    extra columns the extract methods read.
+    """
+    serializer_class = None
+    columns = ()
+
+    def __init__(self, context=None):
+        self.context = context or {}
+        self.request = self.context.get('request')
+        self.extractors, self.sources = self.compile()
+
+    @classmethod
+    def compile(cls):
+        """``([(field name, extractor)], selected columns)``, built once per class"""
+        if '_compiled' not in cls.__dict__:
+            model = cls.serializer_class.Meta.model
+            concrete = {field.name: field for field in model._meta.concrete_fields}
+            extractors, sources = [], list(cls.columns)
+            for name, field in cls.serializer_class().fields.items():
+                if field.write_only:
+                    continue
+                method = getattr(cls, f'extract_{name}', None)
+                if method is not None:
+                    extractors.append((name, method))
+                    continue
+                model_field = concrete.get(field.source)
+                if model_field is None:
+                    extract = None
+                elif isinstance(field, ImageSrcsetField):
+                    extract = srcset_column(field.source, type(field))
+                elif isinstance(field, serializers.FileField) and isinstance(model_field, ModelFileField):
+                    use_url = getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL)
+                    extract = file_column(field.source, model_field.storage, use_url)
+                elif type(field) is serializers.PrimaryKeyRelatedField and field.pk_field is None:
+                    extract = related_column(field.source)
+                elif type(field) in PLAIN_FIELDS and not model_field.is_relation:
+                    extract = column(field.source, field.to_representation)
+                else:
+                    extract = None
+                if extract is None:
+                    raise ImproperlyConfigured(
+                        f'{cls.__name__} needs extract_{name}() for {cls.serializer_class.__name__}.{name}'
+                    )
+                extractors.append((name, extract))
+                sources.append(field.source)
+            cls._compiled = (extractors, list(dict.fromkeys(sources)))
+        return cls._compiled
+
+    def select(self, queryset, *columns):
+        """``queryset`` as the rows this serializer reads, plus ``columns``"""
+        return queryset.prefetch_related(None).values(*dict.fromkeys([*self.sources, *columns]))
+
+    def prepare(self, rows):
+        """Fetch what the rows of one page need from other tables"""
+
+    def to_representation(self, row):
+        return {name: extract(self, row) for name, extract in self.extractors}
+
+    def serialize(self, rows):
+        rows = list(rows)
+        self.prepare(rows)
+        return [self.to_representation(row) for row in rows]
+
+
+def group_by(rows, key, representations):
+    """``{row[key]: [representation, ...]}``, in row order"""
+    groups = {}
+    for row, representation in zip(rows, representations):
+        groups.setdefault(row[key], []).append(representation)
+    return groups
+
+
+class ProductImageRows(RowSerializer):
+    serializer_class = ProductImageSerializer
+
+
+class ProductRows(RowSerializer):
+    serializer_class = ProductSerializer
+    columns = ('old_price', 'discount')
+
+    def prepare(self, rows):
+        images = ProductImageRows(self.context)
+        image_rows = list(images.select(ProductImage.objects.filter(product__in=[row['id'] for row in rows])))
+        self.images = group_by(image_rows, 'product', images.serialize(image_rows))
+
+    def extract_price(self, row):
+        return Product.compute_price(row['old_price'], row['discount'])
+
+    def extract_images(self, row):
+        return self.images.get(row['id'], [])
+
+
+class OrderItemRows(RowSerializer):
+    serializer_class = OrderItemSerializer
+    columns = ('order', 'product', 'unit_price', 'product_name', 'line_total')
+
+    def prepare(self, rows):
+        # Lines from before the checkout snapshot fall back to the product
+        legacy = {row['product'] for row in rows if row['unit_price'] is None or not row['product_name']}
+        self.products = {
+            pk: (Product.compute_price(old_price, discount), name)
+            for pk, old_price, discount, name in Product.objects.filter(pk__in=legacy)
+            .values_list('pk', 'old_price', 'discount', 'name')
+        } if legacy else {}
+
+    def extract_product(self, row):
+        price, name = row['unit_price'], row['product_name']
+        if price is None or not name:
+            product_price, product_name = self.products[row['product']]
+            price = product_price if price is None else price
+            name = name or product_name
+        return {"id": str(row['product']), "price": price, "name": name}
+
+    def extract_sub_total(self, row):
+        return row['line_total']
+
+
+class OrderRows(RowSerializer):
+    serializer_class = orderSerializer
+    columns = ('total_amount',)
+    status_labels = dict(Order._meta.get_field('pending_status').flatchoices)
+
+    def prepare(self, rows):
+        lines = OrderItemRows(self.context)
+        line_rows = list(lines.select(OrderItem.objects.with_line_totals().filter(order__in=[row['id'] for row in rows])))
+        self.items = group_by(line_rows, 'order', lines.serialize(line_rows))
+
+    def extract_status_label(self, row):
+        value = row['pending_status']
+        return force_str(self.status_labels.get(value, value), strings_only=True)
+
+    def extract_items(self, row):
+        return self.items.get(row['id'], [])
+
+    def extract_total(self, row):
+        return row['total_amount']
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoder(encoder_class, ensure_ascii, allow_nan, separators):
+    # JSONEncoder.encode keeps no state between calls, so one can be shared
+    return encoder_class(ensure_ascii=ensure_ascii, allow_nan=allow_nan, separators=separators,
+                         check_circular=False)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer with one shared encoder and no circular reference check
+
+    Same bytes as JSONRenderer. Response data is plain dicts and lists,
+    so tracking every container against cycles is wasted work; indented
+    (browsable or ``; indent=``) responses take the regular path.
+    """
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        encoder = get_encoder(self.encoder_class, self.ensure_ascii, not self.strict,
+                              SHORT_SEPARATORS if self.compact else LONG_SEPARATORS)
+        ret = encoder.encode(data)
+        # Same escaping as JSONRenderer, for JavaScript compatibility
+        ret = ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+        return ret.encode()
+
+
+class FastListMixin:
+    """
+    Serve ``list`` through ``row_serializer_class`` (a RowSerializer)
+
+    Filters, ordering and pagination run as usual, on a ``.values()``
+    queryset; the page's rows also carry the ``ordering_fields`` so
+    keyset cursors can be built from them.
+    """
+    row_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        if not getattr(settings, 'API_FAST_LISTS', True):
+            return super().list(request, *args, **kwargs)
+        serializer = self.row_serializer_class(self.get_serializer_context())
+        queryset = serializer.select(self.filter_queryset(self.get_queryset()),
+                                     *getattr(self, 'ordering_fields', None) or ())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.serialize_rows(serializer, page))
+        return Response(self.serialize_rows(serializer, queryset))
+
+    def serialize_rows(self, serializer, rows):
+        # Timed like serializer.data (api.instrumentation)
+        started = time.perf_counter()
+        with timed('serialize'):
+            data = serializer.serialize(rows)
+        if current.get() is not None:
+            registry.inc('serializer_seconds_total', {'serializer': type(serializer).__name__},
+                         time.perf_counter() - started, help='Time spent producing serializer.data')
+        return data
+
+    def get_renderers(self):
+        return [FastJSONRenderer() if type(renderer) is JSONRenderer else renderer
+                for renderer in super().get_renderers()]
@@ -1,10 +1,61 @@
-from django_filters.rest_framework import FilterSet
+from django import forms
+from django_filters.rest_framework import Filter, FilterSet, NumberFilter
+from rest_framework.filters import SearchFilter
 from storeapp.models import *
+from storeapp.search import get_search_backend
+from . import hotcache
+
+
+class CategoryChoiceField(forms.UUIDField):
+    """A category id, validated against the hot category list instead of a query"""
+    default_error_messages = {
+        'invalid_choice': 'Select a valid choice. That choice is not one of the available choices.',
+    }
+
+    def to_python(self, value):
+        value = super().to_python(value)
+        if value is not None and value not in hotcache.get_category_ids():
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        return value
+
+
+class CategoryFilter(Filter):
+    field_class = CategoryChoiceField
+
 
 class ProductFilter(FilterSet):
+    category = CategoryFilter(field_name='category')
+
     class Meta:
         model= Product
         fields = {
             'category':['exact'],
-            'old_price':['gt','lt']
-        }
\ No newline at end of file
+            'old_price':['gt','lt'],
+            'effective_price':['gt','lt','gte','lte'],
+        }
+
+
+class OrderFilter(FilterSet):
+    # total_amount is annotated by Order.objects.with_totals()
+    total_amount__gte = NumberFilter(field_name='total_amount', lookup_expr='gte')
+    total_amount__lte = NumberFilter(field_name='total_amount', lookup_expr='lte')
+
+    class Meta:
+        model= Order
+        fields = {
+            'pending_status':['exact'],
+            'placed_at':['gte','lte'],
+        }
+
+
+class ProductSearchFilter(SearchFilter):
+    """
+    ?search= through the full-text backend from storeapp.search
+
+    Matches are ordered by relevance unless ?ordering= is also given.
+    """
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+        return get_search_backend(queryset.db).search(queryset, ' '.join(terms))
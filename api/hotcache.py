@@ -0,0 +1,225 @@
+"""
+Per-process cache of hot catalog rows
+
+Compact product records (``get_product``/``get_products``) and the whole
+category list (``get_categories``) live in this worker's memory, so cart
+validation, nested cart serialization and category filters stop going
+to the database for the same few SKUs.
+
+- Products sit in an LRU bounded by HOTCACHE_MAX_PRODUCTS (default
+  10000) entries; every entry, and the category list, expires after
+  HOTCACHE_TTL seconds (default 60).
+- Any catalog write clears this process's copy at once (the same signals
+  as api.cache) and bumps the shared catalog generation of api.cache.
+  Other workers compare that generation at most every
+  HOTCACHE_CHECK_INTERVAL seconds (default 1.0) and drop their copy when
+  it moved.
+- Stock moves (``inventory_changed``: checkouts, cancellations) and new
+  image variants (``product_images_changed``) only evict the products
+  involved, and only in this process. Elsewhere ``inventory`` and
+  ``image_variants`` can be HOTCACHE_TTL seconds old, so never use
+  ``inventory`` to decide a sale.
+
+Cross-worker invalidation needs the generation to live in a cache every
+worker shares (Redis, Memcached, database or file; API_CACHE_ALIAS). On
+a per-process backend (LocMemCache, DummyCache) other workers would
+serve stale products and categories for up to HOTCACHE_TTL, so the hot
+cache stays off there and every lookup goes to the database.
+HOTCACHE_ENABLED=True forces it on anyway, for single-process
+deployments; the system check api.W001 flags that.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models.fields.files import ImageFieldFile
+from django.db.models.signals import post_delete, post_save
+
+from storeapp.models import Category, Product, ProductImage
+from storeapp.signals import inventory_changed, product_images_changed, products_bulk_changed
+from .cache import get_cache, get_generation
+
+MISSING = object()
+
+
+class ProductRecord(NamedTuple):
+    id: uuid.UUID
+    name: str
+    price: float
+    image: ImageFieldFile
+    image_variants: dict
+    inventory: int
+    category_id: uuid.UUID
+
+
+class LRUCache:
+    """Thread-safe LRU with a per-entry TTL"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is MISSING:
+                return MISSING
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def discard(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+products = LRUCache(getattr(settings, 'HOTCACHE_MAX_PRODUCTS', 10000), getattr(settings, 'HOTCACHE_TTL', 60))
+categories = LRUCache(1, getattr(settings, 'HOTCACHE_TTL', 60))
+_generation = {'value': None, 'checked': float('-inf')}
+
+PRODUCT_FIELDS = ['pk', 'name', 'effective_price', 'image', 'image_variants', 'inventory', 'category_id']
+IMAGE_FIELD = Product._meta.get_field('image')
+
+
+def clear(**kwargs):
+    products.clear()
+    categories.clear()
+
+
+def invalidate(**kwargs):
+    """Signal receiver: drop this process's copy now and after commit"""
+    clear()
+    transaction.on_commit(clear)
+
+
+def evict(pks, **kwargs):
+    """Signal receiver for per-product changes: drop just these products, now and after commit"""
+    pks = [pk for pk in map(as_uuid, pks) if pk]
+    products.discard(pks)
+    transaction.on_commit(lambda: products.discard(pks))
+
+
+def has_shared_generation():
+    return not isinstance(get_cache(), (LocMemCache, DummyCache))
+
+
+def is_enabled():
+    setting = getattr(settings, 'HOTCACHE_ENABLED', None)
+    return has_shared_generation() if setting is None else setting
+
+
+def check_shared_cache(**kwargs):
+    """System check: the hot cache forced on without a shared generation"""
+    if getattr(settings, 'HOTCACHE_ENABLED', None) and not has_shared_generation():
+        return [checks.Warning(
+            'HOTCACHE_ENABLED is set but API_CACHE_ALIAS is a per-process cache',
+            hint='Other workers never see catalog changes and serve stale products for up to '
+                 'HOTCACHE_TTL seconds. Use a shared cache (Redis, Memcached) or a single process.',
+            id='api.W001',
+        )]
+    return []
+
+
+def sync():
+    """
+    Drop everything if another worker changed the catalog since the last check
+
+    Returns whether the hot cache may be used at all (is_enabled).
+    """
+    if not is_enabled():
+        return False
+    now = time.monotonic()
+    if now - _generation['checked'] < getattr(settings, 'HOTCACHE_CHECK_INTERVAL', 1.0):
+        return True
+    _generation['checked'] = now
+    generation = get_generation()
+    if generation != _generation['value']:
+        clear()
+        _generation['value'] = generation
+    return True
+
+
+def as_uuid(value):
+    try:
+        return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+
+def get_products(ids):
+    """``{id: ProductRecord}`` for the existing ids; one query for all the misses"""
+    use_cache = sync()
+    found, missing = {}, []
+    for pk in filter(None, map(as_uuid, ids)):
+        record = products.get(pk) if use_cache else MISSING
+        if record is MISSING:
+            missing.append(pk)
+        else:
+            found[pk] = record
+    if missing:
+        for pk, name, price, image, variants, inventory, category_id in (
+            Product.objects.filter(pk__in=missing).values_list(*PRODUCT_FIELDS)
+        ):
+            record = ProductRecord(pk, name, price, ImageFieldFile(None, IMAGE_FIELD, image or ''),
+                                   variants, inventory, category_id)
+            if use_cache:
+                products.set(pk, record)
+            found[pk] = record
+    return found
+
+
+def get_product(pk):
+    """The ProductRecord of ``pk``, or None if there is no such product"""
+    pk = as_uuid(pk)
+    return get_products([pk]).get(pk) if pk else None
+
+
+def get_categories():
+    """Every category as ``{'category_id', 'title', 'slug'}``, ordered by title"""
+    use_cache = sync()
+    rows = categories.get('all') if use_cache else MISSING
+    if rows is MISSING:
+        rows = list(Category.objects.order_by('title').values('category_id', 'title', 'slug'))
+        if use_cache:
+            categories.set('all', rows)
+    return rows
+
+
+def get_category_ids():
+    return {row['category_id'] for row in get_categories()}
+
+
+for model in (Product, ProductImage, Category):
+    post_save.connect(invalidate, sender=model, dispatch_uid=f'api-hotcache-save-{model.__name__}')
+    post_delete.connect(invalidate, sender=model, dispatch_uid=f'api-hotcache-delete-{model.__name__}')
+products_bulk_changed.connect(invalidate, dispatch_uid='api-hotcache-bulk')
+inventory_changed.connect(evict, dispatch_uid='api-hotcache-inventory')
+product_images_changed.connect(evict, dispatch_uid='api-hotcache-images')
@@ -0,0 +1,406 @@
+"""
+Bulk product import
+
+Streams CSV or NDJSON rows (see ProductImportRowSerializer for the
+columns) and writes them in batches:
+
+1. rows are validated one by one; a bad row is reported and skipped
+2. the batch's images are fetched, decoded and stored in a process pool
+3. under a catalog lock (``lock_slugs``), missing categories are
+   bulk-created, then products are looked up by slug: new ones are
+   bulk-created, changed ones bulk-updated and unchanged ones left
+   alone. Re-running an import is cheap, and two imports of the same
+   slugs at once never create the same product twice
+4. image rows are bulk-created for products that have no images yet,
+   and their thumbnails are queued (storeapp.imaging)
+
+Each batch commits on its own; an error in one row never aborts the
+batch or the import.
+
+Image URLs come from the uploaded file, so every host (including each
+redirect target) must resolve to public addresses only: loopback,
+private, link-local (cloud metadata) and reserved ranges are refused.
+
+Settings:
+- IMPORT_IMAGE_HOSTS: when set, the only hosts images may be fetched
+  from (still subject to the address check)
+"""
+
+import csv
+import hashlib
+import io
+import ipaddress
+import json
+import os
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+import django
+import requests
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, connections, transaction
+from django.db.models import F
+from django.utils.text import slugify
+from PIL import Image, UnidentifiedImageError
+
+from storeapp import imaging
+from storeapp.models import Category, ChangeLog, Product, ProductImage
+from storeapp.signals import products_bulk_changed
+from . import cache, hotcache
+from .serializer import ProductImportRowSerializer
+
+FORMATS = ('csv', 'ndjson')
+PRODUCT_FIELDS = ['name', 'description', 'old_price', 'discount', 'inventory', 'top_deal', 'flash_sales']
+BATCH_SIZE = 1000
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+IMAGE_TIMEOUT = 15
+MAX_IMAGE_REDIRECTS = 3
+MAX_REPORTED_ERRORS = 1000
+# pg_advisory_xact_lock key serializing the import batches
+IMPORT_LOCK_ID = 0x70726f64
+
+
+class ImportResult:
+    """
+    Import counters plus the first MAX_REPORTED_ERRORS row errors
+
+    A row whose images failed is still imported; it is counted in
+    ``failed`` and reported with its image errors.
+    """
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.images = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, slug, errors):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'slug': slug, 'errors': errors})
+
+    def as_dict(self):
+        return {
+            'rows': self.rows,
+            'created': self.created,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'images': self.images,
+            'failed': self.failed,
+            'errors': self.errors,
+        }
+
+
+def read_rows(stream, fmt):
+    """Yield ``(line, row or None, parse error or None)`` from a text stream"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            row = {key: value for key, value in row.items() if key and value not in ('', None)}
+            if 'images' in row:
+                row['images'] = row['images'].split()
+            yield reader.line_num, row, None
+    elif fmt == 'ndjson':
+        for line, text in enumerate(stream, 1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+                if not isinstance(row, dict):
+                    raise ValueError('expected a JSON object')
+            except ValueError as exc:
+                yield line, None, {'non_field_errors': [str(exc)]}
+                continue
+            yield line, {key: value for key, value in row.items() if value not in ('', None)}, None
+    else:
+        raise ValueError(f"format must be one of: {', '.join(FORMATS)}")
+
+
+class ImageURLError(ValueError):
+    pass
+
+
+def check_image_url(url):
+    """Raise ImageURLError unless ``url`` is http(s) on an allowed, public host"""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageURLError('only http(s) URLs are allowed')
+    allowed = getattr(settings, 'IMPORT_IMAGE_HOSTS', None)
+    if allowed is not None and parts.hostname.lower() not in {host.lower() for host in allowed}:
+        raise ImageURLError(f'{parts.hostname} is not an allowed image host')
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, parts.port or None, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError) as exc:
+        raise ImageURLError(f'cannot resolve {parts.hostname}: {exc}')
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if not address.is_global or address.is_multicast:
+            raise ImageURLError(f'{parts.hostname} resolves to a non-public address')
+
+
+def fetch_image(url):
+    """The bytes at ``url`` (at most MAX_IMAGE_BYTES + 1), checking every redirect"""
+    for _ in range(MAX_IMAGE_REDIRECTS + 1):
+        check_image_url(url)
+        with requests.get(url, timeout=IMAGE_TIMEOUT, stream=True, allow_redirects=False) as response:
+            if response.is_redirect:
+                url = urljoin(url, response.headers['location'])
+                continue
+            response.raise_for_status()
+            if int(response.headers.get('content-length') or 0) > MAX_IMAGE_BYTES:
+                raise ImageURLError(f'larger than {MAX_IMAGE_BYTES} bytes')
+            return response.raw.read(MAX_IMAGE_BYTES + 1, decode_content=True)
+    raise ImageURLError('too many redirects')
+
+
+def _init_worker():
+    django.setup()
+
+
+def process_image(source, allow_local=False):
+    """
+    Fetch, decode and store one image; return ``(name, error)``
+
+    Runs in a worker process. Files are stored under a content hash, so
+    importing the same picture twice stores it once.
+    """
+    try:
+        if urlsplit(source).scheme in ('http', 'https'):
+            data = fetch_image(source)
+        elif allow_local:
+            with open(source, 'rb') as fh:
+                data = fh.read(MAX_IMAGE_BYTES + 1)
+        else:
+            return None, f'{source}: only http(s) URLs are allowed'
+        if len(data) > MAX_IMAGE_BYTES:
+            return None, f'{source}: larger than {MAX_IMAGE_BYTES} bytes'
+        with Image.open(io.BytesIO(data)) as image:
+            image.verify()
+            extension = {'JPEG': 'jpg'}.get(image.format, (image.format or 'png').lower())
+        name = f'img/{hashlib.sha1(data).hexdigest()[:24]}.{extension}'
+        if not default_storage.exists(name):
+            name = default_storage.save(name, ContentFile(data))
+        return name, None
+    except (OSError, ValueError, requests.RequestException, UnidentifiedImageError,
+            Image.DecompressionBombError) as exc:
+        return None, f'{source}: {exc}'
+
+
+def lock_slugs(slugs):
+    """
+    Serialize imports of ``slugs`` until the transaction ends
+
+    Slugs are not unique in the database, so a batch must look products
+    up and create the missing ones under a lock. PostgreSQL takes a
+    transaction-level advisory lock; elsewhere a no-op UPDATE of those
+    rows makes the transaction a writer (SQLite's single writer lock,
+    InnoDB's next-key locks on the slug index).
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [IMPORT_LOCK_ID])
+    else:
+        Product._base_manager.filter(slug__in=list(slugs)).update(slug=F('slug'))
+
+
+class ProductImporter:
+    """
+    ``workers=0`` processes images in this process (no pool)
+
+    ``allow_local_images`` lets rows name files on this machine; only the
+    management command enables it, ``images_dir`` is their base dir.
+    ``on_batch`` is called after each committed batch.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, workers=None, allow_local_images=False, images_dir='',
+                 on_batch=None):
+        self.batch_size = batch_size
+        self.on_batch = on_batch
+        self.workers = os.cpu_count() if workers is None else workers
+        self.allow_local_images = allow_local_images
+        self.images_dir = images_dir
+        self.categories = {}
+
+    def run(self, stream, fmt='csv'):
+        result = ImportResult()
+        pool = None
+        if self.workers:
+            if not connection.in_atomic_block:
+                # Forked workers must not inherit open database sockets
+                connections.close_all()
+            pool = ProcessPoolExecutor(self.workers, initializer=_init_worker)
+        try:
+            batch = []
+            for line, row, errors in read_rows(stream, fmt):
+                result.rows += 1
+                if errors:
+                    result.error(line, None, errors)
+                    continue
+                batch.append((line, row))
+                if len(batch) >= self.batch_size:
+                    self.import_batch(batch, result, pool)
+                    batch = []
+            if batch:
+                self.import_batch(batch, result, pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return result
+
+    def import_batch(self, batch, result, pool):
+        rows = {}
+        for line, row in batch:
+            serializer = ProductImportRowSerializer(data=row)
+            if serializer.is_valid():
+                # A later row for the same slug wins
+                rows[serializer.validated_data['slug']] = (line, serializer.validated_data)
+            else:
+                result.error(line, row.get('slug'), serializer.errors)
+
+        # Images are fetched before taking the lock, then checked again under it
+        existing, with_images = self.get_existing(rows)
+        images = self.store_images(
+            {slug: data for slug, (line, data) in rows.items()
+             if slug not in existing or existing[slug].pk not in with_images},
+            rows, result, pool,
+        )
+
+        with transaction.atomic():
+            lock_slugs(rows)
+            existing, with_images = self.get_existing(rows)
+            images = {
+                slug: names for slug, names in images.items()
+                if slug not in existing or existing[slug].pk not in with_images
+            }
+            categories = self.get_categories(data for line, data in rows.values())
+            created, updated = [], []
+            fields = set()
+            for slug, (line, data) in rows.items():
+                values = {field: data[field] for field in PRODUCT_FIELDS if field in data}
+                category = categories.get(self.category_slug(data))
+                if category is not None:
+                    values['category_id'] = category.pk
+                product = existing.get(slug)
+                if product is None:
+                    product = Product(slug=slug, **values)
+                    if images.get(slug):
+                        product.image = images[slug][0]
+                    created.append(product)
+                    continue
+                changed = {field for field, value in values.items() if getattr(product, field) != value}
+                for field in changed:
+                    setattr(product, field, values[field])
+                if images.get(slug) and not product.image:
+                    product.image = images[slug][0]
+                    changed.add('image')
+                if not changed:
+                    result.unchanged += 1
+                    continue
+                fields |= {'category' if field == 'category_id' else field for field in changed}
+                updated.append(product)
+
+            Product.objects.bulk_create(created, batch_size=self.batch_size)
+            if updated:
+                Product.objects.bulk_update(updated, sorted(fields), batch_size=self.batch_size)
+            result.created += len(created)
+            result.updated += len(updated)
+
+            products = {product.slug: product for product in [*existing.values(), *created]}
+            new_images = [
+                ProductImage(product=products[slug], image=name)
+                for slug, names in images.items() for name in names
+            ]
+            ProductImage.objects.bulk_create(new_images, batch_size=self.batch_size)
+            result.images += len(new_images)
+            touched = {image.product_id for image in new_images} - {p.pk for p in [*created, *updated]}
+            if touched:
+                # bulk_create skips post_save, which drives cache invalidation
+                products_bulk_changed.send(sender=ProductImage, pks=list(touched))
+            # ... and the thumbnail generation
+            imaging.schedule(Product, [*created, *updated])
+            imaging.schedule(ProductImage, new_images)
+        if self.on_batch is not None:
+            self.on_batch()
+
+    @staticmethod
+    def get_existing(slugs):
+        """``({slug: oldest product}, {pks of those with images})``"""
+        existing = {}
+        for product in Product.objects.filter(slug__in=slugs).order_by('slug', 'id'):
+            existing.setdefault(product.slug, product)
+        with_images = set(
+            ProductImage.objects.filter(product__in=existing.values())
+            .values_list('product_id', flat=True)
+        )
+        return existing, with_images
+
+    def store_images(self, wanted, rows, result, pool):
+        """Return ``{slug: [stored names]}`` for the rows in ``wanted``"""
+        jobs = []
+        for slug, data in wanted.items():
+            sources = ([data['image']] if 'image' in data else []) + data.get('images', [])
+            for source in dict.fromkeys(sources):
+                if self.allow_local_images and not urlsplit(source).scheme:
+                    source = os.path.join(self.images_dir, source)
+                jobs.append((slug, source))
+        if not jobs:
+            return {}
+
+        sources = [source for slug, source in jobs]
+        flags = [self.allow_local_images] * len(jobs)
+        if pool is None:
+            outcomes = map(process_image, sources, flags)
+        else:
+            outcomes = pool.map(process_image, sources, flags, chunksize=8)
+
+        images = {}
+        for (slug, source), (name, error) in zip(jobs, outcomes):
+            if error:
+                result.error(rows[slug][0], slug, {'images': [error]})
+            else:
+                images.setdefault(slug, [])
+                if name not in images[slug]:
+                    images[slug].append(name)
+        return images
+
+    @staticmethod
+    def category_slug(data):
+        if 'category_slug' in data:
+            return data['category_slug']
+        if 'category' in data:
+            return slugify(data['category'])[:50]
+        return None
+
+    def get_categories(self, rows):
+        """Map category slug -> Category, creating the missing ones"""
+        titles = {}
+        for data in rows:
+            slug = self.category_slug(data)
+            if slug and slug not in self.categories:
+                titles.setdefault(slug, data.get('category') or slug)
+        if titles:
+            for category in Category.objects.filter(slug__in=titles).order_by('slug', 'title'):
+                self.categories.setdefault(category.slug, category)
+            missing = [
+                Category(slug=slug, title=title)
+                for slug, title in titles.items() if slug not in self.categories
+            ]
+            created = Category.objects.bulk_create(missing)
+            for category in created:
+                self.categories[category.slug] = category
+            if created:
+                # bulk_create skips post_save, which feeds the change log and
+                # invalidates the catalog caches
+                ChangeLog.objects.record(Category, [category.pk for category in created])
+                cache.invalidate_catalog()
+                hotcache.invalidate()
+        return self.categories
+
+
+def import_products(stream, fmt='csv', **options):
+    return ProductImporter(**options).run(stream, fmt)
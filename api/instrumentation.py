@@ -0,0 +1,311 @@
+"""
+Per-request performance instrumentation
+
+Enable it with::
+
+    MIDDLEWARE = ['api.instrumentation.InstrumentationMiddleware', ...]
+
+The DB execute wrapper and the ``serializer.data`` timing are installed
+when that middleware is loaded, so a process without it pays nothing.
+It records, for every request:
+
+- SQL: number of queries and time, through a DB execute wrapper installed
+  on every connection (so ORM calls from sync_to_async threads count too)
+- serialize: time spent producing ``serializer.data``, per serializer
+- cache: time spent in the catalog response cache (api.cache)
+- external: time spent calling third parties (``timed('external', name)``,
+  used by api.payments)
+
+Each response gets a ``Server-Timing`` header with those figures. The
+process-wide totals, with latency histograms per DRF route, are served in
+Prometheus text format by ``metrics_view`` (``/metrics``); figures are per
+process, so scrape every worker. Requests slower than
+SLOW_REQUEST_SECONDS are logged to ``api.instrumentation.slow`` with their
+slowest SQL statements (placeholders only, never parameters).
+
+Settings:
+- INSTRUMENTATION_ENABLED: set to False to turn the middleware off
+  without editing MIDDLEWARE (default True)
+- METRICS_ALLOWED_IPS: addresses/networks allowed to read /metrics
+  (default loopback only)
+- SLOW_REQUEST_SECONDS: slow-request log threshold (default 1.0)
+- SLOW_REQUEST_MAX_QUERIES: SQL statements kept per request (default 200)
+"""
+
+import contextvars
+import ipaddress
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from rest_framework.serializers import BaseSerializer, ListSerializer
+
+slow_logger = logging.getLogger('api.instrumentation.slow')
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+@dataclass
+class RequestStats:
+    sql_count: int = 0
+    sql_time: float = 0.0
+    # kind -> seconds ('serialize', 'cache', 'external')
+    timings: dict = field(default_factory=dict)
+    # (seconds, sql) of the first SLOW_REQUEST_MAX_QUERIES statements
+    queries: list = field(default_factory=list)
+    _depth: dict = field(default_factory=dict)
+
+
+current = contextvars.ContextVar('api_request_stats', default=None)
+
+
+class Registry:
+    """Thread-safe in-process counters and histograms"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+
+    def inc(self, name, labels, value=1, help=''):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.help.setdefault(name, ('counter', help))
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, help=''):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.help.setdefault(name, ('histogram', help))
+            buckets, total = self.histograms.get(key, ([0] * len(BUCKETS), [0.0, 0]))
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    buckets[index] += 1
+            total[0] += value
+            total[1] += 1
+            self.histograms[key] = (buckets, total)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self):
+        """Prometheus text exposition format (0.0.4)"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(b), list(t))) for key, (b, t) in self.histograms.items())
+            described = dict(self.help)
+        lines, seen = [], set()
+
+        def header(name):
+            if name not in seen:
+                seen.add(name)
+                kind, text = described[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f'{name}{format_labels(labels)} {value:g}')
+        for (name, labels), (buckets, (total, count)) in histograms:
+            header(name)
+            for bound, observed in zip(BUCKETS, buckets):
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", f"{bound:g}"),))} {observed}')
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total:g}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+registry = Registry()
+
+
+@contextmanager
+def timed(kind, name=None):
+    """
+    Add the time spent in the block to the current request's ``kind``
+
+    Nested blocks of the same kind only count once. With a ``name``,
+    external calls are also observed in a histogram, in or out of a
+    request (task queue workers).
+    """
+    stats = current.get()
+    outer = stats is not None and not stats._depth.get(kind)
+    if stats is not None:
+        stats._depth[kind] = stats._depth.get(kind, 0) + 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if stats is not None:
+            stats._depth[kind] -= 1
+            if outer:
+                stats.timings[kind] = stats.timings.get(kind, 0.0) + elapsed
+        if name is not None:
+            registry.observe(f'{kind}_call_duration_seconds', {'name': name}, elapsed,
+                             help=f'Duration of {kind} calls')
+
+
+def record_sql(execute, sql, params, many, context):
+    stats = current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        stats.sql_count += 1
+        stats.sql_time += elapsed
+        if len(stats.queries) < getattr(settings, 'SLOW_REQUEST_MAX_QUERIES', 200):
+            stats.queries.append((elapsed, sql))
+
+
+def add_execute_wrapper(sender=None, connection=None, **kwargs):
+    # Wrappers live on the connection wrapper, which outlives reconnects
+    if record_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_sql)
+
+
+def install():
+    """Hook the DB wrapper and serializer timing in (InstrumentationMiddleware)"""
+    connection_created.connect(add_execute_wrapper, dispatch_uid='api-instrumentation-sql')
+    for connection in connections.all(initialized_only=True):
+        add_execute_wrapper(connection=connection)
+
+    if getattr(BaseSerializer.data.fget, 'instrumented', False):
+        return
+    original = BaseSerializer.data
+
+    def data(self):
+        if current.get() is None or getattr(self, '_data', None) is not None:
+            return original.fget(self)
+        serializer = self.child if isinstance(self, ListSerializer) else self
+        started = time.perf_counter()
+        with timed('serialize'):
+            result = original.fget(self)
+        registry.inc('serializer_seconds_total', {'serializer': type(serializer).__name__},
+                     time.perf_counter() - started, help='Time spent producing serializer.data')
+        return result
+
+    data.instrumented = True
+    BaseSerializer.data = property(data)
+
+
+def get_route(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        # Keeps 404 scans from creating a label per path
+        return 'unmatched'
+    return match.view_name or match.route
+
+
+def server_timing(stats, total):
+    parts = [
+        f'db;dur={stats.sql_time * 1000:.1f};desc="{stats.sql_count} queries"',
+        *(f'{kind};dur={seconds * 1000:.1f}' for kind, seconds in sorted(stats.timings.items())),
+        f'total;dur={total * 1000:.1f}',
+    ]
+    return ', '.join(parts)
+
+
+class InstrumentationMiddleware:
+    """
+    Sync and async: under ASGI the async views (api.async_views) stay on
+    the event loop instead of being adapted through a thread
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'INSTRUMENTATION_ENABLED', True):
+            raise MiddlewareNotUsed()
+        install()
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        # ORM calls in sync_to_async threads copy this context, so they see stats
+        stats = RequestStats()
+        token = current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - started)
+
+    def finish(self, request, response, stats, total):
+        labels = {'route': get_route(request), 'method': request.method}
+        registry.observe('http_request_duration_seconds', labels, total, help='Request latency per route')
+        registry.inc('http_requests_total', {**labels, 'status': response.status_code},
+                     help='Requests per route and status')
+        registry.inc('http_request_sql_queries_total', labels, stats.sql_count, help='SQL queries per route')
+        registry.inc('http_request_sql_seconds_total', labels, stats.sql_time, help='SQL time per route')
+        for kind, seconds in stats.timings.items():
+            registry.inc(f'http_request_{kind}_seconds_total', labels, seconds, help=f'{kind} time per route')
+
+        response['Server-Timing'] = server_timing(stats, total)
+        if total >= getattr(settings, 'SLOW_REQUEST_SECONDS', 1.0):
+            self.log_slow_request(request, labels['route'], stats, total)
+        return response
+
+    def log_slow_request(self, request, route, stats, total):
+        slowest = sorted(stats.queries, key=lambda query: query[0], reverse=True)[:10]
+        slow_logger.warning(
+            'Slow request %s %s (%s) %.0fms: %s queries in %.0fms, %s\n%s',
+            request.method, request.path, route, total * 1000, stats.sql_count, stats.sql_time * 1000,
+            ', '.join(f'{kind} {seconds * 1000:.0f}ms' for kind, seconds in stats.timings.items()) or '-',
+            '\n'.join(f'  {seconds * 1000:.1f}ms {sql}' for seconds, sql in slowest),
+        )
+
+
+def ip_allowed(address):
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in ipaddress.ip_network(network, strict=False) for network in allowed)
+
+
+def metrics_view(request):
+    """GET /metrics -- Prometheus scrape endpoint, restricted to METRICS_ALLOWED_IPS"""
+    if not ip_allowed(request.META.get('REMOTE_ADDR', '')):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,151 @@
+"""
+Minimal asyncio HTTP/1.1 load generator
+
+Opens ``connections`` keep-alive connections and has each one send GET
+requests back to back for ``duration`` seconds, recording the latency
+and status of every response. Standard library only, so benchmarks run
+anywhere the project does.
+"""
+
+import asyncio
+import ssl
+import time
+from urllib.parse import urlsplit
+
+
+class LoadResult:
+    def __init__(self, url, connections):
+        self.url = url
+        self.connections = connections
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def record(self, status, latency):
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    @property
+    def requests(self):
+        return len(self.latencies)
+
+    @property
+    def rps(self):
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, p):
+        """Nearest-rank percentile of the latencies, in milliseconds"""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))
+        return ordered[index] * 1000
+
+    def as_dict(self):
+        return {
+            'url': self.url,
+            'connections': self.connections,
+            'requests': self.requests,
+            'errors': self.errors,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+            'elapsed': round(self.elapsed, 3),
+            'rps': round(self.rps, 1),
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+        }
+
+
+async def read_response(reader):
+    """Read one response; return ``(status, keep_alive)``"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip().lower()
+
+    keep_alive = headers.get('connection') != 'close'
+    if status in (204, 304) or 100 <= status < 200:
+        pass
+    elif headers.get('transfer-encoding') == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    else:
+        await reader.read()
+        keep_alive = False
+    return status, keep_alive
+
+
+async def _client(url, deadline, result, headers):
+    parts = urlsplit(url)
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+    lines = [f'GET {target} HTTP/1.1', f'Host: {parts.netloc}', 'Connection: keep-alive']
+    lines += [f'{name}: {value}' for name, value in headers.items()]
+    request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+    context = ssl.create_default_context() if secure else None
+
+    reader = writer = None
+    while time.monotonic() < deadline:
+        if writer is None:
+            try:
+                reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=context)
+            except OSError:
+                result.errors += 1
+                await asyncio.sleep(0.05)
+                continue
+        started = time.perf_counter()
+        try:
+            writer.write(request)
+            status, keep_alive = await read_response(reader)
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            result.errors += 1
+            writer.close()
+            writer = None
+            continue
+        result.record(status, time.perf_counter() - started)
+        if not keep_alive:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def arun(url, connections=100, duration=10.0, headers=None):
+    result = LoadResult(url, connections)
+    started = time.monotonic()
+    deadline = started + duration
+    await asyncio.gather(*(
+        _client(url, deadline, result, headers or {}) for _ in range(connections)
+    ))
+    result.elapsed = time.monotonic() - started
+    return result
+
+
+def run(url, connections=100, duration=10.0, headers=None):
+    """Hammer ``url`` and return a LoadResult"""
+    return asyncio.run(arun(url, connections, duration, headers))
+
+
+def raise_open_file_limit(needed):
+    """Best effort: lift RLIMIT_NOFILE so ``needed`` sockets can be open"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
@@ -0,0 +1,141 @@
+"""
+Benchmark the API hot paths (api.benchmark)
+
+In-process, against a throwaway test database seeded for the run:
+
+    python manage.py bench --products 2000 --save-baseline bench.json
+    python manage.py bench --products 2000 --compare bench.json
+
+Against a live server sharing this project's database (seed it first;
+enable api.instrumentation on the server to get query counts):
+
+    python manage.py bench --seed-only --products 2000
+    python manage.py bench --live http://127.0.0.1:8000 --concurrency 8
+    python manage.py bench --clear
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from api import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Seed data and measure p50/p95/p99, requests/sec and queries per request of the API scenarios'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--live', metavar='URL', help='Benchmark a running server instead of in-process')
+        parser.add_argument('--auth-header-type', default='JWT')
+        parser.add_argument('--scenario', action='append', choices=sorted(benchmark.SCENARIOS),
+                            help='Scenario(s) to run; defaults to all')
+        parser.add_argument('--iterations', type=int, default=200, help='Timed requests per scenario')
+        parser.add_argument('--warmup', type=int, default=20, help='Untimed requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=1, help='Client threads (--live only)')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for data and scenarios')
+        for name, default in vars(benchmark.SeedSizes()).items():
+            parser.add_argument(f'--{name}', type=int, default=default, help=f'Seeded {name}')
+        parser.add_argument('--keepdb', action='store_true', help='Reuse the in-process test database')
+        parser.add_argument('--seed-only', action='store_true', help='Seed this database and exit')
+        parser.add_argument('--clear', action='store_true', help='Remove seeded data from this database and exit')
+        parser.add_argument('--json', dest='json_path', help='Write the results to this file')
+        parser.add_argument('--save-baseline', metavar='PATH')
+        parser.add_argument('--compare', metavar='PATH', help='Baseline to compare with; fails on regressions')
+        parser.add_argument('--tolerance', type=float, default=0.10,
+                            help='Allowed p95/rps change before it counts as a regression (fraction)')
+
+    def handle(self, *args, **options):
+        sizes = benchmark.SeedSizes(**{name: options[name] for name in vars(benchmark.SeedSizes())})
+        if options['clear']:
+            benchmark.clear()
+            self.stdout.write('Removed the benchmark data')
+            return
+        if options['seed_only']:
+            self.stdout.write(f"Seeded {benchmark.seed(sizes, options['seed'])}")
+            return
+        if options['concurrency'] > 1 and not options['live']:
+            raise CommandError('--concurrency needs --live; the test client runs on one connection')
+
+        if options['live']:
+            results, meta = self.run_live(options, sizes)
+        else:
+            results, meta = self.run_in_process(options, sizes)
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as fh:
+                json.dump({'meta': meta, 'results': results}, fh, indent=2)
+        if options['save_baseline']:
+            benchmark.save_baseline(options['save_baseline'], meta, results)
+            self.stdout.write(f"Baseline written to {options['save_baseline']}")
+        if options['compare']:
+            self.compare(results, meta, options['compare'], options['tolerance'])
+
+    def run_live(self, options, sizes):
+        ctx = benchmark.load_context()
+        if ctx is None:
+            raise CommandError('No benchmark data in this database; run `bench --seed-only` first')
+        client = benchmark.LiveClient(options['live'], options['auth_header_type'])
+        return self.run_scenarios(client, ctx, options, sizes)
+
+    def run_in_process(self, options, sizes):
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            ctx = benchmark.load_context()
+            if ctx is None:
+                self.stdout.write(f"Seeded {benchmark.seed(sizes, options['seed'])}")
+                ctx = benchmark.load_context()
+            return self.run_scenarios(benchmark.InProcessClient(), ctx, options, sizes)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+    def run_scenarios(self, client, ctx, options, sizes):
+        results = []
+        for name in options['scenario'] or list(benchmark.SCENARIOS):
+            result = benchmark.run_scenario(
+                client, ctx, name, options['iterations'], options['warmup'],
+                options['concurrency'], options['seed'],
+            )
+            results.append(result.as_dict())
+            self.report(results[-1])
+        meta = benchmark.environment(client, vars(sizes), options['iterations'], options['concurrency'],
+                                     options['seed'])
+        return results, meta
+
+    def report(self, row):
+        def ms(value):
+            return '-' if value is None else f'{value:.1f}ms'
+        queries = '-' if row['queries_per_request'] is None else f"{row['queries_per_request']:g}"
+        self.stdout.write(
+            f"{row['scenario']:<15} {row['rps']:>8.1f} req/s  p50 {ms(row['p50_ms']):>8}  "
+            f"p95 {ms(row['p95_ms']):>8}  p99 {ms(row['p99_ms']):>8}  "
+            f"cpu {ms(row['cpu_ms_per_request']):>8}  queries {queries:>5}  errors {row['errors']}"
+        )
+
+    def compare(self, results, meta, path, tolerance):
+        try:
+            baseline = benchmark.load_baseline(path)
+        except (OSError, ValueError) as exc:
+            raise CommandError(f'Cannot read baseline {path}: {exc}')
+        for name in ('target', 'database', 'sizes', 'concurrency'):
+            if baseline['meta'].get(name) != meta[name]:
+                self.stderr.write(f"Warning: baseline {name} {baseline['meta'].get(name)!r} differs from {meta[name]!r}")
+        regressed = []
+        self.stdout.write(f"\nCompared with {path} ({baseline['meta'].get('created_at', '?')}):")
+        for row in benchmark.compare(results, baseline, tolerance):
+            current, base = row['current'], row['baseline']
+            self.stdout.write(
+                f"{row['scenario']:<15} p95 {base['p95_ms'] or 0:.1f} -> {current['p95_ms'] or 0:.1f}ms  "
+                f"rps {base['rps']:.1f} -> {current['rps']:.1f}  "
+                f"cpu {base.get('cpu_ms_per_request')} -> {current['cpu_ms_per_request']}ms  "
+                f"queries {base.get('queries_per_request')} -> {current['queries_per_request']}"
+                + (f"  REGRESSED: {', '.join(row['regressions'])}" if row['regressions'] else '')
+            )
+            if row['regressions']:
+                regressed.append(row['scenario'])
+        if regressed:
+            raise CommandError(f"Regressions in: {', '.join(regressed)}")
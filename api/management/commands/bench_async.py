@@ -0,0 +1,74 @@
+"""
+Compare the sync catalog viewsets with their async variants under load
+
+Run the sync endpoints under a WSGI server and the async ones under an
+ASGI server (or both under ASGI), then e.g.:
+
+    python manage.py bench_async --sync-url http://127.0.0.1:8000 \\
+        --async-url http://127.0.0.1:8001 --connections 1000 --duration 30
+
+The sync product and category endpoints are served from the response
+cache (api.cache); point API_CACHE_ALIAS at a DummyCache on the server to
+compare the database paths only.
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import loadgen
+from storeapp.models import Product
+
+ENDPOINTS = {
+    'products': ('/api/products/?pagination=cursor', '/api/async/products/'),
+    'product': ('/api/products/{product}/', '/api/async/products/{product}/'),
+    'categories': ('/api/categories/', '/api/async/categories/'),
+    'reviews': ('/api/products/{product}/reviews/', '/api/async/products/{product}/reviews/'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark requests/sec and latency of the sync vs async catalog endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sync-url', default='http://127.0.0.1:8000')
+        parser.add_argument('--async-url', help='Defaults to --sync-url')
+        parser.add_argument('--connections', type=int, default=1000)
+        parser.add_argument('--duration', type=float, default=30.0)
+        parser.add_argument('--warmup', type=float, default=2.0)
+        parser.add_argument('--endpoint', action='append', choices=sorted(ENDPOINTS),
+                            help='Endpoint(s) to run; defaults to all')
+        parser.add_argument('--product', help='Product id for detail/review endpoints')
+        parser.add_argument('--json', dest='json_path', help='Also write the results to this file')
+
+    def handle(self, *args, **options):
+        product = options['product'] or Product.objects.values_list('id', flat=True).first()
+        bases = {'sync': options['sync_url'], 'async': options['async_url'] or options['sync_url']}
+        connections = options['connections']
+        loadgen.raise_open_file_limit(connections + 64)
+
+        results = []
+        for name in options['endpoint'] or list(ENDPOINTS):
+            for variant, path in zip(('sync', 'async'), ENDPOINTS[name]):
+                if '{product}' in path and product is None:
+                    raise CommandError('No products found; pass --product or seed the catalog')
+                url = bases[variant].rstrip('/') + path.format(product=product)
+                if options['warmup']:
+                    loadgen.run(url, min(connections, 50), options['warmup'])
+                result = loadgen.run(url, connections, options['duration'])
+                results.append({'endpoint': name, 'variant': variant, **result.as_dict()})
+                self.report(results[-1])
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as fh:
+                json.dump(results, fh, indent=2)
+
+    def report(self, row):
+        def ms(value):
+            return '-' if value is None else f'{value:.1f}ms'
+        non_2xx = sum(count for status, count in row['statuses'].items() if not status.startswith('2'))
+        self.stdout.write(
+            f"{row['endpoint']:<11} {row['variant']:<6} {row['rps']:>9.1f} req/s  "
+            f"p50 {ms(row['p50_ms']):>9}  p99 {ms(row['p99_ms']):>9}  "
+            f"non-2xx {non_2xx}  errors {row['errors']}"
+        )
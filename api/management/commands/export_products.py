@@ -0,0 +1,39 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import export
+
+
+class Command(BaseCommand):
+    help = 'Stream the product catalog as NDJSON or CSV with constant memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', dest='fmt', choices=sorted(export.RENDERERS), default='ndjson')
+        parser.add_argument('--output', '-o', help='File to write; defaults to stdout')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--updated-since', help='ISO 8601 datetime; only products changed since')
+        parser.add_argument('--after', help='Resume after this product id (needs --updated-since)')
+        parser.add_argument('--base-url', default='', help='Prefix for image URLs')
+        parser.add_argument('--chunk-size', type=int, default=export.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            since, after = export.parse_position(options['updated_since'], options['after'])
+        except export.ExportError as exc:
+            raise CommandError(str(exc))
+        base_url = options['base_url'].rstrip('/')
+        blocks = export.stream(
+            options['fmt'], since, after, gzip=options['gzip'],
+            build_url=lambda url: base_url + url, chunk_size=options['chunk_size'],
+        )
+
+        if options['output']:
+            with open(options['output'], 'wb') as fh:
+                for block in blocks:
+                    fh.write(block)
+        else:
+            out = sys.stdout.buffer
+            for block in blocks:
+                out.write(block)
+            out.flush()
@@ -0,0 +1,51 @@
+import io
+import json
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.importer import BATCH_SIZE, FORMATS, import_products
+
+
+class Command(BaseCommand):
+    help = 'Bulk create/update products from a CSV or NDJSON file, matched on slug'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Input file, or '-' for stdin")
+        parser.add_argument('--format', dest='fmt', choices=FORMATS,
+                            help='Defaults to ndjson for .ndjson/.jsonl files, else csv')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--workers', type=int, help='Image worker processes (0 = none); defaults to the CPU count')
+        parser.add_argument('--images-dir', default='', help='Base dir for image paths that are not URLs')
+        parser.add_argument('--errors', help='Write the row errors to this file as NDJSON')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['fmt'] or ('ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+        if path == '-':
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+        elif os.path.exists(path):
+            stream = open(path, encoding='utf-8-sig', newline='')
+        else:
+            raise CommandError(f'{path} does not exist')
+
+        with stream:
+            result = import_products(
+                stream, fmt,
+                batch_size=options['batch_size'],
+                workers=options['workers'],
+                allow_local_images=True,
+                images_dir=options['images_dir'] or os.path.dirname(os.path.abspath(path)),
+            )
+
+        summary = result.as_dict()
+        errors = summary.pop('errors')
+        if options['errors']:
+            with open(options['errors'], 'w') as fh:
+                for error in errors:
+                    fh.write(json.dumps(error) + '\n')
+        else:
+            for error in errors:
+                self.stderr.write(json.dumps(error))
+        self.stdout.write(', '.join(f'{key}={value}' for key, value in summary.items()))
@@ -0,0 +1,276 @@
+"""
+Pagination classes for the API
+
+ProductPagination keeps the classic ``?page=N`` behaviour and adds a
+keyset (cursor) mode for deep scrolling through large catalogs.
+"""
+
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination over ``(ordering field, id)``
+
+    Each page is fetched with ``WHERE (field, id) > (last value, last id)``
+    instead of an OFFSET, so page 1000 costs the same as page 1.
+
+    - The ordering comes from the ``ordering`` query param, restricted to
+      the view's ``ordering_fields``; ``id`` (or the view's
+      ``keyset_tiebreaker``) is always the tiebreaker.
+    - ``COUNT(*)`` only runs when the client sends ``?count=true``.
+    - Cursors are opaque base64 tokens and are only valid for the
+      ordering they were issued for.
+    """
+    page_size = api_settings.PAGE_SIZE or 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    ordering_param = api_settings.ORDERING_PARAM
+    tiebreaker = 'id'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page = self.get_page_queryset(queryset, request, view)
+        self.count = queryset.count() if self.wants_count(request) else None
+        return self.paginate_rows(list(page))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """Async variant for the ASGI views; rows are fetched with aiterator()"""
+        page = self.get_page_queryset(queryset, request, view)
+        self.count = await queryset.acount() if self.wants_count(request) else None
+        return self.paginate_rows([row async for row in page.aiterator(chunk_size=self.page_size + 1)])
+
+    def get_page_queryset(self, queryset, request, view=None):
+        """Order and filter ``queryset`` down to the rows of the requested page"""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.tiebreaker = getattr(view, 'keyset_tiebreaker', self.tiebreaker)
+        self.field, self.descending = self.get_ordering(request, view)
+        self.cursor = self.decode_cursor(request, queryset)
+        self.reverse = bool(self.cursor and self.cursor['r'])
+        scan_descending = self.descending != self.reverse
+
+        queryset = queryset.order_by(*self.order_by(scan_descending))
+        if self.cursor is not None:
+            queryset = queryset.filter(self.after(self.cursor, scan_descending))
+        return queryset[:self.page_size + 1]
+
+    def paginate_rows(self, results):
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if self.reverse:
+            results.reverse()
+
+        if self.cursor is None:
+            self.has_previous, self.has_next = False, has_more
+        elif self.reverse:
+            self.has_previous, self.has_next = has_more, True
+        else:
+            self.has_previous, self.has_next = True, has_more
+
+        self.first = results[0] if results else None
+        self.last = results[-1] if results else None
+        return results
+
+    def get_paginated_response(self, data):
+        payload = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if self.count is not None:
+            payload = {'count': self.count, **payload}
+        return Response(payload)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'count': {'type': 'integer', 'example': 123},
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'The pagination cursor value.',
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.page_size_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Number of results to return per page.',
+                'schema': {'type': 'integer'},
+            },
+            {
+                'name': self.count_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Include the total number of results (runs a COUNT query).',
+                'schema': {'type': 'boolean'},
+            },
+        ]
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if size <= 0:
+            return self.page_size
+        return min(size, self.max_page_size)
+
+    def get_ordering(self, request, view):
+        """Return ``(field, descending)`` for the requested ordering"""
+        allowed = set(getattr(view, 'ordering_fields', None) or [])
+        params = request.query_params.get(self.ordering_param, '')
+        for term in params.split(','):
+            term = term.strip()
+            if term.lstrip('-') in allowed:
+                return term.lstrip('-'), term.startswith('-')
+        return self.tiebreaker, False
+
+    def wants_count(self, request):
+        value = request.query_params.get(self.count_query_param, '')
+        return value.lower() in ('1', 'true', 'yes')
+
+    def order_by(self, descending):
+        prefix = '-' if descending else ''
+        fields = [self.field]
+        if self.field != self.tiebreaker:
+            fields.append(self.tiebreaker)
+        return [prefix + field for field in fields]
+
+    def after(self, cursor, descending):
+        """Build the keyset predicate for rows after ``cursor``"""
+        op = 'lt' if descending else 'gt'
+        tiebreak = Q(**{f'{self.tiebreaker}__{op}': cursor['id']})
+        if self.field == self.tiebreaker:
+            return tiebreak
+        return (
+            Q(**{f'{self.field}__{op}': cursor['v']})
+            | (Q(**{self.field: cursor['v']}) & tiebreak)
+        )
+
+    def get_next_link(self):
+        if not self.has_next or self.last is None:
+            return None
+        return self.build_link(self.last, reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or self.first is None:
+            return None
+        return self.build_link(self.first, reverse=True)
+
+    def build_link(self, row, reverse):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.count_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(row, reverse))
+
+    def encode_cursor(self, row, reverse):
+        position = {
+            'o': self.field,
+            'v': self.value(row, self.field),
+            'id': self.value(row, self.tiebreaker),
+            'r': int(reverse),
+        }
+        raw = json.dumps(position, default=str, separators=(',', ':'))
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, request, queryset):
+        """The cursor's position, with ``v`` and ``id`` converted for ``queryset``"""
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+            position = json.loads(raw)
+            if position['o'] != self.field or not {'v', 'id', 'r'} <= position.keys():
+                raise ValueError(position)
+            for key, name in (('v', self.field), ('id', self.tiebreaker)):
+                position[key] = self.get_field(queryset, name).to_python(position[key])
+                if position[key] is None:
+                    # Keyset predicates cannot compare with NULL
+                    raise ValueError(position)
+        except (TypeError, ValueError, KeyError, AttributeError, binascii.Error, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    @staticmethod
+    def get_field(queryset, name):
+        """The model field (or annotation output field) ``name`` orders by"""
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field
+        if name == 'pk':
+            return queryset.model._meta.pk
+        return queryset.model._meta.get_field(name)
+
+    @staticmethod
+    def value(row, field):
+        if isinstance(row, dict):
+            return row[field]
+        return getattr(row, field)
+
+
+class ProductPagination(PageNumberPagination):
+    """
+    Page-number pagination with an opt-in keyset mode
+
+    ``?page=N`` works as before. Sending ``?pagination=cursor`` (or any
+    ``?cursor=`` token) switches to KeysetPagination, which skips the
+    COUNT and OFFSET so per-page latency stays flat at any depth.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    mode_query_param = 'pagination'
+    keyset_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.use_keyset(request):
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_schema_operation_parameters(self, view):
+        parameters = super().get_schema_operation_parameters(view)
+        parameters.append({
+            'name': self.mode_query_param,
+            'required': False,
+            'in': 'query',
+            'description': 'Set to "cursor" for keyset pagination.',
+            'schema': {'type': 'string', 'enum': ['page', 'cursor']},
+        })
+        return parameters + self.keyset_class().get_schema_operation_parameters(view)
+
+    def use_keyset(self, request):
+        params = request.query_params
+        return (
+            params.get(self.mode_query_param) == 'cursor'
+            or self.keyset_class.cursor_query_param in params
+        )
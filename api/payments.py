@@ -0,0 +1,153 @@
+"""
+Payment gateways
+
+The API talks to the payment provider only through a gateway, picked by
+the ``PAYMENT_GATEWAY`` setting (dotted path, default StripeGateway).
+FakeGateway is a local stand-in for development and tests: it never
+leaves the process and its sessions are paid unless told otherwise.
+
+``parse_event`` verifies a webhook delivery against the
+``STRIPE_WEBHOOK_SECRET`` signing secret and returns the event as a dict.
+"""
+
+import hashlib
+import hmac
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .instrumentation import timed
+
+
+class PaymentError(Exception):
+    pass
+
+
+class StripeGateway:
+    def __init__(self):
+        import stripe
+
+        self.stripe = stripe
+        self.api_key = settings.STRIPE_SECRET_KEY
+
+    def create_checkout_session(self, order_id, amount, email, idempotency_key):
+        """Return ``{'id', 'url', 'expires_at'}`` of a new Checkout session"""
+        try:
+            with timed('external', 'stripe.checkout.session.create'):
+                session = self.stripe.checkout.Session.create(
+                    api_key=self.api_key,
+                    idempotency_key=idempotency_key,
+                    payment_method_types=['card'],
+                    line_items=[{
+                        'price_data': {
+                            'currency': 'usd',
+                            'product_data': {
+                                'name': 'Supa Electronics Store',
+                                'description': 'Best store in town',
+                            },
+                            'unit_amount': int(round(amount * 100)),
+                        },
+                        'quantity': 1,
+                    }],
+                    mode='payment',
+                    metadata={'order_id': str(order_id)},
+                    client_reference_id=str(order_id),
+                    customer_email=email,
+                    success_url=f'{settings.FRONTEND_URL}/orders/{order_id}/success/',
+                    cancel_url=f'{settings.FRONTEND_URL}/orders/{order_id}/cancel/',
+                )
+        except self.stripe.error.StripeError as exc:
+            raise PaymentError(str(exc)) from exc
+        return {'id': session.id, 'url': session.url, 'expires_at': session.expires_at}
+
+    def get_session(self, session_id):
+        """Return ``{'id', 'paid', 'expired', 'order_id'}`` for a Checkout session"""
+        try:
+            with timed('external', 'stripe.checkout.session.retrieve'):
+                session = self.stripe.checkout.Session.retrieve(session_id, api_key=self.api_key)
+        except self.stripe.error.StripeError as exc:
+            raise PaymentError(str(exc)) from exc
+        return {
+            'id': session.id,
+            'paid': session.payment_status == 'paid',
+            'expired': session.status == 'expired',
+            'order_id': (session.metadata or {}).get('order_id'),
+        }
+
+    def parse_event(self, payload, signature):
+        """Verify the ``Stripe-Signature`` of a webhook ``payload`` (bytes)"""
+        try:
+            self.stripe.Webhook.construct_event(payload, signature, settings.STRIPE_WEBHOOK_SECRET)
+        except (ValueError, self.stripe.error.SignatureVerificationError) as exc:
+            raise PaymentError(str(exc)) from exc
+        # Verified: plain dicts are what gets stored
+        return json.loads(payload)
+
+
+class FakeGateway:
+    """
+    In-memory gateway; set ``FakeGateway.paid = False`` to simulate an
+    unpaid session, ``FakeGateway.expired = True`` an expired one
+    """
+    sessions = {}
+    paid = True
+    expired = False
+    fail = False
+
+    def create_checkout_session(self, order_id, amount, email, idempotency_key):
+        if self.fail:
+            raise PaymentError('Fake gateway is failing')
+        for session in self.sessions.values():
+            if session['idempotency_key'] == idempotency_key:
+                return session['public']
+        session_id = f'cs_fake_{uuid.uuid4().hex}'
+        public = {
+            'id': session_id,
+            'url': f'{settings.FRONTEND_URL}/orders/{order_id}/success/?session_id={session_id}',
+            'expires_at': int(time.time()) + 24 * 3600,
+        }
+        self.sessions[session_id] = {
+            'idempotency_key': idempotency_key, 'order_id': str(order_id),
+            'amount': amount, 'public': public,
+        }
+        return public
+
+    def get_session(self, session_id):
+        if session_id not in self.sessions:
+            raise PaymentError(f'No such session: {session_id}')
+        return {
+            'id': session_id,
+            'paid': self.paid,
+            'expired': self.expired,
+            'order_id': self.sessions[session_id]['order_id'],
+        }
+
+    @staticmethod
+    def sign(payload, timestamp=None):
+        """``Stripe-Signature`` header for ``payload``, as Stripe computes it"""
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        secret = getattr(settings, 'STRIPE_WEBHOOK_SECRET', 'whsec_fake').encode()
+        digest = hmac.new(secret, f'{timestamp}.'.encode() + payload, hashlib.sha256).hexdigest()
+        return f't={timestamp},v1={digest}'
+
+    def parse_event(self, payload, signature, tolerance=300):
+        parts = dict(item.split('=', 1) for item in (signature or '').split(',') if '=' in item)
+        try:
+            timestamp = int(parts.get('t', ''))
+        except ValueError:
+            raise PaymentError('Malformed signature header') from None
+        if not hmac.compare_digest(self.sign(payload, timestamp), f"t={timestamp},v1={parts.get('v1', '')}"):
+            raise PaymentError('Signature does not match the payload')
+        if abs(time.time() - timestamp) > tolerance:
+            raise PaymentError('Signature timestamp outside the tolerance zone')
+        try:
+            return json.loads(payload)
+        except ValueError as exc:
+            raise PaymentError(str(exc)) from exc
+
+
+def get_gateway():
+    return import_string(getattr(settings, 'PAYMENT_GATEWAY', 'api.payments.StripeGateway'))()
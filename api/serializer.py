@@ -7,15 +7,62 @@ into Python datatypes that can be easily rendered into JSON.
 
 from rest_framework import serializers
 import uuid
-from storeapp.models import Product, Category, Review, Cart, Cartitems,ProductImage,Profile,Order,OrderItem
-from django.db import transaction
+from storeapp.models import Product, Category, Review, Cart, Cartitems,ProductImage,Profile,Order,OrderItem,OutOfStock,ChangeLog
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, models, transaction
+from . import hotcache
 
 
 
+class ImageSrcsetField(serializers.ReadOnlyField):
+    """
+    Renders ``image_variants`` (storeapp.imaging) as ready-to-use URLs
+
+    ``{"thumbnail": url, "width": w, "height": h,
+       "srcset": {"avif": "url 160w, url 320w", "webp": ..., "jpeg": ...}}``
+    or None until the variants have been generated.
+    """
+    thumbnail_width = 320
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('source', 'image_variants')
+        super().__init__(**kwargs)
+
+    def to_representation(self, variants):
+        return self.build(variants, self.context.get('request'))
+
+    @classmethod
+    def build(cls, variants, request=None):
+        """The representation of ``variants``, outside of a serializer (api.fastpath)"""
+        formats = (variants or {}).get('formats')
+        if not formats:
+            return None
+
+        def url(name):
+            url = default_storage.url(name)
+            return request.build_absolute_uri(url) if request is not None else url
+
+        srcset = {
+            fmt: ', '.join(f'{url(name)} {width}w' for width, name in sorted(
+                sizes.items(), key=lambda item: int(item[0])))
+            for fmt, sizes in formats.items()
+        }
+        fallback = formats.get('jpeg') or next(iter(formats.values()))
+        width = min(fallback, key=lambda w: (int(w) < cls.thumbnail_width, abs(int(w) - cls.thumbnail_width)))
+        return {
+            'thumbnail': url(fallback[width]),
+            'width': variants.get('width'),
+            'height': variants.get('height'),
+            'srcset': srcset,
+        }
+
+
 class ProductImageSerializer(serializers.ModelSerializer):
+    image_srcset = ImageSrcsetField()
+
     class Meta:
         model = ProductImage
-        fields= ["id","product","image"]
+        fields= ["id","product","image","image_srcset"]
 
 
 class ProductSerializer(serializers.ModelSerializer):
@@ -31,18 +78,20 @@ class ProductSerializer(serializers.ModelSerializer):
     - id: Primary key
     - price: Current price
     - inventory: Stock quantity
+    - image_srcset: thumbnail and srcset URLs of the resized image
     
     The category field uses StringRelatedField to display the category name 
     instead of just the ID.
     """
     images = ProductImageSerializer(many=True, read_only=True)
+    image_srcset = ImageSrcsetField()
     uploaded_images = serializers.ListField(
         child=serializers.ImageField(max_length=100000, allow_empty_file=False, use_url=False),
         write_only=True
     )
     class Meta:
         model = Product
-        fields = ['id','name','description','old_price','price','inventory','image','images','uploaded_images']
+        fields = ['id','name','description','old_price','price','inventory','image','image_srcset','images','uploaded_images']
         extra_kwargs = {
             'image': {'read_only': True}
         }
@@ -55,6 +104,31 @@ class ProductSerializer(serializers.ModelSerializer):
         return product
 
 
+class ProductImportRowSerializer(serializers.Serializer):
+    """
+    One row of a bulk product import (api.importer)
+
+    ``slug`` identifies the product: rows whose slug already exists
+    update that product instead of creating a new one. Fields left out
+    of a row keep their current (or default) value. ``category`` is a
+    category title, ``category_slug`` its slug; a missing category is
+    created. ``image``/``images`` are http(s) URLs (or, for the
+    management command, local paths).
+    """
+    slug = serializers.SlugField(max_length=50)
+    name = serializers.CharField(max_length=200)
+    description = serializers.CharField(required=False, allow_blank=True)
+    old_price = serializers.FloatField(required=False, min_value=0)
+    discount = serializers.BooleanField(required=False)
+    inventory = serializers.IntegerField(required=False, min_value=0)
+    top_deal = serializers.BooleanField(required=False)
+    flash_sales = serializers.BooleanField(required=False)
+    category = serializers.CharField(required=False, max_length=200)
+    category_slug = serializers.SlugField(required=False, max_length=50)
+    image = serializers.CharField(required=False, max_length=2000)
+    images = serializers.ListField(child=serializers.CharField(max_length=2000), required=False, max_length=20)
+
+
 class CategorySerializer(serializers.ModelSerializer):
     """
     Serializer for Category model
@@ -103,10 +177,32 @@ class SimpleProductSerializer(serializers.ModelSerializer):
     - id: Product ID
     - price: Current price
     - name: Product name
+    - image_srcset: thumbnail and srcset URLs of the resized image
     """
+    image_srcset = ImageSrcsetField()
+
     class Meta:
         model = Product
-        fields = ['id','price','name','image']
+        fields = ['id','price','name','image','image_srcset']
+
+
+class CachedProductSerializer(SimpleProductSerializer):
+    """SimpleProductSerializer fed from the hot product cache (api.hotcache)"""
+    def get_attribute(self, instance):
+        if hasattr(instance, 'product_record'):
+            return instance.product_record
+        return hotcache.get_product(instance.product_id)
+
+
+class CartItemListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        items = data.all() if isinstance(data, models.manager.BaseManager) else data
+        # One query for every product the hot cache is missing (or all of
+        # them when it is off); the records are kept on the items
+        records = hotcache.get_products({item.product_id for item in items})
+        for item in items:
+            item.product_record = records.get(item.product_id)
+        return super().to_representation(items)
 
 
 class CartItemSerializer(serializers.ModelSerializer):
@@ -116,20 +212,26 @@ class CartItemSerializer(serializers.ModelSerializer):
     Fields:
     - id: Cart item ID
     - cart: Parent cart reference
-    - product: Nested product info (using SimpleProductSerializer)
+    - product: Nested product info (SimpleProductSerializer fields, read
+      from api.hotcache rather than the product row)
     - quantity: Number of units
-    - sub_total: Calculated field (quantity × price)
+    - sub_total: quantity × price, the ``line_total`` annotated in the
+      database (CartitemsQuerySet.with_line_totals) so lines add up to
+      the cart's grand_total even while the hot cache lags
     """
-    product = SimpleProductSerializer(many=False)
+    product = CachedProductSerializer(many=False)
     sub_total = serializers.SerializerMethodField(method_name='total')
     
     class Meta:
         model = Cartitems
         fields = ['id','cart','product','quantity','sub_total']
+        list_serializer_class = CartItemListSerializer
     
     def total(self, cartitem: Cartitems):
-        """Calculate line item total (price × quantity)"""
-        return cartitem.quantity * cartitem.product.price
+        """Line item total (price × quantity)"""
+        if hasattr(cartitem, 'line_total'):
+            return cartitem.line_total
+        return Cartitems.objects.with_line_totals().values_list('line_total', flat=True).get(pk=cartitem.pk)
 
 
 class AddCartItemSerializer(serializers.ModelSerializer):
@@ -137,7 +239,7 @@ class AddCartItemSerializer(serializers.ModelSerializer):
     product_id=serializers.UUIDField()
 
     def validate_product_id(sef,value):
-        if not Product.objects.filter(pk=value).exists():
+        if hotcache.get_product(value) is None:
             raise serializers.ValidationError('no valid product id try again')
         return value
     def validate(self, data):
@@ -150,31 +252,92 @@ class AddCartItemSerializer(serializers.ModelSerializer):
         quantity = self.validated_data['quantity']
 
         # Ensure the cart exists to avoid FK errors
-        cart = Cart.objects.filter(pk=cart_id).first()
-        if not cart:
+        if not Cart.objects.filter(pk=cart_id).exists():
             raise serializers.ValidationError('Invalid cart id. Please create a new cart.')
 
+        # Atomic increment-or-insert, safe against concurrent adds. The hot
+        # cache may still hold a product deleted since validation.
         try:
-            cartitem = Cartitems.objects.get(product_id=product_id, cart_id=cart_id)
-            cartitem.quantity += quantity
-            cartitem.save()
-            self.instance = cartitem
-        except Cartitems.DoesNotExist:
-            # Create using cart instance to satisfy FK constraint
-            self.instance = Cartitems.objects.create(
-                cart=cart,
-                product_id=product_id,
-                quantity=quantity,
-            )
+            self.instance = Cartitems.objects.add_quantity(cart_id, product_id, quantity)
+        except Product.DoesNotExist:
+            raise serializers.ValidationError({'product_id': ['no valid product id try again']})
         return self.instance
     class Meta:
         model = Cartitems
         fields = ['id','product_id','quantity']
+        extra_kwargs = {'quantity': {'max_value': Cartitems.MAX_QUANTITY}}
 
 class UpdatecartitemSerializer(serializers.ModelSerializer):
     class Meta:
         model = Cartitems
         fields = ['quantity']
+        extra_kwargs = {'quantity': {'max_value': Cartitems.MAX_QUANTITY}}
+
+
+class BulkCartItemLineSerializer(serializers.Serializer):
+    product_id = serializers.UUIDField()
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class BulkCartItemSerializer(serializers.Serializer):
+    """
+    Set the quantity of many cart lines in one request
+
+    Lines for the same product are merged. All product ids are validated
+    with one query on the product table (not the hot cache, which may
+    still hold a product another worker deleted), then checked again
+    under a row lock in the transaction that upserts every line with a
+    single bulk_create(update_conflicts=True). A product deleted in
+    between is a 400, not a 500.
+    """
+    MAX_QUANTITY = Cartitems.MAX_QUANTITY
+    items = BulkCartItemLineSerializer(many=True, allow_empty=False)
+
+    def validate_items(self, items):
+        quantities = {}
+        for line in items:
+            quantities[line['product_id']] = quantities.get(line['product_id'], 0) + line['quantity']
+        too_many = [str(pk) for pk, quantity in quantities.items() if quantity > self.MAX_QUANTITY]
+        if too_many:
+            raise serializers.ValidationError(f'Quantity too large for: {", ".join(too_many)}')
+        self.check_products(Product.objects.filter(pk__in=quantities), quantities)
+        return quantities
+
+    @staticmethod
+    def check_products(queryset, product_ids):
+        found = set(queryset.values_list('pk', flat=True))
+        missing = [str(pk) for pk in product_ids if pk not in found]
+        if missing:
+            raise serializers.ValidationError(f'no valid product id try again: {", ".join(missing)}')
+
+    def save(self, **kwargs):
+        cart_id = self.context['cart_id']
+        if not Cart.objects.filter(pk=cart_id).exists():
+            raise serializers.ValidationError('Invalid cart id. Please create a new cart.')
+
+        items = self.validated_data['items']
+        try:
+            with transaction.atomic():
+                # Keeps the products from being deleted until this commits
+                try:
+                    self.check_products(Product.objects.select_for_update().filter(pk__in=items), items)
+                except serializers.ValidationError as exc:
+                    raise serializers.ValidationError({'items': exc.detail})
+                Cartitems.objects.bulk_create(
+                    [
+                        Cartitems(cart_id=cart_id, product_id=product_id, quantity=quantity)
+                        for product_id, quantity in items.items()
+                    ],
+                    update_conflicts=True,
+                    unique_fields=['cart', 'product'],
+                    update_fields=['quantity'],
+                )
+                # bulk_create skips the post_save handler that maintains the totals
+                Cart.objects.filter(pk=cart_id).refresh_totals(touch=True)
+        except IntegrityError:
+            # Where row locks do not exist: deleted before the upsert
+            raise serializers.ValidationError({'items': ['no valid product id try again']})
+        return Cart.objects.with_items().get(pk=cart_id)
 
 
 class CartSerializer(serializers.ModelSerializer):
@@ -185,9 +348,10 @@ class CartSerializer(serializers.ModelSerializer):
     Fields:
     - cart_id: Unique cart identifier
     - items: Nested list of cart items
-    - grand_total: Sum of all item totals
+    - grand_total: Sum of all item totals (denormalized Cart.subtotal)
     
-    Uses prefetch_related in view for optimized queries.
+    Uses prefetch_related in view for optimized queries; products come
+    from api.hotcache.
     """
     cart_id = serializers.UUIDField(read_only=True)
     items = CartItemSerializer(many=True, read_only=True)
@@ -198,10 +362,8 @@ class CartSerializer(serializers.ModelSerializer):
         fields = ['cart_id','items','grand_total'] 
     
     def main_total(self, cart: Cart):
-        """Calculate total value of all items in cart"""
-        items = cart.items.all()
-        total = sum([item.quantity * item.product.price for item in items])
-        return total
+        """Total value of all items in cart, maintained on Cart.subtotal"""
+        return cart.subtotal
 
     def create(self, validated_data):
         # Auto-generate a session_id and attach owner if user is authenticated
@@ -217,15 +379,27 @@ class CartSerializer(serializers.ModelSerializer):
         return Cart.objects.create(session_id=session_id, owner=owner)
 
 class OrderItemSerializer(serializers.ModelSerializer):
-    product = SimpleProductSerializer(read_only=True)
+    """
+    Order line as it was sold
+
+    ``product`` is built from the checkout snapshot (unit_price and
+    product_name) so reading order history never touches Product.
+    """
+    product = serializers.SerializerMethodField()
     sub_total = serializers.SerializerMethodField()
 
     class Meta:
         model = OrderItem
         fields = ["id","product","quantity","sub_total"]
 
+    def get_product(self, obj: OrderItem):
+        return {"id": str(obj.product_id), "price": obj.price, "name": obj.name}
+
     def get_sub_total(self, obj: OrderItem):
-        return obj.quantity * (obj.product.price if obj.product else 0)
+        # Annotated by OrderItem.objects.with_line_totals() in OrderviewSet
+        if hasattr(obj, 'line_total'):
+            return obj.line_total
+        return obj.quantity * obj.price
 
 class orderSerializer(serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
@@ -239,23 +413,58 @@ class orderSerializer(serializers.ModelSerializer):
     def get_total(self, obj: Order):
         return obj.total_price
 
+    def update(self, instance, validated_data):
+        """
+        Status changes go through Order.mark_paid / Order.release
+
+        Only a pending order changes status, so stock reserved at checkout
+        is returned exactly once when an admin fails or cancels it.
+        """
+        status = validated_data.pop('pending_status', instance.pending_status)
+        if status != instance.pending_status:
+            if status == Order.PAYMENT_STATUS_COMPLETE:
+                moved = instance.mark_paid()
+            elif status == Order.PAYMENT_STATUS_PENDING:
+                moved = False
+            else:
+                moved = instance.release(status)
+            if not moved:
+                raise serializers.ValidationError({'pending_status': 'Only a pending order can change status.'})
+        return super().update(instance, validated_data)
+
     def get_status_label(self, obj: Order):
         return obj.get_pending_status_display()
 
 class CreateOrderSerializer(serializers.Serializer):
+    """
+    Turns a cart into an order
+
+    Inventory for every line is reserved in the same transaction; if any
+    line is short the whole checkout fails and lists the short lines.
+    """
     cart_id = serializers.UUIDField()
     def save(self, **kwargs):
         cart_id = self.validated_data['cart_id']
         user_id = self.context['user_id']
 
         with transaction.atomic():
+            cartitems = list(Cartitems.objects.filter(cart_id=cart_id).select_related('product'))
+            quantities = {}
+            for item in cartitems:
+                quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+            try:
+                Product.objects.reserve(quantities)
+            except OutOfStock as exc:
+                raise serializers.ValidationError({'inventory': exc.lines})
+
             order = Order.objects.create(owner_id=user_id)
-            cartitems = Cartitems.objects.filter(cart_id=cart_id)
             orderitems = [
                 OrderItem(
                     order=order,
                     product=item.product,
                     quantity=item.quantity,
+                    unit_price=item.product.price,
+                    product_name=item.product.name,
                 )
                 for item in cartitems
             ]
@@ -270,4 +479,13 @@ class ProfileSarializer(serializers.ModelSerializer):
         fields = ["id","name","bio","image"]
 
 
+class ChangeLogSerializer(serializers.ModelSerializer):
+    """
+    One change feed entry
 
+    ``action`` is 'U' (created or updated) or 'D' (deleted); consumers
+    re-fetch ``model``/``object_id`` to get the current state.
+    """
+    class Meta:
+        model = ChangeLog
+        fields = ["seq","model","object_id","action","created_at"]
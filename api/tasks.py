@@ -0,0 +1,197 @@
+"""
+Background tasks for the order/payment flow (run by storeapp.taskqueue)
+
+1. ``pay`` queues create_checkout_session; the client polls
+   ``GET /api/orders/{id}/payment/`` for the session URL
+2. back from the payment page, ``success_payment`` queues confirm_payment,
+   which asks the gateway whether the session was paid before moving the
+   order from 'P' to 'C'; an expired session moves it to 'F' and returns
+   its reserved stock
+3. a confirmed order queues send_order_confirmation
+
+Stripe webhooks (api.webhooks) confirm orders too, without the client:
+each stored event queues process_stripe_events.
+
+Catalog imports uploaded to ``POST /api/products/import/`` are stored
+and run by import_products_file; the client polls
+``GET /api/products/import/{task id}/`` for the counts.
+"""
+
+import io
+import time
+import uuid
+
+from django.core.files.storage import default_storage
+from django.core.mail import send_mail
+
+from storeapp import taskqueue
+from storeapp.models import Order, Task
+from . import webhooks
+from .importer import import_products
+from .payments import PaymentError, get_gateway
+
+CREATE_CHECKOUT_SESSION = 'orders.create_checkout_session'
+CONFIRM_PAYMENT = 'orders.confirm_payment'
+SEND_ORDER_CONFIRMATION = 'orders.send_order_confirmation'
+PROCESS_STRIPE_EVENTS = 'payments.process_stripe_events'
+IMPORT_PRODUCTS = 'catalog.import_products'
+# Seconds between import heartbeats before another worker may take over
+IMPORT_LEASE = 900
+
+
+def checkout_key(order_id):
+    return f'order:{order_id}:checkout'
+
+
+@taskqueue.task(CREATE_CHECKOUT_SESSION, max_attempts=5)
+def create_checkout_session(order_id, nonce):
+    order = Order.objects.with_totals().select_related('owner').get(pk=order_id)
+    if order.pending_status != Order.PAYMENT_STATUS_PENDING:
+        return {'skipped': 'Order is not pending payment'}
+    # Same key on every retry, so a retried task never opens a second session
+    session = get_gateway().create_checkout_session(
+        order.pk, order.total_price, order.owner.email,
+        idempotency_key=f'checkout-{order.pk}-{nonce}',
+    )
+    Order.objects.filter(pk=order.pk).update(payment_session_id=session['id'])
+    return session
+
+
+@taskqueue.task(CONFIRM_PAYMENT, max_attempts=8)
+def confirm_payment(order_id):
+    order = Order.objects.get(pk=order_id)
+    if order.pending_status != Order.PAYMENT_STATUS_PENDING:
+        return {'status': order.pending_status}
+    if not order.payment_session_id:
+        raise PaymentError('Order has no checkout session yet')
+    session = get_gateway().get_session(order.payment_session_id)
+    if session['paid']:
+        if order.mark_paid():
+            queue_confirmation_email(order.pk)
+        return {'status': Order.PAYMENT_STATUS_COMPLETE}
+    if session['expired']:
+        # The order's current session can no longer be paid: give its stock back
+        order.release(Order.PAYMENT_STATUS_FAILED)
+        return {'status': order.pending_status, 'expired': True}
+    # Some payment methods settle later: retry with backoff
+    raise PaymentError('Checkout session is not paid yet')
+
+
+@taskqueue.task(SEND_ORDER_CONFIRMATION, max_attempts=5)
+def send_order_confirmation(order_id):
+    order = (
+        Order.objects.with_totals().select_related('owner')
+        .prefetch_related('items').get(pk=order_id)
+    )
+    lines = [f'{item.quantity} x {item.name} @ ${item.price:.2f}' for item in order.items.all()]
+    send_mail(
+        f'Your order #{order.pk} is confirmed',
+        '\n'.join(['Thank you for your order!', '', *lines, '', f'Total: ${order.total_price:.2f}']),
+        None,
+        [order.owner.email],
+    )
+    return {'to': order.owner.email}
+
+
+@taskqueue.task(PROCESS_STRIPE_EVENTS, max_attempts=10)
+def process_stripe_events():
+    # Drains every stored event, so the tasks queued by a burst after
+    # the first one mostly find nothing left to do
+    processed, paid = webhooks.process_pending()
+    for order_id in paid:
+        queue_confirmation_email(order_id)
+    return {'events': processed, 'paid': paid}
+
+
+@taskqueue.task(IMPORT_PRODUCTS, max_attempts=3, lease=IMPORT_LEASE)
+def import_products_file(path, fmt):
+    # Batches match on slug under a lock (api.importer), so a retry only
+    # rewrites what changed; the heartbeat after each batch keeps another
+    # worker from claiming the task meanwhile. No process pool here: the
+    # management command is the place for one.
+    taskqueue.heartbeat()
+    try:
+        with default_storage.open(path, 'rb') as upload:
+            stream = io.TextIOWrapper(upload, encoding='utf-8-sig', newline='')
+            result = import_products(stream, fmt, workers=0, on_batch=taskqueue.heartbeat)
+        taskqueue.heartbeat()
+    except taskqueue.LeaseLost:
+        # Another worker owns the task, and the upload, now
+        raise
+    except Exception:
+        if taskqueue.is_last_attempt():
+            default_storage.delete(path)
+        raise
+    default_storage.delete(path)
+    return result.as_dict()
+
+
+def request_checkout(order):
+    """Queue (or reuse) the checkout session task of ``order``"""
+    task = taskqueue.enqueue(
+        CREATE_CHECKOUT_SESSION, {'order_id': order.pk, 'nonce': uuid.uuid4().hex},
+        idempotency_key=checkout_key(order.pk),
+    )
+    expires_at = (task.result or {}).get('expires_at') or 0
+    if task.status == Task.STATUS_DONE and expires_at < time.time():
+        # The previous session expired (or was skipped): open a fresh one
+        taskqueue.requeue(task, payload={'order_id': order.pk, 'nonce': uuid.uuid4().hex})
+    return task
+
+
+def request_confirmation(order):
+    task = taskqueue.enqueue(
+        CONFIRM_PAYMENT, {'order_id': order.pk}, idempotency_key=f'order:{order.pk}:confirm',
+    )
+    if task.status == Task.STATUS_DONE and order.pending_status == Order.PAYMENT_STATUS_PENDING:
+        # Checked an earlier (expired) session: check the current one
+        taskqueue.requeue(task)
+    return task
+
+
+def queue_confirmation_email(order_id):
+    return taskqueue.enqueue(
+        SEND_ORDER_CONFIRMATION, {'order_id': order_id}, idempotency_key=f'order:{order_id}:confirmation-email',
+    )
+
+
+def queue_stripe_event(event_id):
+    return taskqueue.enqueue(PROCESS_STRIPE_EVENTS, idempotency_key=f'stripe-event:{event_id}')
+
+
+def checkout_status(order):
+    """What the client needs to poll the checkout session"""
+    task = Task.objects.filter(idempotency_key=checkout_key(order.pk)).first()
+    status = {
+        'order_status': order.pending_status,
+        'checkout_status': task.get_status_display().lower() if task else None,
+        'session_url': None,
+        'error': None,
+    }
+    if task is not None and task.status == Task.STATUS_DONE:
+        status['session_url'] = (task.result or {}).get('url')
+        status['error'] = (task.result or {}).get('skipped')
+    elif task is not None and task.status == Task.STATUS_FAILED:
+        status['error'] = 'Could not create a checkout session, please try again'
+    return status
+
+
+def queue_import(upload, fmt):
+    """Store an uploaded import file and queue its import"""
+    path = default_storage.save(f'imports/{uuid.uuid4().hex}.{fmt}', upload)
+    return taskqueue.enqueue(IMPORT_PRODUCTS, {'path': path, 'fmt': fmt})
+
+
+def import_status(task):
+    """What the client needs to poll a queued import"""
+    status = {
+        'id': task.pk,
+        'status': task.get_status_display().lower(),
+        'result': None,
+        'error': None,
+    }
+    if task.status == Task.STATUS_DONE:
+        status['result'] = task.result
+    elif task.status == Task.STATUS_FAILED:
+        status['error'] = 'The import failed, please check the file and upload it again'
+    return status
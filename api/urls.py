@@ -1,5 +1,7 @@
 from django.urls import path,include
 from .views import *
+from .async_views import AsyncCategoryView, AsyncProductView, AsyncReviewView
+from .changes import ChangeFeedView
 from rest_framework.routers import DefaultRouter
 from rest_framework_nested import routers
 
@@ -24,7 +26,21 @@ cart_router.register("items",CartIemViewSet,basename="cart-items")
 
 
 
+# ASGI-native read-only variants of the catalog endpoints (api.async_views)
+async_urlpatterns = [
+    path("products/",AsyncProductView.as_view(),name="async-product-list"),
+    path("products/<uuid:pk>/",AsyncProductView.as_view(),name="async-product-detail"),
+    path("categories/",AsyncCategoryView.as_view(),name="async-category-list"),
+    path("categories/<uuid:pk>/",AsyncCategoryView.as_view(),name="async-category-detail"),
+    path("products/<uuid:product_pk>/reviews/",AsyncReviewView.as_view(),name="async-review-list"),
+    path("products/<uuid:product_pk>/reviews/<int:pk>/",AsyncReviewView.as_view(),name="async-review-detail"),
+]
+
+
 urlpatterns = [
+    path("async/",include(async_urlpatterns)),
+    path("stripe/webhook/",StripeWebhookView.as_view(),name="stripe-webhook"),
+    path("changes/",ChangeFeedView.as_view(),name="changes-list"),
     path("",include(router.urls)),
     path("",include(product_router.urls)),
     path("",include(cart_router.urls)),
@@ -1,58 +1,129 @@
 from rest_framework.decorators import action
-from rest_framework.status import HTTP_204_NO_CONTENT, HTTP_201_CREATED, HTTP_400_BAD_REQUEST
+from rest_framework.status import HTTP_204_NO_CONTENT, HTTP_201_CREATED, HTTP_202_ACCEPTED, HTTP_400_BAD_REQUEST
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, DestroyModelMixin
 from django_filters.rest_framework import DjangoFilterBackend
 from .filter import *
 from .serializer import *
 from storeapp.models import *
-from rest_framework.filters import SearchFilter, OrderingFilter
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.filters import OrderingFilter
+from .pagination import ProductPagination
+from .cache import CachedResponseMixin
+from .conditional import ConditionalGetMixin
+from .fastpath import FastListMixin, OrderRows, ProductRows
+from . import export, tasks, webhooks
+from .payments import PaymentError, get_gateway
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, IsAdminUser
-from django.conf import settings
+from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
+from rest_framework.views import APIView
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from rest_framework.exceptions import ValidationError
-import stripe
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
-
-class ProductViewSet(ModelViewSet):
+class ProductViewSet(CachedResponseMixin, ConditionalGetMixin, FastListMixin, ModelViewSet):
     """
     Complete CRUD interface for Products
     
     Features:
     - Filtering: Uses ProductFilter class
-    - Search: By name or description
-    - Ordering: By old_price
-    - Pagination: PageNumberPagination
+    - Search: Full-text over name and description (ProductSearchFilter)
+    - Ordering: By old_price or effective_price (what the customer pays)
+    - Pagination: ProductPagination (?page=N, or keyset mode with
+      ?pagination=cursor for flat per-page latency on deep pages)
     
-    Optimized with select_related to prevent N+1 queries on category.
+    Optimized with prefetch_related to prevent N+1 queries on images.
+    list/retrieve are served from the catalog response cache (api.cache)
+    and answer conditional requests (api.conditional); cache misses of
+    list are built from ``.values()`` rows (api.fastpath).
+
+    Feeds and indexers should use the streaming ``export`` action instead
+    of paging through the list.
     """
-    queryset = Product.objects.all().select_related('category')
+    queryset = Product.objects.all().prefetch_related('images')
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    row_serializer_class = ProductRows
+    cache_control = 'public, max-age=60'
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, OrderingFilter]
     filterset_class = ProductFilter
-    search_fields = ['name', 'description']
-    ordering_fields = ['old_price']
-    pagination_class = PageNumberPagination
+    ordering_fields = ['old_price', 'effective_price']
+    pagination_class = ProductPagination
+
+    @action(detail=False, methods=['GET'], permission_classes=[IsAdminUser])
+    def export(self, request):
+        """
+        Stream the whole catalog (admin only)
+
+        Query params: ``fmt`` (ndjson or csv), ``updated_since``, ``after``
+        (see api.export) and ``gzip=true`` for a gzip-encoded body.
+        """
+        params = request.query_params
+        fmt = params.get('fmt', 'ndjson')
+        gzip = params.get('gzip', '').lower() in ('1', 'true', 'yes')
+        try:
+            since, after = export.parse_position(params.get('updated_since'), params.get('after'))
+            body = export.stream(fmt, since, after, gzip=gzip, build_url=request.build_absolute_uri)
+        except export.ExportError as exc:
+            raise ValidationError({'detail': str(exc)})
+
+        response = StreamingHttpResponse(body, content_type=export.FORMATS[fmt])
+        response['Content-Disposition'] = f'attachment; filename="products.{fmt}"'
+        if gzip:
+            response['Content-Encoding'] = 'gzip'
+        return response
+
+    @action(detail=False, methods=['POST'], url_path='import', permission_classes=[IsAdminUser],
+            parser_classes=[MultiPartParser, FormParser])
+    def bulk_import(self, request):
+        """
+        Queue a bulk create/update of products from an uploaded CSV or NDJSON ``file`` (admin only, 202)
+
+        Rows are matched on slug; see api.importer. Images must be http(s)
+        URLs. The import runs on the task queue (api.tasks); poll
+        ``status_url`` for the counts and the per-row errors.
+        """
+        upload = request.FILES.get('file')
+        if upload is None:
+            raise ValidationError({'file': 'This field is required.'})
+        fmt = request.data.get('fmt') or ('ndjson' if upload.name.endswith(('.ndjson', '.jsonl')) else 'csv')
+        if fmt not in ('csv', 'ndjson'):
+            raise ValidationError({'fmt': 'Must be csv or ndjson.'})
+        task = tasks.queue_import(upload, fmt)
+        status_url = request.build_absolute_uri(f'{request.path}{task.pk}/')
+        return Response({**tasks.import_status(task), 'status_url': status_url},
+                        status=HTTP_202_ACCEPTED, headers={'Location': status_url})
+
+    @action(detail=False, methods=['GET'], url_path=r'import/(?P<task_id>[0-9]+)', url_name='import-status',
+            permission_classes=[IsAdminUser])
+    def import_status(self, request, task_id=None):
+        """Status of a queued import: the counts and per-row errors once it is done"""
+        task = get_object_or_404(Task, pk=task_id, name=tasks.IMPORT_PRODUCTS)
+        return Response(tasks.import_status(task))
 
-class CategoryViewSet(ModelViewSet):
+class CategoryViewSet(CachedResponseMixin, ConditionalGetMixin, ModelViewSet):
     """
     Standard CRUD interface for Categories
+
+    list/retrieve are served from the catalog response cache (api.cache)
+    and answer conditional requests (api.conditional).
     """
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
+    cache_control = 'public, max-age=300'
 
-class ReviewViewSet(ModelViewSet):
+class ReviewViewSet(ConditionalGetMixin, ModelViewSet):
     """
     Review management tied to specific products
     
     The product ID comes from URL parameter (product_pk).
     Automatically sets product context for serializer.
+    list/retrieve answer conditional requests (api.conditional).
     """
     serializer_class = ReviewSerializer
+    cache_control = 'public, max-age=60'
 
     def get_serializer_context(self):
         """Inject product_id from URL into serializer context"""
@@ -68,13 +139,20 @@ class CartViewSet(CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, Gener
     - create: Make new cart
     - retrieve: Get cart details
     
-    Uses prefetch_related to optimize item/product queries.
+    Uses prefetch_related to optimize item queries; the products of the
+    items are served from the hot cache (api.hotcache).
     Cart items are read-only in this interface - manage items separately.
     """
-    queryset = Cart.objects.prefetch_related('items__product')
+    queryset = Cart.objects.with_items()
     serializer_class = CartSerializer
 
 class CartIemViewSet(ModelViewSet):
+    """
+    Items of one cart (carts/<cart_pk>/items/)
+
+    POST items/bulk/ with {"items": [{"product_id", "quantity"}, ...]}
+    sets many lines at once and returns the updated cart.
+    """
     http_method_names = ['get', 'patch', 'delete', 'post']
     
     def get_serializer_class(self):
@@ -88,7 +166,14 @@ class CartIemViewSet(ModelViewSet):
         return {'cart_id': self.kwargs['cart_pk']}
     
     def get_queryset(self):
-        return Cartitems.objects.filter(cart_id=self.kwargs['cart_pk'])
+        return Cartitems.objects.with_line_totals().filter(cart_id=self.kwargs['cart_pk'])
+
+    @action(detail=False, methods=['POST'])
+    def bulk(self, request, cart_pk=None):
+        serializer = BulkCartItemSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        cart = serializer.save()
+        return Response(CartSerializer(cart, context={'request': request}).data)
 
 class ProfileViewSet(ModelViewSet):
     queryset = Profile.objects.all()
@@ -106,8 +191,23 @@ class ProfileViewSet(ModelViewSet):
             headers=headers,
         )
 
-class OrderviewSet(ModelViewSet):
+class OrderviewSet(ConditionalGetMixin, FastListMixin, ModelViewSet):
+    """
+    Orders of the current user (all orders for staff)
+
+    Order totals and line subtotals are annotated in the database from
+    the price snapshot taken at checkout, so a listing runs a constant
+    number of queries without touching Product, and can be filtered and
+    sorted by total (?total_amount__gte=, ?ordering=-total_amount).
+    The list is built from ``.values()`` rows (api.fastpath); list and
+    retrieve answer conditional requests (api.conditional), privately.
+    """
     permission_classes = [IsAuthenticated]
+    row_serializer_class = OrderRows
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filterset_class = OrderFilter
+    ordering_fields = ['placed_at', 'total_amount']
+    ordering = ['-placed_at']
 
     def get_permissions(self):
         if self.action in ['list', 'retrieve']:
@@ -116,48 +216,46 @@ class OrderviewSet(ModelViewSet):
 
     @action(detail=True, methods=['POST'])
     def pay(self, request, pk=None):
+        """
+        Queue creation of the Stripe Checkout session (202)
+
+        The Stripe call runs on the task queue (api.tasks); poll the
+        ``payment`` action until it returns the ``session_url``.
+        """
         order = self.get_object()
         if order.pending_status != 'P':
             raise ValidationError("This order is not pending payment")
+        tasks.request_checkout(order)
+        return Response(tasks.checkout_status(order), status=HTTP_202_ACCEPTED)
 
-        amount = order.total_price
-        email = request.user.email
-        order_id = str(order.id)
+    @action(detail=True, methods=['GET'])
+    def payment(self, request, pk=None):
+        """Checkout session status: ``session_url`` once it is ready"""
+        return Response(tasks.checkout_status(self.get_object()))
 
-        try:
-            session = stripe.checkout.Session.create(
-                payment_method_types=['card'],
-                line_items=[{
-                    'price_data': {
-                        'currency': 'usd',
-                        'product_data': {
-                            'name': 'Supa Electronics Store',
-                            'description': 'Best store in town',
-                        },
-                        'unit_amount': int(amount * 100),
-                    },
-                    'quantity': 1,
-                }],
-                mode='payment',
-                metadata={'order_id': order_id},
-                customer_email=email,
-                success_url=f'{settings.FRONTEND_URL}/orders/{order_id}/success/',
-                cancel_url=f'{settings.FRONTEND_URL}/orders/{order_id}/cancel/',
-            )
-            return Response({'session_url': session.url})
-        except Exception as e:
-            return Response({'error': str(e)}, status=HTTP_400_BAD_REQUEST)
+    @action(detail=True, methods=['POST'])
+    def cancel(self, request, pk=None):
+        """Cancel a pending order and return its reserved inventory"""
+        order = self.get_object()
+        if not order.release(Order.PAYMENT_STATUS_CANCELLED):
+            raise ValidationError("This order is not pending payment")
+        return Response(orderSerializer(order).data)
 
-    @action(detail=True, methods=['GET'])
+    @action(detail=True, methods=['GET', 'POST'])
     def success_payment(self, request, pk=None):
+        """
+        Queue verification of the payment with Stripe (202)
+
+        The order only moves to 'C' once the gateway reports the session
+        as paid; poll the order until ``pending_status`` changes.
+        """
         order = self.get_object()
-        order.pending_status = "C"
-        order.save()
-        serializer = self.get_serializer(order)
+        if order.pending_status == Order.PAYMENT_STATUS_PENDING:
+            tasks.request_confirmation(order)
         return Response({
-            'message': 'Payment successful',
-            'data': serializer.data
-        })
+            'message': 'Payment is being confirmed',
+            'data': orderSerializer(order).data
+        }, status=HTTP_202_ACCEPTED)
 
     def get_serializer_class(self):
         if self.request.method == "POST":
@@ -169,9 +267,15 @@ class OrderviewSet(ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
+        items = OrderItem.objects.with_line_totals()
+        orders = (
+            Order.objects.with_totals()
+            .prefetch_related(Prefetch('items', queryset=items))
+            .order_by('-placed_at')
+        )
         if user.is_staff:
-            return Order.objects.all().order_by('-placed_at')
-        return Order.objects.filter(owner=user).order_by('-placed_at')
+            return orders
+        return orders.filter(owner=user)
 
     def create(self, request, *args, **kwargs):
         input_serializer = CreateOrderSerializer(
@@ -181,4 +285,26 @@ class OrderviewSet(ModelViewSet):
         input_serializer.is_valid(raise_exception=True)
         order = input_serializer.save()
         output = orderSerializer(order)
-        return Response(output.data, status=HTTP_201_CREATED)
\ No newline at end of file
+        return Response(output.data, status=HTTP_201_CREATED)
+
+
+class StripeWebhookView(APIView):
+    """
+    POST /api/stripe/webhook/ -- Stripe event deliveries
+
+    Verifies the ``Stripe-Signature`` header, stores the event once per
+    event id and queues it for api.webhooks; Stripe only needs the 200.
+    Redelivered events are acknowledged without being applied again.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        try:
+            event = get_gateway().parse_event(request.body, request.headers.get('Stripe-Signature'))
+        except PaymentError as exc:
+            return Response({'error': str(exc)}, status=HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            created = webhooks.store_event(event)
+            tasks.queue_stripe_event(event['id'])
+        return Response({'received': True, 'duplicate': not created})
@@ -0,0 +1,122 @@
+"""
+Stripe webhook ingestion
+
+The endpoint only verifies and stores a delivery (``store_event``); order
+state changes happen on the task queue (``process_pending``), in batches:
+
+- ``checkout.session.completed`` (paid) and
+  ``checkout.session.async_payment_succeeded`` move the order P -> C
+- ``checkout.session.expired`` and ``checkout.session.async_payment_failed``
+  move it P -> F and return its stock, but only for the order's current
+  session: an order that opened a new session after an old one expired
+  stays payable
+
+Every transition is a conditional ``UPDATE ... WHERE pending_status='P'``,
+so replays, duplicate deliveries and a racing ``success_payment`` are
+harmless. Other event types are stored and marked ignored.
+"""
+
+import logging
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from storeapp.models import Order, StripeEvent
+
+logger = logging.getLogger(__name__)
+
+PAID = 'paid'
+FAILED = 'failed'
+
+EVENT_ACTIONS = {
+    'checkout.session.completed': PAID,
+    'checkout.session.async_payment_succeeded': PAID,
+    'checkout.session.async_payment_failed': FAILED,
+    'checkout.session.expired': FAILED,
+}
+
+
+def get_batch_size():
+    return getattr(settings, 'STRIPE_WEBHOOK_BATCH_SIZE', 100)
+
+
+def store_event(event):
+    """Store a verified event; False if this event id was already received"""
+    try:
+        with transaction.atomic():
+            StripeEvent.objects.create(event_id=event['id'], type=event['type'], payload=event)
+    except IntegrityError:
+        return False
+    return True
+
+
+def _order_id(session):
+    order_id = (session.get('metadata') or {}).get('order_id') or session.get('client_reference_id')
+    return int(order_id) if str(order_id or '').isdigit() else None
+
+
+def classify(event):
+    """``(action, order_id, session_id)`` for an event, action None if it changes nothing"""
+    session = event.payload.get('data', {}).get('object', {})
+    action = EVENT_ACTIONS.get(event.type)
+    if event.type == 'checkout.session.completed' and session.get('payment_status') == 'unpaid':
+        # Delayed payment methods: wait for async_payment_succeeded/failed
+        action = None
+    return action, _order_id(session), session.get('id')
+
+
+def apply_batch(events):
+    """Apply one batch of events; return the ids of the orders that were paid"""
+    actions = {event.pk: classify(event) for event in events}
+    paid = {order_id for action, order_id, _ in actions.values() if action == PAID and order_id}
+    failed = {
+        (order_id, session_id) for action, order_id, session_id in actions.values()
+        if action == FAILED and order_id and session_id
+    }
+    paid_ids = set(Order.objects.filter(pk__in=paid).mark_paid()) if paid else set()
+    # A session failing never overrides a payment seen in the same batch
+    failed = [(order_id, session_id) for order_id, session_id in failed if order_id not in paid]
+    failed_ids = set()
+    if failed:
+        sessions = reduce(or_, [Q(pk=order_id, payment_session_id=session_id) for order_id, session_id in failed])
+        failed_ids = set(Order.objects.filter(sessions).release(Order.PAYMENT_STATUS_FAILED))
+
+    now = timezone.now()
+    for event in events:
+        action, order_id, _ = actions[event.pk]
+        if action is None:
+            event.outcome = 'ignored'
+        elif order_id in (paid_ids if action == PAID else failed_ids):
+            event.outcome = f'order {order_id} {action}'
+        else:
+            event.outcome = 'no change'
+        event.processed_at = now
+    StripeEvent.objects.bulk_update(events, ['outcome', 'processed_at'])
+    return sorted(paid_ids)
+
+
+def process_pending(batch_size=None):
+    """
+    Apply the unprocessed events, ``batch_size`` at a time, until none are left
+
+    Workers lock their batch with ``SKIP LOCKED``, so several of them can
+    drain a burst side by side. Returns ``(events, paid_order_ids)``.
+    """
+    batch_size = batch_size or get_batch_size()
+    processed, paid = 0, []
+    while True:
+        with transaction.atomic():
+            events = list(
+                StripeEvent.objects.filter(processed_at__isnull=True)
+                .select_for_update(skip_locked=True).order_by('id')[:batch_size]
+            )
+            if not events:
+                break
+            paid += apply_batch(events)
+        processed += len(events)
+        logger.info('Applied %s Stripe event(s)', len(events))
+    return processed, paid
@@ -22,6 +22,8 @@ from django.conf.urls.static import static
 
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 
+from api.instrumentation import metrics_view
+
 
 from rest_framework import permissions
 
@@ -31,6 +33,7 @@ from rest_framework import permissions
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
 
 
       path('api/', include('api.urls')), 
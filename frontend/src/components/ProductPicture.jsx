@@ -0,0 +1,27 @@
+import { mediaUrl } from '../api/client'
+
+// Renders the pre-generated AVIF/WebP/JPEG variants (image_srcset from the
+// API) and falls back to the original upload until they exist.
+export default function ProductPicture({ srcset, image, alt, sizes, className, eager = false }) {
+  const loading = eager ? 'eager' : 'lazy'
+  if (!srcset) {
+    return <img src={mediaUrl(image)} alt={alt} className={className} loading={loading} />
+  }
+  return (
+    <picture>
+      {srcset.srcset.avif && <source type="image/avif" srcSet={srcset.srcset.avif} sizes={sizes} />}
+      {srcset.srcset.webp && <source type="image/webp" srcSet={srcset.srcset.webp} sizes={sizes} />}
+      <img
+        src={srcset.thumbnail}
+        srcSet={srcset.srcset.jpeg}
+        sizes={sizes}
+        width={srcset.width}
+        height={srcset.height}
+        alt={alt}
+        className={className}
+        loading={loading}
+        decoding="async"
+      />
+    </picture>
+  )
+}
@@ -67,14 +67,18 @@ export default function Cart() {
                   }
                   // Create order from cart
                   const { data: order } = await api.post('/api/orders/', { cart_id: cartId })
-                  // Request Stripe checkout session
-                  const { data } = await api.post(`/api/orders/${order.id}/pay/`)
+                  // Queue the Stripe checkout session, then poll until it is ready
+                  let { data } = await api.post(`/api/orders/${order.id}/pay/`)
+                  for (let i = 0; i < 30 && !data?.session_url && !data?.error; i++) {
+                    await new Promise((resolve) => setTimeout(resolve, 1000))
+                    ;({ data } = await api.get(`/api/orders/${order.id}/payment/`))
+                  }
                   if (data?.session_url) {
                     // Backend deletes the cart after creating order, so clear local cart id to prevent 404s
                     clearCartLocal()
                     window.location.href = data.session_url
                   } else {
-                    setCheckoutError('Failed to create checkout session')
+                    setCheckoutError(data?.error || 'Failed to create checkout session')
                   }
                 } catch (e) {
                   setCheckoutError(e?.response?.data?.error || e.message)
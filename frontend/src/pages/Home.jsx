@@ -1,6 +1,7 @@
 import { Link } from 'react-router-dom'
-import { api, mediaUrl } from '../api/client'
+import { api } from '../api/client'
 import { useEffect, useState } from 'react'
+import ProductPicture from '../components/ProductPicture'
 
 export default function Home() {
   const [featured, setFeatured] = useState([])
@@ -66,10 +67,11 @@ export default function Home() {
           <div className="grid grid-cols-1 sm:grid-cols-2 md:grid-cols-3 gap-6">
             {featured.map((p, idx) => {
               const img = p.image || (p.images?.[0]?.image) || ''
+              const srcset = p.image ? p.image_srcset : p.images?.[0]?.image_srcset
               return (
                 <Link to={`/products/${p.id}`} key={p.id} className="block bg-white border rounded overflow-hidden hover:shadow-lg transition-shadow wow animate__animated animate__fadeInUp" style={{ animationDelay: `${idx * 0.05}s` }}>
                   {img ? (
-                    <img src={mediaUrl(img)} alt={p.name} className="w-full h-44 object-cover" />
+                    <ProductPicture srcset={srcset} image={img} alt={p.name} sizes="(min-width: 768px) 33vw, (min-width: 640px) 50vw, 100vw" className="w-full h-44 object-cover" />
                   ) : (
                     <div className="w-full h-44 bg-gray-100 flex items-center justify-center text-gray-400">No image</div>
                   )}
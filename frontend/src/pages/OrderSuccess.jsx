@@ -9,9 +9,23 @@ export default function OrderSuccess() {
 
   useEffect(() => {
     let mounted = true
-    api.get(`/api/orders/${id}/success_payment/`)
-      .then(() => { if (mounted) setMessage('Payment successful. Your order is confirmed!') })
-      .catch((e) => setError(e?.response?.data?.detail || e.message))
+    // Payment is verified with Stripe in the background: poll the order
+    const poll = async () => {
+      await api.post(`/api/orders/${id}/success_payment/`)
+      for (let i = 0; i < 30 && mounted; i++) {
+        const { data: order } = await api.get(`/api/orders/${id}/`)
+        if (order.pending_status === 'C') {
+          if (mounted) setMessage('Payment successful. Your order is confirmed!')
+          return
+        }
+        if (order.pending_status !== 'P') {
+          throw new Error('Payment was not completed')
+        }
+        await new Promise((resolve) => setTimeout(resolve, 2000))
+      }
+      if (mounted) setMessage('Payment received. Your order will be confirmed shortly.')
+    }
+    poll().catch((e) => { if (mounted) setError(e?.response?.data?.detail || e.message) })
     return () => { mounted = false }
   }, [id])
 
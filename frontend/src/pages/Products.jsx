@@ -1,7 +1,8 @@
 import { useEffect, useState } from 'react'
 import { Link } from 'react-router-dom'
-import { api, mediaUrl } from '../api/client'
+import { api } from '../api/client'
 import { useCart } from '../state/CartContext'
+import ProductPicture from '../components/ProductPicture'
 
 export default function Products() {
   const [items, setItems] = useState([])
@@ -27,12 +28,13 @@ export default function Products() {
       <div className="grid grid-cols-1 sm:grid-cols-2 md:grid-cols-3 gap-6">
         {items.map((p) => {
           const img = p.image || (p.images?.[0]?.image) || ''
+          const srcset = p.image ? p.image_srcset : p.images?.[0]?.image_srcset
           const inCart = hasProduct(p.id)
           return (
             <div key={p.id} className="bg-white border rounded shadow-sm overflow-hidden flex flex-col">
               <Link to={`/products/${p.id}`} className="block">
                 {img ? (
-                  <img src={mediaUrl(img)} alt={p.name} className="w-full h-48 object-cover" />
+                  <ProductPicture srcset={srcset} image={img} alt={p.name} sizes="(min-width: 768px) 33vw, (min-width: 640px) 50vw, 100vw" className="w-full h-48 object-cover" />
                 ) : (
                   <div className="w-full h-48 bg-gray-100 flex items-center justify-center text-gray-400">No image</div>
                 )}
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class StoreappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'storeapp'
+
+    def ready(self):
+        from .search import install_search_backend
+        post_migrate.connect(install_search_backend, sender=self)
+        # Registers the image variant task with storeapp.taskqueue
+        from . import imaging, taskqueue
+        taskqueue.task(imaging.GENERATE_VARIANTS, max_attempts=3)(imaging.generate_variants)
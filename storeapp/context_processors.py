@@ -1,13 +1,38 @@
+from django.utils.functional import SimpleLazyObject
+
 from .models import Cart
-import uuid
+
+# Session keys: the anonymous shopper id (Cart.session_id) and the cached cart pk
+SESSION_KEY = 'nonuser'
+CART_ID_KEY = 'cart_id'
+
+
+def get_session_cart(request):
+    """
+    The anonymous cart of this session, without creating one
+
+    Returns an unsaved, empty Cart (``pk`` None) when the session has no
+    cart yet; no query at all unless the session holds a cart id.
+    """
+    session = request.session
+    if CART_ID_KEY not in session and SESSION_KEY in session:
+        # Sessions from before the cart id was cached: look it up once
+        cart_id = Cart.objects.filter(
+            session_id=session[SESSION_KEY], completed=False,
+        ).values_list('pk', flat=True).first()
+        session[CART_ID_KEY] = cart_id and str(cart_id)
+    cart_id = session.get(CART_ID_KEY)
+    if cart_id:
+        cart = Cart.objects.filter(pk=cart_id, completed=False).first()
+        if cart is not None:
+            return cart
+        # Checked out or purged (storeapp.retention)
+        session[CART_ID_KEY] = None
+    return Cart(cart_id=None, session_id=session.get(SESSION_KEY, ''))
+
 
 def cart_renderer(request):
-      try:
-         cart = Cart.objects.get(session_id = request.session['nonuser'], completed=False)
-      except:
-         request.session['nonuser'] = str(uuid.uuid4())
-         cart = Cart.objects.create(session_id = request.session['nonuser'], completed=False)
-         
+      # Resolved only if a template reads ``cart``
       return {
-         'cart': cart
-      }
\ No newline at end of file
+         'cart': SimpleLazyObject(lambda: get_session_cart(request))
+      }
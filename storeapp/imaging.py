@@ -0,0 +1,160 @@
+"""
+Image derivatives for product pictures
+
+Every ``Product.image`` / ``ProductImage.image`` gets resized copies at
+a few fixed widths in AVIF (when Pillow can write it), WebP and JPEG.
+They are generated by a task on storeapp.taskqueue, never on the
+request path, and recorded in the row's ``image_variants``:
+
+    {"source": "img/phone.png", "version": 1, "width": 2400, "height": 1800,
+     "formats": {"webp": {"160": "img/v/3f2a…-160w.webp", ...}, ...}}
+
+Derivative names hash the original bytes and the encoder settings, so a
+URL never changes content and can be cached forever.
+
+The task only becomes visible when the saving transaction commits and
+is retried if a worker dies mid-way, so a job is not lost on restart.
+Its idempotency key names the row and the source file, so saving a row
+again before its variants exist queues nothing new.
+``manage.py generate_image_variants`` sweeps rows that still need
+variants (older rows, or after a VERSION bump).
+
+Storing the variants is a plain UPDATE that bumps the product's
+``updated_at`` and sends ``product_images_changed``: the hot cache
+evicts that product and the change feed records it, but the catalog
+response cache is not dropped, so cached pages pick up the new srcset
+within API_CACHE_TIMEOUT.
+
+Settings:
+- IMAGE_VARIANT_WIDTHS: widths to generate (default 160, 320, 640, 1280)
+"""
+
+import hashlib
+import io
+import logging
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .signals import product_images_changed
+
+logger = logging.getLogger(__name__)
+
+# Bump to regenerate every derivative with new settings
+VERSION = 1
+WIDTHS = (160, 320, 640, 1280)
+QUALITY = {'avif': 50, 'webp': 75, 'jpeg': 80}
+EXTENSIONS = {'avif': 'avif', 'webp': 'webp', 'jpeg': 'jpg'}
+
+GENERATE_VARIANTS = 'images.generate_variants'
+
+
+def output_formats():
+    """Best first; AVIF only when this Pillow build can encode it"""
+    Image.init()
+    formats = ['webp', 'jpeg']
+    if 'AVIF' in Image.SAVE:
+        formats.insert(0, 'avif')
+    return formats
+
+
+def get_widths():
+    return tuple(sorted(getattr(settings, 'IMAGE_VARIANT_WIDTHS', WIDTHS)))
+
+
+def render_variants(name, storage=default_storage):
+    """Create the derivatives of stored image ``name``; return the variants dict"""
+    with storage.open(name, 'rb') as fh:
+        data = fh.read()
+    digest = hashlib.sha1(data).hexdigest()
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        image.load()
+    width, height = image.size
+    has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+
+    formats = {}
+    widths = [w for w in get_widths() if w < width] or [width]
+    for w in widths:
+        resized = image.resize((w, max(1, round(height * w / width))), Image.LANCZOS, reducing_gap=3.0)
+        for fmt in output_formats():
+            key = f'{digest}:{w}:{fmt}:{QUALITY[fmt]}:{VERSION}'
+            target = f'img/v/{hashlib.sha1(key.encode()).hexdigest()[:24]}-{w}w.{EXTENSIONS[fmt]}'
+            if not storage.exists(target):
+                frame = resized
+                if fmt == 'jpeg' or not has_alpha:
+                    frame = resized.convert('RGB')
+                elif frame.mode not in ('RGBA', 'RGB'):
+                    frame = frame.convert('RGBA')
+                buffer = io.BytesIO()
+                frame.save(buffer, fmt.upper(), quality=QUALITY[fmt], optimize=fmt == 'jpeg')
+                target = storage.save(target, ContentFile(buffer.getvalue()))
+            formats.setdefault(fmt, {})[str(w)] = target
+    return {'source': name, 'version': VERSION, 'width': width, 'height': height, 'formats': formats}
+
+
+def needs_variants(instance):
+    name = instance.image.name if instance.image else ''
+    variants = instance.image_variants or {}
+    if not name:
+        return bool(variants)
+    return variants.get('source') != name or variants.get('version') != VERSION
+
+
+def update_variants(model, pk):
+    """Generate and store the variants of one row, if its image is still the same"""
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None or not needs_variants(instance):
+        return
+    name = instance.image.name if instance.image else ''
+    variants = {}
+    if name:
+        try:
+            variants = render_variants(name)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            logger.exception('Could not generate variants for %s', name)
+            return
+    # Guarded by the image name so a newer upload is never overwritten.
+    # _base_manager: ProductQuerySet.update would invalidate the whole catalog
+    same_image = Q(image=name) | Q(image__isnull=True) if not name else Q(image=name)
+    product_field = model._meta.get_field('product') if hasattr(instance, 'product_id') else None
+    fields = {'image_variants': variants}
+    if product_field is None:
+        fields['updated_at'] = timezone.now()
+    if not model._base_manager.filter(same_image, pk=pk).update(**fields):
+        return
+    product_id = instance.pk
+    if product_field is not None:
+        product_id = instance.product_id
+        product_field.related_model._base_manager.filter(pk=product_id).update(updated_at=timezone.now())
+    product_images_changed.send(sender=model, pks=[product_id])
+
+
+def generate_variants(model, pks):
+    """Task ``GENERATE_VARIANTS``: update_variants for each of ``pks``"""
+    model = apps.get_model(model)
+    for pk in pks:
+        update_variants(model, pk)
+    return {'rows': len(pks)}
+
+
+def schedule(model, instances):
+    """Queue variant generation for the ``instances`` that need it; it runs once the transaction commits"""
+    # Imported here: storeapp.models imports this module
+    from . import taskqueue
+
+    label = model._meta.label_lower
+    for instance in instances:
+        if not needs_variants(instance):
+            continue
+        source = hashlib.sha1((instance.image.name if instance.image else '').encode()).hexdigest()[:16]
+        # Product keys are UUIDs: keep the payload JSON
+        taskqueue.enqueue(
+            GENERATE_VARIANTS, {'model': label, 'pks': [str(instance.pk)]},
+            idempotency_key=f'image-variants:{label}:{instance.pk}:{VERSION}:{source}',
+        )
@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from storeapp import imaging
+from storeapp.models import Product, ProductImage
+
+
+def _generate(model, pk):
+    try:
+        imaging.update_variants(model, pk)
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = 'Generate missing or outdated thumbnails/WebP/AVIF variants for product images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        todo = []
+        for model in (Product, ProductImage):
+            rows = model.objects.exclude(image='').exclude(image__isnull=True).only('pk', 'image', 'image_variants')
+            todo += [(model, row.pk) for row in rows.iterator(chunk_size=2000) if imaging.needs_variants(row)]
+        self.stdout.write(f'{len(todo)} image(s) to process')
+
+        with ThreadPoolExecutor(options['workers']) as pool:
+            for done, _ in enumerate(pool.map(lambda job: _generate(*job), todo), 1):
+                if done % 500 == 0:
+                    self.stdout.write(f'{done}/{len(todo)}')
+        self.stdout.write('done')
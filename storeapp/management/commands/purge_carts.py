@@ -0,0 +1,36 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from storeapp import retention
+
+
+class Command(BaseCommand):
+    help = 'Delete empty, completed and abandoned carts in small batches (storeapp.retention)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Carts per transaction')
+        parser.add_argument('--pause', type=float, default=0.05, help='Seconds to sleep between batches')
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be deleted')
+        parser.add_argument('--json', action='store_true', help='Print the metrics as one JSON line')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            counts = retention.count()
+            self.stdout.write(json.dumps({'dry_run': True, 'carts': counts}) if options['json'] else
+                              ', '.join(f'{name}: {n}' for name, n in counts.items()))
+            return
+
+        result = retention.purge_carts(batch_size=options['batch_size'], pause=options['pause'])
+        metrics = {
+            'carts': result.carts, 'carts_deleted': result.total, 'items_deleted': result.items,
+            'batches': result.batches, 'seconds': round(result.seconds, 3),
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(metrics))
+        else:
+            self.stdout.write(
+                f"Deleted {result.total} cart(s) "
+                f"({', '.join(f'{name}: {n}' for name, n in result.carts.items())}) "
+                f"and {result.items} item(s) in {result.batches} batch(es), {result.seconds:.1f}s"
+            )
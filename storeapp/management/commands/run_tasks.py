@@ -0,0 +1,35 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+
+from storeapp import taskqueue
+
+
+class Command(BaseCommand):
+    help = 'Run background tasks from the database queue (storeapp.taskqueue)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the due tasks and exit')
+        parser.add_argument('--batch', type=int, default=10, help='Tasks claimed per round trip')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Idle poll interval in seconds')
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        # Task modules register themselves when their app is ready
+        self.stdout.write(f"Worker ready, tasks: {', '.join(sorted(taskqueue.registry)) or 'none'}")
+        while not self.stopping:
+            done = taskqueue.run_pending(limit=options['batch'], batch=options['batch'])
+            if done:
+                self.stdout.write(f'ran {done} task(s)')
+            if options['once'] and done < options['batch']:
+                break
+            if not done:
+                time.sleep(options['sleep'])
+
+    def stop(self, signum, frame):
+        # Finish the current task, then exit
+        self.stopping = True
@@ -1,8 +1,17 @@
-from django.db import models
+
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Case, ExpressionWrapper, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Concat, Least
+from django.db.models.lookups import Exact
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 import uuid
 
 from  django.conf import settings
 from UserProfile.models import Customer
+from . import imaging
+from .signals import inventory_changed, product_images_changed, products_bulk_changed
 
 # Create your models here.
 
@@ -13,6 +22,8 @@ class Category(models.Model):
     slug = models.SlugField(default= None)
     featured_product = models.OneToOneField('Product', on_delete=models.CASCADE, blank=True, null=True, related_name='featured_product')
     icon = models.CharField(max_length=100, default=None, blank = True, null=True)
+    # Last-Modified / ETag of the category endpoints (api.conditional)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.title
@@ -23,6 +34,7 @@ class Review(models.Model):
     date_created = models.DateTimeField(auto_now_add=True)
     description = models.TextField(default="description")
     name = models.CharField(max_length=50)
+    updated_at = models.DateTimeField(auto_now=True)
     
     def __str__(self):
         return self.description
@@ -30,7 +42,144 @@ class Review(models.Model):
 
 
 
+class OutOfStock(Exception):
+    """Raised by ProductQuerySet.reserve(); ``lines`` describes each shortfall"""
+    def __init__(self, lines):
+        super().__init__(lines)
+        self.lines = lines
+
+
+class ProductQuerySet(models.QuerySet):
+    """
+    Keeps the stored ``effective_price`` and ``search_document`` in sync
+    on bulk writes
+
+    ``update()``, ``bulk_create()`` and ``bulk_update()`` skip
+    ``Product.save()``, so they recompute the columns themselves and
+    refresh the totals of any cart holding a repriced product. Stock-only
+    writes go through ``update_stock()``.
+    """
+    PRICE_FIELDS = {'old_price', 'discount'}
+    SEARCH_FIELDS = {'name', 'description'}
+
+    def update(self, **kwargs):
+        if kwargs.keys() == {'inventory'}:
+            return self.update_stock(kwargs['inventory'], list(self.order_by().values_list('pk', flat=True)))
+        if self.SEARCH_FIELDS & kwargs.keys():
+            kwargs['search_document'] = Product.search_document_expression(
+                name=kwargs.get('name'), description=kwargs.get('description'),
+            )
+        carts = []
+        if self.PRICE_FIELDS & kwargs.keys():
+            carts = list(
+                Cart.objects.filter(items__product__in=self.order_by().values('pk'))
+                .values_list('pk', flat=True).distinct()
+            )
+            kwargs['effective_price'] = Product.price_expression(
+                old_price=kwargs.get('old_price'), discount=kwargs.get('discount'),
+            )
+        kwargs.setdefault('updated_at', timezone.now())
+        with transaction.atomic(using=self.db):
+            # Listeners (the change feed) need to know which rows changed
+            pks = list(self.order_by().values_list('pk', flat=True))
+            rows = super().update(**kwargs)
+        if carts:
+            Cart.objects.filter(pk__in=carts).refresh_totals()
+        products_bulk_changed.send(sender=Product, pks=pks)
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.effective_price = obj.price
+            obj.search_document = obj.build_search_document()
+        created = super().bulk_create(objs, *args, **kwargs)
+        products_bulk_changed.send(sender=Product, pks=[obj.pk for obj in created])
+        return created
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        fields = list(fields)
+        repriced = bool(self.PRICE_FIELDS & set(fields))
+        now = timezone.now()
+        for obj in objs:
+            obj.updated_at = now
+            if repriced:
+                obj.effective_price = obj.price
+            if self.SEARCH_FIELDS & set(fields):
+                obj.search_document = obj.build_search_document()
+        fields += [
+            name for name in [*Product.derived_fields(fields), 'updated_at'] if name not in fields
+        ]
+        rows = super().bulk_update(objs, fields, *args, **kwargs)
+        if repriced:
+            Cart.objects.filter(items__product__in=objs).refresh_totals()
+        products_bulk_changed.send(sender=Product, pks=[obj.pk for obj in objs])
+        return rows
+
+    def update_stock(self, inventory, pks):
+        """
+        Set ``inventory`` on the products ``pks`` of this queryset
+
+        Unlike other updates this refreshes no cart and sends
+        ``inventory_changed`` instead of ``products_bulk_changed``, so
+        checkouts and cancellations do not invalidate the whole catalog.
+        """
+        rows = super(ProductQuerySet, self.filter(pk__in=pks)).update(
+            inventory=inventory, updated_at=timezone.now())
+        inventory_changed.send(sender=Product, pks=list(pks))
+        return rows
+
+    def reserve(self, quantities):
+        """
+        Take ``quantities`` ({product_id: qty}) out of inventory atomically
+
+        A single conditional ``UPDATE ... WHERE inventory >= qty`` covers
+        every line; if any line is short nothing is taken and OutOfStock
+        lists the failing products.
+        """
+        if not quantities:
+            return
+        ids = sorted(quantities, key=str)
+        wanted = self._per_product(quantities)
+        with transaction.atomic():
+            # Lock rows in a deterministic order so checkouts sharing
+            # products cannot deadlock each other
+            list(self.select_for_update().filter(pk__in=ids).order_by('pk').values_list('pk'))
+            rows = self.filter(inventory__gte=wanted).update_stock(F('inventory') - wanted, ids)
+            if rows == len(ids):
+                return
+            transaction.set_rollback(True)
+        lines = [
+            {'product_id': str(pk), 'name': name,
+             'requested': quantities[pk], 'available': inventory}
+            for pk, name, inventory in self.filter(pk__in=ids).order_by('pk')
+            .values_list('pk', 'name', 'inventory')
+            if inventory < quantities[pk]
+        ]
+        raise OutOfStock(lines)
+
+    def release(self, quantities):
+        """Put ``quantities`` ({product_id: qty}) back into inventory"""
+        if not quantities:
+            return
+        self.update_stock(F('inventory') + self._per_product(quantities), list(quantities))
+
+    @staticmethod
+    def _per_product(quantities):
+        return Case(
+            *[When(pk=pk, then=Value(qty)) for pk, qty in quantities.items()],
+            output_field=IntegerField(),
+        )
+
+    def sync_effective_price(self):
+        """Backfill ``effective_price`` from ``old_price``/``discount``"""
+        return self.update(effective_price=Product.price_expression())
+
+
 class Product(models.Model):
+    DISCOUNT_PERCENT = 30
+
     name = models.CharField(max_length=200)
     description = models.TextField(blank=True, null=True)
     discount = models. BooleanField(default=False)
@@ -42,15 +191,103 @@ class Product(models.Model):
     inventory = models.IntegerField(default=5)
     top_deal=models.BooleanField(default=False)
     flash_sales = models.BooleanField(default=False)
+    # Materialized ``price`` so filtering and ordering by what the customer
+    # pays can run in the database. Maintained by save() and ProductQuerySet.
+    effective_price = models.FloatField(default=100.00, editable=False)
+    # Text indexed by the full-text search backend (storeapp.search)
+    search_document = models.TextField(blank=True, default='', editable=False)
+    # Bumped by save() and every ProductQuerySet write; drives the export feed
+    updated_at = models.DateTimeField(auto_now=True)
+    # Resized/re-encoded copies of ``image``, maintained by storeapp.imaging
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination on the API orders by (field, id)
+            models.Index(fields=['old_price', 'id']),
+            models.Index(fields=['effective_price', 'id']),
+            # Incremental exports scan by (updated_at, id)
+            models.Index(fields=['updated_at', 'id']),
+        ]
     
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'effective_price' in field_names:
+            instance._loaded_price = instance.effective_price
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.effective_price = self.price
+        self.search_document = self.build_search_document()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {
+                *update_fields, *self.derived_fields(update_fields), 'updated_at',
+            }
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def derived_fields(fields):
+        """Stored columns that must be rewritten when ``fields`` change"""
+        derived = []
+        if ProductQuerySet.PRICE_FIELDS & set(fields):
+            derived.append('effective_price')
+        if ProductQuerySet.SEARCH_FIELDS & set(fields):
+            derived.append('search_document')
+        return derived
+
+    def build_search_document(self):
+        return f"{self.name} {self.description or ''}"
+
+    @classmethod
+    def search_document_expression(cls, name=None, description=None):
+        """Database expression equivalent of ``build_search_document()``"""
+        name = cls._as_expression(name, F('name'), models.TextField())
+        description = cls._as_expression(description, F('description'), models.TextField())
+        return Concat(name, Value(' '), Coalesce(description, Value('')),
+                      output_field=models.TextField())
+
     @property
     def price(self):
-        if self.discount:
-            new_price = self.old_price - ((30/100)*self.old_price)
+        return self.compute_price(self.old_price, self.discount)
+
+    @classmethod
+    def compute_price(cls, old_price, discount):
+        """``price`` from raw column values (``.values()`` rows, api.fastpath)"""
+        if discount:
+            new_price = old_price - ((cls.DISCOUNT_PERCENT/100)*old_price)
         else:
-            new_price = self.old_price
+            new_price = old_price
         return new_price
+
+    @classmethod
+    def price_expression(cls, prefix='', old_price=None, discount=None):
+        """
+        Database expression equivalent of ``price``
+
+        ``prefix`` reaches the product through a relation (e.g. 'product__');
+        ``old_price``/``discount`` substitute new values during an update.
+        """
+        old_price = cls._as_expression(old_price, F(prefix + 'old_price'), models.FloatField())
+        discount = cls._as_expression(discount, F(prefix + 'discount'), models.BooleanField())
+        return Case(
+            When(Exact(discount, True),
+                 then=old_price - (Value(cls.DISCOUNT_PERCENT/100) * old_price)),
+            default=old_price,
+            output_field=models.FloatField(),
+        )
+
+    @staticmethod
+    def _as_expression(value, default, output_field):
+        if value is None:
+            return default
+        if hasattr(value, 'resolve_expression'):
+            return value
+        return Value(output_field.to_python(value), output_field=output_field)
     
     @property
     def img(self):
@@ -67,35 +304,171 @@ class Product(models.Model):
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, related_name='images', on_delete=models.CASCADE)
     image = models.ImageField(upload_to='img', blank = True, null=True)
+    # Resized/re-encoded copies of ``image``, maintained by storeapp.imaging
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+
+
+class CartQuerySet(models.QuerySet):
+    def with_items(self):
+        """Prefetch the lines with their ``line_total`` (CartitemsQuerySet.with_line_totals)"""
+        return self.prefetch_related(models.Prefetch('items', queryset=Cartitems.objects.with_line_totals()))
+
+    def refresh_totals(self, touch=False):
+        """
+        Recompute item_count and subtotal for these carts in one UPDATE
+
+        ``touch`` also bumps ``updated``: pass it when the shopper changed
+        the cart, not when a price change merely re-totals it, so
+        abandoned carts still age out (storeapp.retention).
+        """
+        items = Cartitems.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+        count = items.annotate(total=Sum('quantity')).values('total')
+        subtotal = items.annotate(total=Sum(Cartitems.line_total_expression())).values('total')
+        fields = {'updated': timezone.now()} if touch else {}
+        return self.update(
+            item_count=Coalesce(Subquery(count), 0),
+            subtotal=Coalesce(Subquery(subtotal), 0.0),
+            **fields,
+        )
 
 
 class Cart(models.Model):
     owner = models.ForeignKey(Customer, on_delete=models.CASCADE, null = True, blank=True)
     cart_id = models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True)
     created = models.DateTimeField(auto_now_add=True)
+    # Last change made by the shopper (refresh_totals(touch=True))
+    updated = models.DateTimeField(auto_now=True)
     completed = models.BooleanField(default=False)
     session_id = models.CharField(max_length=100)
-    
+    # Denormalized aggregates of the cart lines, kept in sync by the
+    # Cartitems/Product signal handlers below so reads never walk the items.
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    subtotal = models.FloatField(default=0, editable=False)
+
+    objects = CartQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Anonymous cart lookups and the retention sweeps (storeapp.retention)
+            models.Index(fields=['session_id']),
+            models.Index(fields=['created']),
+            models.Index(fields=['updated']),
+        ]
 
     @property
     def num_of_items(self):
-        cartitems = self.cartitems_set.all()
-        qtysum = sum([ qty.quantity for qty in cartitems])
-        return qtysum
+        return self.item_count
     
     @property
     def cart_total(self):
-        cartitems = self.cartitems_set.all()
-        qtysum = sum([ qty.subTotal for qty in cartitems])
-        return qtysum
+        return self.subtotal
+
+    def refresh_totals(self):
+        Cart.objects.filter(pk=self.pk).refresh_totals()
+        self.refresh_from_db(fields=['item_count', 'subtotal'])
 
     def __str__(self):
         return str(self.cart_id)
 
+class CartitemsQuerySet(models.QuerySet):
+    def with_line_totals(self):
+        """Annotate ``line_total`` the way ``Cart.subtotal`` adds it up"""
+        return self.annotate(line_total=Cartitems.line_total_expression())
+
+    def add_quantity(self, cart_id, product_id, quantity):
+        """
+        Add ``quantity`` of a product to a cart in one atomic statement
+
+        Uses ``INSERT ... SELECT ... ON CONFLICT (cart, product) DO UPDATE
+        SET quantity = LEAST(quantity + excluded.quantity, MAX_QUANTITY)
+        RETURNING ...`` where the database supports it, so concurrent adds
+        never lose increments or create duplicate lines. Other databases
+        fall back to an ``F()`` increment with a guarded insert. The sum
+        is capped at ``Cartitems.MAX_QUANTITY`` rather than overflowing
+        the column. Raises Product.DoesNotExist instead of inserting a
+        line for a missing product.
+        """
+        connection = connections[self.db]
+        features = connection.features
+        if features.supports_update_conflicts_with_target and features.can_return_columns_from_insert:
+            item = self._upsert_quantity(connection, cart_id, product_id, quantity)
+            if item is not None:
+                # The raw upsert sends no post_save, so keep the cart totals in sync here
+                Cart.objects.filter(pk=cart_id).refresh_totals(touch=True)
+        else:
+            item = self._increment_or_create(cart_id, product_id, quantity)
+        if item is None:
+            raise Product.DoesNotExist(f'No product {product_id}')
+        return item
+
+    def _upsert_quantity(self, connection, cart_id, product_id, quantity):
+        meta = self.model._meta
+        table = connection.ops.quote_name(meta.db_table)
+        cart = meta.get_field('cart')
+        product = meta.get_field('product')
+        columns = [connection.ops.quote_name(name) for name in (cart.column, product.column, 'quantity')]
+        least = 'MIN' if connection.vendor == 'sqlite' else 'LEAST'
+        products = connection.ops.quote_name(Product._meta.db_table)
+        product_pk = connection.ops.quote_name(Product._meta.pk.column)
+        # Selecting the product row inserts nothing when it is gone, rather
+        # than failing on the foreign key at commit
+        sql = (
+            f'INSERT INTO {table} ({", ".join(columns)}) '
+            f'SELECT %s, {products}.{product_pk}, %s FROM {products} WHERE {products}.{product_pk} = %s '
+            f'ON CONFLICT ({columns[0]}, {columns[1]}) DO UPDATE '
+            f'SET {columns[2]} = {least}({table}.{columns[2]} + excluded.{columns[2]}, %s) '
+            f'RETURNING {connection.ops.quote_name(meta.pk.column)}, {columns[2]}'
+        )
+        params = [
+            cart.get_db_prep_value(cart_id, connection),
+            quantity,
+            product.get_db_prep_value(product_id, connection),
+            self.model.MAX_QUANTITY,
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        pk, total = row
+        item = self.model(pk=pk, cart_id=cart_id, product_id=product_id, quantity=total)
+        item._state.adding = False
+        item._state.db = self.db
+        return item
+
+    def _increment_or_create(self, cart_id, product_id, quantity):
+        lines = self.filter(cart_id=cart_id, product_id=product_id)
+        for _ in range(2):
+            if lines.update(quantity=Least(F('quantity') + quantity, self.model.MAX_QUANTITY)):
+                break
+            if not Product.objects.filter(pk=product_id).exists():
+                return None
+            try:
+                with transaction.atomic(using=self.db):
+                    # post_save (refresh_cart_totals) keeps the totals
+                    return self.create(cart_id=cart_id, product_id=product_id, quantity=quantity)
+            except IntegrityError:
+                # Another request inserted the line first; increment it instead
+                continue
+        Cart.objects.filter(pk=cart_id).refresh_totals(touch=True)
+        return lines.get()
+
+
 class Cartitems(models.Model):
+    # Largest PositiveSmallIntegerField value; adds past it are capped
+    MAX_QUANTITY = 32767
+
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, blank=True, null=True,related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE, blank=True, null=True, related_name='cartitems')
     quantity = models.PositiveSmallIntegerField(default=0)
+
+    objects = CartitemsQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # One line per product; lets cart writes upsert instead of read-modify-write
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
     
     
     @property
@@ -104,6 +477,10 @@ class Cartitems(models.Model):
         
         return total
 
+    @staticmethod
+    def line_total_expression():
+        return ExpressionWrapper(F('quantity') * F('product__effective_price'), output_field=models.FloatField())
+
 
 class SavedItem(models.Model):
     owner = models.ForeignKey(Customer, on_delete=models.CASCADE, null = True, blank=True)
@@ -115,6 +492,29 @@ class SavedItem(models.Model):
     def __str__(self):
         return str(self.id)
 
+
+@receiver([post_save, post_delete], sender=Cartitems)
+def refresh_cart_totals(sender, instance, **kwargs):
+    origin = kwargs.get('origin')
+    if isinstance(origin, Cart) or getattr(origin, 'model', None) is Cart:
+        # The whole cart is being deleted, nothing left to keep in sync
+        return
+    if instance.cart_id:
+        Cart.objects.filter(pk=instance.cart_id).refresh_totals(touch=True)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductImage)
+def generate_image_variants(sender, instance, **kwargs):
+    imaging.schedule(sender, [instance])
+
+
+@receiver(post_save, sender=Product)
+def refresh_carts_on_price_change(sender, instance, created, **kwargs):
+    if not created and getattr(instance, '_loaded_price', None) != instance.effective_price:
+        Cart.objects.filter(items__product=instance).refresh_totals()
+    instance._loaded_price = instance.effective_price
+
 class Profile(models.Model):
     name = models.CharField(max_length=50)
     bio = models.TextField()
@@ -123,37 +523,361 @@ class Profile(models.Model):
     def __str__(self):
         return self.name
     
+class OrderQuerySet(models.QuerySet):
+    def with_totals(self):
+        """Annotate ``total_amount`` (sum of line totals) in the database"""
+        lines = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+        total = lines.annotate(total=Sum(OrderItem.line_total_expression())).values('total')
+        return self.annotate(total_amount=Coalesce(Subquery(total), 0.0))
+
+    def _move_pending(self, status):
+        # Lock the pending rows first so the ids we return are exactly the
+        # orders this call moved, however many callers race on them
+        ids = list(
+            self.select_for_update().filter(pending_status=Order.PAYMENT_STATUS_PENDING)
+            .order_by('pk').values_list('pk', flat=True)
+        )
+        if ids:
+            Order.objects.filter(pk__in=ids, pending_status=Order.PAYMENT_STATUS_PENDING).update(
+                pending_status=status, updated_at=timezone.now())
+            ChangeLog.objects.record(Order, ids)
+        return ids
+
+    def mark_paid(self):
+        """Move the pending orders to complete; return the ids that moved"""
+        with transaction.atomic():
+            return self._move_pending(Order.PAYMENT_STATUS_COMPLETE)
+
+    def release(self, status=None):
+        """
+        Move the pending orders to ``status`` and return their stock
+
+        Orders that already left 'P' are skipped, so releasing twice never
+        puts inventory back twice. Returns the ids that moved.
+        """
+        with transaction.atomic():
+            ids = self._move_pending(status or Order.PAYMENT_STATUS_FAILED)
+            quantities = dict(
+                OrderItem.objects.filter(order_id__in=ids).order_by()
+                .values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+            )
+            Product.objects.release(quantities)
+        return ids
+
+
 class Order(models.Model):
     PAYMENT_STATUS_PENDING = 'P'
     PAYMENT_STATUS_COMPLETE = 'C'
     PAYMENT_STATUS_FAILED = 'F'
+    PAYMENT_STATUS_CANCELLED = 'X'
     
     PAYMENT_STATUS_CHOICES = [
         (PAYMENT_STATUS_PENDING, 'Pending'),
         (PAYMENT_STATUS_COMPLETE, 'Complete'),
         (PAYMENT_STATUS_FAILED, 'Failed'),
+        (PAYMENT_STATUS_CANCELLED, 'Cancelled'),
     ]
     placed_at = models.DateTimeField(auto_now_add=True)
     pending_status = models.CharField(
         max_length=50, choices=PAYMENT_STATUS_CHOICES, default=PAYMENT_STATUS_PENDING)
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT)
+    # Bumped by status moves and line changes too (api.conditional)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Stripe Checkout session created for this order (api.tasks)
+    payment_session_id = models.CharField(max_length=255, blank=True, default='', db_index=True)
+
+    objects = OrderQuerySet.as_manager()
     
     def __str__(self):
         return self.pending_status
     
     @property
     def total_price(self):
-      items = self.items.all()
-      total = sum([item.quantity * item.product.price for item in items])
-      return total
+      # Annotated by Order.objects.with_totals(), otherwise one aggregate query
+      if hasattr(self, 'total_amount'):
+          return self.total_amount
+      total = self.items.aggregate(total=Sum(OrderItem.line_total_expression()))['total']
+      return total or 0
+
+    def release(self, status=PAYMENT_STATUS_FAILED):
+        """Move this order to ``status`` if pending and return its stock (OrderQuerySet.release)"""
+        moved = Order.objects.filter(pk=self.pk).release(status)
+        if moved:
+            self.pending_status = status
+        return bool(moved)
+
+    def mark_paid(self):
+        """Move this order to complete; False if it already left 'P'"""
+        moved = Order.objects.filter(pk=self.pk).mark_paid()
+        if moved:
+            self.pending_status = self.PAYMENT_STATUS_COMPLETE
+        return bool(moved)
+
 
 
+class OrderItemQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        created = super().bulk_create(objs, *args, **kwargs)
+        # bulk_create skips post_save, which feeds the change log
+        ChangeLog.objects.record(OrderItem, [obj.pk for obj in created if obj.pk is not None])
+        ChangeLog.objects.record(Order, {obj.order_id for obj in created})
+        return created
+
+    def with_line_totals(self):
+        """Annotate ``line_total`` (quantity x unit price) in the database"""
+        return self.annotate(line_total=OrderItem.line_total_expression())
+
+    def backfill_snapshots(self):
+        """Snapshot today's product price/name onto lines created before snapshots"""
+        product = Product.objects.filter(pk=OuterRef('product'))
+        return self.filter(unit_price__isnull=True).update(
+            unit_price=Subquery(product.values('effective_price')),
+            product_name=Subquery(product.values('name')),
+        )
+
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.PROTECT, related_name = "items")
     product = models.ForeignKey(Product, on_delete=models.PROTECT)
     quantity = models.PositiveSmallIntegerField()
+    # Snapshot of the product taken at checkout so order history never
+    # re-reads Product. Null only on lines created before snapshots existed.
+    unit_price = models.FloatField(null=True, blank=True)
+    product_name = models.CharField(max_length=200, blank=True, default='')
+
+    objects = OrderItemQuerySet.as_manager()
+
+    @property
+    def price(self):
+        if self.unit_price is not None:
+            return self.unit_price
+        return self.product.price
+
+    @property
+    def name(self):
+        return self.product_name or self.product.name
+
+    @staticmethod
+    def line_total_expression():
+        # Product is only consulted for lines without a snapshot
+        price = Coalesce(
+            F('unit_price'),
+            Subquery(Product.objects.filter(pk=OuterRef('product')).values('effective_price')),
+        )
+        return ExpressionWrapper(F('quantity') * price, output_field=models.FloatField())
     
 
     def __str__(self):
-        return self.product.name
\ No newline at end of file
+        return self.name
+
+
+class Task(models.Model):
+    """
+    A unit of background work for storeapp.taskqueue
+
+    ``idempotency_key`` makes enqueueing the same job twice return the
+    existing row. ``locked_until`` is the lease of the worker running it;
+    a task whose lease ran out (crashed worker) is picked up again.
+    """
+    STATUS_QUEUED = 'Q'
+    STATUS_RUNNING = 'R'
+    STATUS_DONE = 'D'
+    STATUS_FAILED = 'F'
+
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Workers poll for due tasks in this order
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+    def __str__(self):
+        return f'{self.name} [{self.get_status_display()}]'
+
+
+class StripeEvent(models.Model):
+    """
+    A Stripe webhook event, stored once per Stripe event id
+
+    Stripe delivers at least once and may replay; the unique ``event_id``
+    turns duplicates into no-ops. Rows without ``processed_at`` are
+    applied in batches by api.webhooks.
+    """
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    outcome = models.CharField(max_length=100, blank=True, default='')
+
+    class Meta:
+        indexes = [
+            # Only the backlog of unprocessed events is ever scanned
+            models.Index(fields=['id'], condition=models.Q(processed_at__isnull=True),
+                         name='stripeevent_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.event_id} {self.type}'
+
+
+class ChangeLogQuerySet(models.QuerySet):
+    def record(self, model, pks, action='U'):
+        """Append one entry per primary key in ``pks``"""
+        label = model._meta.model_name
+        return self.bulk_create(
+            [ChangeLog(model=label, object_id=str(pk), action=action) for pk in pks],
+            batch_size=500,
+        )
+
+    def read(self, since, limit, gaps=None, horizon=None):
+        """
+        Up to ``limit`` entries after ``since``, plus those filling ``gaps``
+
+        Sequence numbers are allocated before commit, so a lower ``seq``
+        can become visible after a higher one. Reading does not wait for
+        it: each missing ``seq`` below the last entry read becomes a gap,
+        ``{seq: mark}``, that the caller passes back on the next read. A
+        gap is handed out once its entry commits, and dropped once every
+        transaction that was running when it was seen has finished
+        (``transaction_horizon()``): by then it was rolled back.
+
+        Returns ``(entries, since, gaps)``, the entries in ``seq`` order and
+        the position for the next read.
+        """
+        gaps = dict(gaps or {})
+        entries = list(self.filter(seq__gt=since).order_by('seq')[:limit])
+        # Taken after the read: whatever allocated a gap below it had started
+        now, done_before = horizon or self.transaction_horizon()
+        # From 0 the feed starts at the oldest entry, whatever came before
+        expected = since + 1 if since else None
+        for entry in entries:
+            gaps.update(dict.fromkeys(range(expected or entry.seq, entry.seq), now))
+            expected = entry.seq + 1
+        filled = list(self.filter(seq__in=gaps).order_by('seq')) if gaps else []
+        for entry in filled:
+            del gaps[entry.seq]
+        gaps = {seq: mark for seq, mark in gaps.items() if mark > done_before}
+        since = entries[-1].seq if entries else since
+        return sorted(filled + entries, key=lambda entry: entry.seq), since, gaps
+
+    def transaction_horizon(self):
+        """
+        ``(now, done_before)``: a gap marked ``now`` is final once a later
+        ``done_before`` reaches it
+
+        - PostgreSQL: transaction ids; ``done_before`` is the oldest one
+          still running
+        - SQLite: writers are serialized, so a gap is final when seen
+        - elsewhere: wall clock, CHANGE_FEED_SETTLE_SECONDS (default 5)
+          after the gap was seen
+        """
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT txid_snapshot_xmax(snapshot), txid_snapshot_xmin(snapshot) '
+                    'FROM txid_current_snapshot() AS snapshot'
+                )
+                return cursor.fetchone()
+        if connection.vendor == 'sqlite':
+            return 0, 0
+        now = timezone.now().timestamp()
+        return now, now - getattr(settings, 'CHANGE_FEED_SETTLE_SECONDS', 5)
+
+
+class ChangeLog(models.Model):
+    """
+    Append-only, ordered log of catalog and order changes
+
+    Written by the receivers below (and by the bulk paths that skip
+    post_save), read through ``/api/changes/?since=<seq>``. Consumers
+    re-fetch the object for every entry, so an entry only says *what*
+    changed, never how. Stock moves (``inventory_changed``) are not
+    logged: every order makes them, and the export's ``updated_since``
+    already picks them up.
+    """
+    ACTION_UPSERT = 'U'
+    ACTION_DELETE = 'D'
+
+    ACTION_CHOICES = [
+        (ACTION_UPSERT, 'Upsert'),
+        (ACTION_DELETE, 'Delete'),
+    ]
+    seq = models.BigAutoField(primary_key=True)
+    model = models.CharField(max_length=50)
+    object_id = models.CharField(max_length=64)
+    action = models.CharField(max_length=1, choices=ACTION_CHOICES, default=ACTION_UPSERT)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ChangeLogQuerySet.as_manager()
+
+    def __str__(self):
+        return f'{self.seq} {self.action} {self.model}:{self.object_id}'
+
+
+# Children also touch their parent so consumers can follow just products
+# and orders
+CHANGE_FEED_PARENTS = {
+    Product: None,
+    Category: None,
+    ProductImage: ('product_id', Product),
+    Order: None,
+    OrderItem: ('order_id', Order),
+}
+
+
+def log_change(sender, instance, **kwargs):
+    deleted = kwargs['signal'] is post_delete
+    action = ChangeLog.ACTION_DELETE if deleted else ChangeLog.ACTION_UPSERT
+    ChangeLog.objects.record(sender, [instance.pk], action)
+    parent = CHANGE_FEED_PARENTS[sender]
+    if parent is not None and getattr(instance, parent[0]) is not None:
+        ChangeLog.objects.record(parent[1], [getattr(instance, parent[0])])
+
+
+@receiver(products_bulk_changed)
+@receiver(product_images_changed)
+def log_bulk_product_change(sender, pks, **kwargs):
+    ChangeLog.objects.record(Product, pks)
+
+
+for model in CHANGE_FEED_PARENTS:
+    post_save.connect(log_change, sender=model, dispatch_uid=f'changelog-save-{model.__name__}')
+    post_delete.connect(log_change, sender=model, dispatch_uid=f'changelog-delete-{model.__name__}')
+
+
+def touch_parent(sender, instance, **kwargs):
+    """Images and order lines are part of their parent's representation (api.conditional)"""
+    field, parent = CHANGE_FEED_PARENTS[sender]
+    if getattr(instance, field) is not None:
+        # _base_manager: a plain update, the change feed already has the parent
+        parent._base_manager.filter(pk=getattr(instance, field)).update(updated_at=timezone.now())
+
+
+@receiver(products_bulk_changed, sender=ProductImage)
+def touch_products_of_images(sender, pks, **kwargs):
+    Product._base_manager.filter(pk__in=pks).update(updated_at=timezone.now())
+
+
+for model in (ProductImage, OrderItem):
+    post_save.connect(touch_parent, sender=model, dispatch_uid=f'touch-parent-save-{model.__name__}')
+    post_delete.connect(touch_parent, sender=model, dispatch_uid=f'touch-parent-delete-{model.__name__}')
@@ -0,0 +1,102 @@
+"""
+Cart retention: delete carts that will never become orders
+
+Every anonymous visitor gets a Cart row and only checked out carts are
+deleted, so ``purge_carts`` (``python manage.py purge_carts``, run it
+from cron) sweeps, oldest first:
+
+- empty: no items and untouched for CART_EMPTY_TTL_HOURS (default 24)
+- completed: flagged completed and older than CART_EMPTY_TTL_HOURS
+- abandoned: not changed by the shopper for CART_ABANDONED_TTL_DAYS
+  (default 30), items and all
+
+Each batch (CART_PURGE_BATCH_SIZE, default 500) is its own short
+transaction: the candidate carts are locked and re-checked, so a cart
+that just got an item survives, then their items and the carts go in two
+plain DELETEs without loading rows or sending signals.
+"""
+
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Cart, Cartitems
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PurgeResult:
+    carts: dict = field(default_factory=dict)
+    items: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+
+    @property
+    def total(self):
+        return sum(self.carts.values())
+
+
+def get_rules(now=None):
+    """``{name: (condition, ordering field)}`` of the carts to delete"""
+    now = now or timezone.now()
+    empty_cutoff = now - timedelta(hours=getattr(settings, 'CART_EMPTY_TTL_HOURS', 24))
+    abandoned_cutoff = now - timedelta(days=getattr(settings, 'CART_ABANDONED_TTL_DAYS', 30))
+    # Each rule leads with an indexed range so a sweep is an index scan
+    return {
+        'empty': (Q(created__lt=empty_cutoff, updated__lt=empty_cutoff, item_count=0), 'created'),
+        'completed': (Q(created__lt=empty_cutoff, completed=True), 'created'),
+        'abandoned': (Q(updated__lt=abandoned_cutoff), 'updated'),
+    }
+
+
+def delete_batch(condition, ordering, batch_size):
+    """Delete up to ``batch_size`` carts matching ``condition``; return (carts, items)"""
+    with transaction.atomic():
+        ids = list(
+            Cart.objects.filter(condition).select_for_update(skip_locked=True)
+            .order_by(ordering).values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return 0, 0
+        # _raw_delete: one DELETE each, no row loading, no Cartitems signals
+        items = Cartitems.objects.filter(cart_id__in=ids)._raw_delete(Cartitems.objects.db)
+        carts = Cart.objects.filter(pk__in=ids)._raw_delete(Cart.objects.db)
+    return carts, items
+
+
+def count(now=None):
+    return {name: Cart.objects.filter(condition).count() for name, (condition, _) in get_rules(now).items()}
+
+
+def purge_carts(batch_size=None, pause=0, now=None):
+    """Run every rule until it matches nothing; returns a PurgeResult"""
+    batch_size = batch_size or getattr(settings, 'CART_PURGE_BATCH_SIZE', 500)
+    result = PurgeResult()
+    started = time.monotonic()
+    for name, (condition, ordering) in get_rules(now).items():
+        result.carts[name] = 0
+        while True:
+            carts, items = delete_batch(condition, ordering, batch_size)
+            if not carts:
+                break
+            result.carts[name] += carts
+            result.items += items
+            result.batches += 1
+            if carts < batch_size:
+                break
+            # Lets replication and other writers catch up between batches
+            time.sleep(pause)
+    result.seconds = time.monotonic() - started
+    logger.info(
+        'Purged %s cart(s) (%s) and %s item(s) in %s batch(es), %.1fs',
+        result.total, ', '.join(f'{name}={n}' for name, n in result.carts.items()),
+        result.items, result.batches, result.seconds,
+    )
+    return result
@@ -0,0 +1,176 @@
+"""
+Full-text search backends for products
+
+Every backend searches ``Product.search_document`` (name + description,
+maintained on save and by ProductQuerySet) and annotates matches with
+``search_rank`` so results come back most relevant first.
+
+- PostgresSearchBackend: ``tsvector`` match backed by a GIN expression index
+- SQLiteSearchBackend: FTS5 external-content table kept in sync by triggers
+- ContainsSearchBackend: portable ``icontains`` fallback
+
+The backend is picked from the database vendor, or forced with the
+``PRODUCT_SEARCH_BACKEND`` setting (dotted path to a backend class).
+Database objects are created by ``install()`` on ``post_migrate``.
+"""
+
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.db.models import FloatField, Value
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Product
+
+TERM_RE = re.compile(r'\w+')
+MAX_TERMS = 8
+
+
+def search_terms(query):
+    """Split user input into safe, lowercase prefix terms"""
+    return TERM_RE.findall(query.lower())[:MAX_TERMS]
+
+
+class BaseSearchBackend:
+    def install(self, connection):
+        """Create the indexes or tables this backend needs"""
+
+    def search(self, queryset, query):
+        raise NotImplementedError
+
+
+class ContainsSearchBackend(BaseSearchBackend):
+    """Every term must appear somewhere in the search document"""
+
+    def search(self, queryset, query):
+        for term in search_terms(query):
+            queryset = queryset.filter(search_document__icontains=term)
+        return queryset.annotate(search_rank=Value(1.0, output_field=FloatField()))
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    config = 'english'
+    index_name = 'storeapp_product_search_gin'
+
+    def install(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.index_name} '
+                f'ON {Product._meta.db_table} USING GIN '
+                f"(to_tsvector('{self.config}'::regconfig, COALESCE(search_document, '')))"
+            )
+
+    def search(self, queryset, query):
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+
+        terms = search_terms(query)
+        if not terms:
+            return queryset
+        # Must match the index expression above for the GIN index to be used
+        vector = SearchVector('search_document', config=self.config)
+        tsquery = SearchQuery(
+            ' & '.join(f'{term}:*' for term in terms),
+            config=self.config, search_type='raw',
+        )
+        return (
+            queryset.alias(search_vector=vector)
+            .filter(search_vector=tsquery)
+            .annotate(search_rank=SearchRank(vector, tsquery))
+            .order_by('-search_rank')
+        )
+
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    table = 'storeapp_product_fts'
+
+    def install(self, connection):
+        product = Product._meta.db_table
+        fts = self.table
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute(
+                    f'CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5('
+                    f"search_document, content='{product}', content_rowid='rowid', "
+                    f"tokenize='unicode61 remove_diacritics 2')"
+                )
+            except OperationalError:
+                # SQLite built without FTS5: searches fall back to icontains
+                return
+            cursor.execute(
+                f'CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {product} BEGIN '
+                f'INSERT INTO {fts}(rowid, search_document) VALUES (new.rowid, new.search_document); '
+                f'END'
+            )
+            cursor.execute(
+                f'CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {product} BEGIN '
+                f"INSERT INTO {fts}({fts}, rowid, search_document) "
+                f"VALUES ('delete', old.rowid, old.search_document); "
+                f'END'
+            )
+            cursor.execute(
+                f'CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF search_document ON {product} BEGIN '
+                f"INSERT INTO {fts}({fts}, rowid, search_document) "
+                f"VALUES ('delete', old.rowid, old.search_document); "
+                f'INSERT INTO {fts}(rowid, search_document) VALUES (new.rowid, new.search_document); '
+                f'END'
+            )
+            # Table rebuilds during migrations renumber rowids and drop the
+            # triggers, so resync the index every time.
+            cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+    def search(self, queryset, query):
+        terms = search_terms(query)
+        if not terms:
+            return queryset
+        product = Product._meta.db_table
+        fts = self.table
+        match = ' '.join(f'"{term}"*' for term in terms)
+        return (
+            queryset.alias(search_rowid=RawSQL(f'{product}.rowid', ()))
+            .filter(search_rowid__in=RawSQL(
+                f'SELECT rowid FROM {fts} WHERE {fts} MATCH %s', (match,)
+            ))
+            .annotate(search_rank=RawSQL(
+                f'SELECT -bm25({fts}) FROM {fts} '
+                f'WHERE {fts} MATCH %s AND {fts}.rowid = {product}.rowid',
+                (match,), output_field=FloatField(),
+            ))
+            .order_by('-search_rank')
+        )
+
+
+@lru_cache(maxsize=None)
+def _fts5_installed(alias, name):
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s",
+                (SQLiteSearchBackend.table,),
+            )
+            return cursor.fetchone() is not None
+    except OperationalError:
+        return False
+
+
+def get_search_backend(using=DEFAULT_DB_ALIAS, installing=False):
+    path = getattr(settings, 'PRODUCT_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    if connection.vendor == 'sqlite' and (
+        installing or _fts5_installed(using, connection.settings_dict['NAME'])
+    ):
+        return SQLiteSearchBackend()
+    return ContainsSearchBackend()
+
+
+def install_search_backend(using=DEFAULT_DB_ALIAS, **kwargs):
+    """post_migrate hook: create the backend's indexes/tables"""
+    get_search_backend(using, installing=True).install(connections[using])
+    _fts5_installed.cache_clear()
@@ -0,0 +1,16 @@
+from django.dispatch import Signal
+
+# Sent by ProductQuerySet after update(), bulk_create() and bulk_update(),
+# which bypass post_save. ``pks`` lists the affected products. Sent with
+# ``sender=ProductImage`` when only their images changed.
+products_bulk_changed = Signal()
+
+# Sent by ProductQuerySet.update_stock() when only ``inventory`` changed.
+# Stock moves with every order, so this is not a catalog change: caches
+# evict just ``pks`` instead of everything.
+inventory_changed = Signal()
+
+# Sent by storeapp.imaging after storing new image variants of the
+# products ``pks``. Like ``inventory_changed`` this is not a catalog
+# change: caches evict just ``pks``.
+product_images_changed = Signal()
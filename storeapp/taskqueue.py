@@ -0,0 +1,232 @@
+"""
+Lightweight database-backed task queue
+
+Slow side effects (payment provider calls, emails) run here instead of
+inside a request worker:
+
+    @taskqueue.task('orders.send_email', max_attempts=3)
+    def send_email(order_id):
+        ...
+
+    taskqueue.enqueue('orders.send_email', {'order_id': 1},
+                      idempotency_key='order-email:1')
+
+- Tasks are rows of ``storeapp.models.Task`` and only become visible
+  to workers when the enqueuing transaction commits.
+- ``python manage.py run_tasks`` claims due tasks (``SKIP LOCKED`` where
+  the database supports it, a conditional UPDATE either way) under a
+  lease, runs them and records the result.
+- A failing task is retried with exponential backoff plus jitter until
+  ``max_attempts``; it then stays FAILED with the error for inspection.
+- Task functions must be idempotent: a task can run again after a worker
+  dies mid-way. Pass ``idempotency_key`` on to external APIs.
+- A task that can outlive the lease passes ``lease=`` (seconds) and
+  calls ``heartbeat()`` as it makes progress: that extends the lease, or
+  raises LeaseLost once another worker may have claimed the task.
+
+Settings:
+- TASK_QUEUE_EAGER: run tasks in-process right after commit (dev/tests)
+- TASK_QUEUE_LEASE_SECONDS: how long a claim lasts (default 300)
+"""
+
+import contextvars
+import logging
+import random
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+BACKOFF_BASE = 5
+BACKOFF_MAX = 3600
+
+# The Task row being executed in this thread, for heartbeat()
+current = contextvars.ContextVar('taskqueue_current', default=None)
+
+
+class TaskNotRegistered(KeyError):
+    pass
+
+
+class LeaseLost(Exception):
+    """The running task's lease ran out and another worker may have claimed it"""
+
+
+def task(name, max_attempts=5, lease=None):
+    """Register a function as task ``name``; payload keys become its kwargs"""
+    def decorator(func):
+        func.task_name = name
+        func.max_attempts = max_attempts
+        func.lease = lease
+        registry[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, payload=None, idempotency_key=None, delay=0):
+    """
+    Queue task ``name`` and return its Task row
+
+    With an ``idempotency_key`` an existing task is returned as is,
+    unless it FAILED, in which case it is queued again from scratch.
+    """
+    if name not in registry:
+        raise TaskNotRegistered(name)
+    func = registry[name]
+    run_after = timezone.now() + timedelta(seconds=delay)
+    fields = {
+        'name': name,
+        'payload': payload or {},
+        'max_attempts': func.max_attempts,
+        'run_after': run_after,
+    }
+    if idempotency_key is None:
+        instance = Task.objects.create(**fields)
+    else:
+        try:
+            with transaction.atomic():
+                instance, created = Task.objects.get_or_create(idempotency_key=idempotency_key, defaults=fields)
+        except IntegrityError:
+            # Lost a race with a concurrent enqueue of the same key
+            instance, created = Task.objects.get(idempotency_key=idempotency_key), False
+        if not created and instance.status == Task.STATUS_FAILED:
+            requeue(instance, payload=fields['payload'], run_after=run_after)
+            return instance
+    run_eagerly(instance)
+    return instance
+
+
+def requeue(instance, payload=None, run_after=None):
+    instance.status = Task.STATUS_QUEUED
+    instance.attempts = 0
+    instance.run_after = run_after or timezone.now()
+    instance.locked_until = None
+    instance.last_error = ''
+    instance.result = None
+    if payload is not None:
+        instance.payload = payload
+    instance.save()
+    run_eagerly(instance)
+
+
+def run_eagerly(instance):
+    if getattr(settings, 'TASK_QUEUE_EAGER', False):
+        transaction.on_commit(lambda: run_pending(ids=[instance.pk]))
+
+
+def backoff(attempts):
+    """Seconds to wait before attempt ``attempts + 1``"""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def get_lease(name=None):
+    seconds = getattr(registry.get(name), 'lease', None)
+    return timedelta(seconds=seconds or getattr(settings, 'TASK_QUEUE_LEASE_SECONDS', 300))
+
+
+def heartbeat():
+    """Extend the lease of the running task; raise LeaseLost if it is no longer ours"""
+    instance = current.get()
+    if instance is None:
+        return
+    now = timezone.now()
+    locked_until = now + get_lease(instance.name)
+    extended = Task.objects.filter(
+        pk=instance.pk, status=Task.STATUS_RUNNING, attempts=instance.attempts,
+    ).update(locked_until=locked_until, updated_at=now)
+    if not extended:
+        raise LeaseLost(instance.pk)
+    instance.locked_until = locked_until
+
+
+def is_last_attempt():
+    """Whether a failure of the running task is final"""
+    instance = current.get()
+    return instance is None or instance.attempts >= instance.max_attempts
+
+
+def due_tasks(now):
+    return Task.objects.filter(
+        Q(status=Task.STATUS_QUEUED, run_after__lte=now)
+        | Q(status=Task.STATUS_RUNNING, locked_until__lt=now)
+    )
+
+
+def claim(limit=10, ids=None):
+    """Lease up to ``limit`` due tasks to this worker and return them"""
+    now = timezone.now()
+    candidates = due_tasks(now)
+    if ids is not None:
+        candidates = candidates.filter(pk__in=ids)
+    claimed = []
+    with transaction.atomic():
+        rows = list(
+            candidates.select_for_update(skip_locked=True)
+            .order_by('run_after', 'id')
+            .values_list('pk', 'name', 'status', 'attempts')[:limit]
+        )
+        for pk, name, status, attempts in rows:
+            # Conditional on what we read, so two workers never claim the same row
+            won = Task.objects.filter(pk=pk, status=status, attempts=attempts).update(
+                status=Task.STATUS_RUNNING,
+                attempts=attempts + 1,
+                locked_until=now + get_lease(name),
+                updated_at=now,
+            )
+            if won:
+                claimed.append(pk)
+    return list(Task.objects.filter(pk__in=claimed).order_by('run_after', 'id'))
+
+
+def execute(instance):
+    """Run one claimed task and record the outcome"""
+    func = registry.get(instance.name)
+    token = current.set(instance)
+    try:
+        if func is None:
+            raise TaskNotRegistered(instance.name)
+        result = func(**instance.payload)
+    except Exception as exc:
+        error = ''.join(traceback.format_exception(exc))[-4000:]
+        fields = {'last_error': error, 'locked_until': None, 'updated_at': timezone.now()}
+        if func is not None and instance.attempts < instance.max_attempts:
+            fields.update(status=Task.STATUS_QUEUED,
+                          run_after=timezone.now() + timedelta(seconds=backoff(instance.attempts)))
+        else:
+            fields.update(status=Task.STATUS_FAILED)
+        logger.warning('Task %s (%s) attempt %s failed: %s', instance.pk, instance.name, instance.attempts, exc)
+    else:
+        fields = {'status': Task.STATUS_DONE, 'result': result, 'locked_until': None,
+                  'last_error': '', 'updated_at': timezone.now()}
+    finally:
+        current.reset(token)
+    # Only the worker holding the lease records the outcome
+    Task.objects.filter(pk=instance.pk, attempts=instance.attempts).update(**fields)
+    for name, value in fields.items():
+        setattr(instance, name, value)
+    return instance
+
+
+def run_pending(limit=None, ids=None, batch=10):
+    """Claim and run due tasks until none are left (or ``limit`` ran)"""
+    done = 0
+    while limit is None or done < limit:
+        tasks = claim(batch if limit is None else min(batch, limit - done), ids=ids)
+        if not tasks:
+            break
+        for instance in tasks:
+            execute(instance)
+            if not connection.in_atomic_block:
+                close_old_connections()
+            done += 1
+    return done
@@ -1,3 +1,1411 @@
-from django.test import TestCase
+import base64
+import gzip
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+from asgiref.sync import iscoroutinefunction
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, TransactionTestCase, modify_settings, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image as PILImage
+from rest_framework.exceptions import ValidationError
+from rest_framework.mixins import ListModelMixin
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APITestCase
+from rest_framework.viewsets import GenericViewSet
+
+from api import benchmark, fastpath, hotcache, instrumentation, webhooks
+from api.cache import CachedResponseMixin, bump_generation, compute_etag, get_cache, get_generation
+from api.importer import ProductImporter, import_products, process_image
+from api.payments import FakeGateway
+from api.serializer import BulkCartItemSerializer, CartSerializer, CategorySerializer
+from api.tasks import IMPORT_PRODUCTS
+from . import imaging, retention, search, taskqueue
+from .context_processors import CART_ID_KEY, cart_renderer, get_session_cart
+from .models import Cart, Cartitems, Category, ChangeLog, ChangeLogQuerySet, Order, OrderItem, Product, ProductImage, Review, StripeEvent, Task
+
+
+class QueryBudgetTestCase(APITestCase):
+    """
+    Asserts a fixed maximum number of queries per endpoint
+
+    Each endpoint is measured with a small and a large data set, so an
+    N+1 shows up as the large set blowing the same budget.
+    """
+
+    def assertQueryBudget(self, budget, url):
+        get_cache().clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        queries = '\n'.join(query['sql'] for query in ctx.captured_queries)
+        self.assertLessEqual(
+            len(ctx), budget,
+            f'{url} ran {len(ctx)} queries (budget {budget}):\n{queries}',
+        )
+        return response
+
+
+class EndpointQueryBudgetTests(QueryBudgetTestCase):
+    page_size = 20
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='staff@example.com', is_staff=True)
+        self.category = Category.objects.create(title='Phones', slug='phones')
+
+    def seed(self, count):
+        products = Product.objects.bulk_create(
+            Product(name=f'Product {i}', old_price=10 + i, category=self.category)
+            for i in range(count)
+        )
+        ProductImage.objects.bulk_create(
+            ProductImage(product=product, image='img/p.png')
+            for product in products for _ in range(2)
+        )
+        Review.objects.bulk_create(
+            Review(product=products[0], name=f'r{i}') for i in range(count)
+        )
+        cart = Cart.objects.create(session_id='s')
+        Cartitems.objects.bulk_create(
+            Cartitems(cart=cart, product=product, quantity=1) for product in products
+        )
+        order = Order.objects.create(owner=self.user)
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, product=product, quantity=2,
+                      unit_price=product.price, product_name=product.name)
+            for product in products
+        )
+        return products[0], cart
+
+    def check_budgets(self, count):
+        product, cart = self.seed(count)
+        # The ETag / Last-Modified aggregate of api.conditional
+        validators = 1
+        self.assertQueryBudget(3 + validators, f'/api/products/?page_size={self.page_size}')
+        self.assertQueryBudget(3 + validators, f'/api/products/?pagination=cursor&page_size={self.page_size}')
+        self.assertQueryBudget(2 + validators, f'/api/products/{product.pk}/')
+        self.assertQueryBudget(2 + validators, '/api/categories/')
+        self.assertQueryBudget(2 + validators, f'/api/products/{product.pk}/reviews/')
+        self.assertQueryBudget(3, f'/api/carts/{cart.pk}/')
+        self.assertQueryBudget(3, f'/api/carts/{cart.pk}/items/')
+        self.client.force_authenticate(self.user)
+        self.assertQueryBudget(3 + validators, '/api/orders/')
+
+    def test_small_catalog(self):
+        self.check_budgets(2)
+
+    def test_large_catalog(self):
+        self.check_budgets(self.page_size * 2)
+
+
+class OrderTotalsTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='staff@example.com', is_staff=True)
+        self.client.force_authenticate(self.user)
+        cheap = Product.objects.create(name='Cheap', old_price=10)
+        sale = Product.objects.create(name='Sale', old_price=100, discount=True)
+        self.small = Order.objects.create(owner=self.user)
+        OrderItem.objects.create(order=self.small, product=cheap, quantity=3)
+        self.large = Order.objects.create(owner=self.user)
+        OrderItem.objects.create(order=self.large, product=cheap, quantity=1)
+        OrderItem.objects.create(order=self.large, product=sale, quantity=2)
+
+    def test_totals_are_annotated_with_discount(self):
+        response = self.client.get('/api/orders/?ordering=-total_amount')
+        orders = response.data.get('results', response.data)
+        self.assertEqual([order['total'] for order in orders], [150.0, 30.0])
+        self.assertEqual(sorted(item['sub_total'] for item in orders[0]['items']), [10.0, 140.0])
+        self.assertEqual(self.large.total_price, 150.0)
+
+    def test_filter_by_total(self):
+        response = self.client.get('/api/orders/?total_amount__gte=100')
+        orders = response.data.get('results', response.data)
+        self.assertEqual([order['id'] for order in orders], [self.large.id])
+
+    def test_checkout_snapshots_prices(self):
+        product = Product.objects.create(name='Phone', old_price=200)
+        cart = Cart.objects.create(session_id='s')
+        Cartitems.objects.create(cart=cart, product=product, quantity=2)
+        response = self.client.post('/api/orders/', {'cart_id': str(cart.pk)}, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+
+        Product.objects.filter(pk=product.pk).update(old_price=999, name='Renamed')
+        order = self.client.get(f"/api/orders/{response.data['id']}/").data
+        self.assertEqual(order['total'], 400.0)
+        self.assertEqual(order['items'][0]['product'], {'id': str(product.pk), 'price': 200.0, 'name': 'Phone'})
+
+
+class InventoryReservationTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='buyer@example.com')
+        self.client.force_authenticate(self.user)
+        self.phone = Product.objects.create(name='Phone', inventory=3)
+        self.case = Product.objects.create(name='Case', inventory=1)
+
+    def checkout(self, *lines):
+        cart = Cart.objects.create(session_id='s')
+        for product, quantity in lines:
+            Cartitems.objects.create(cart=cart, product=product, quantity=quantity)
+        return self.client.post('/api/orders/', {'cart_id': str(cart.pk)}, format='json')
+
+    def test_checkout_reserves_inventory(self):
+        response = self.checkout((self.phone, 2), (self.case, 1))
+        self.assertEqual(response.status_code, 201, response.content)
+        self.phone.refresh_from_db()
+        self.case.refresh_from_db()
+        self.assertEqual((self.phone.inventory, self.case.inventory), (1, 0))
+
+    def test_short_line_fails_whole_checkout(self):
+        response = self.checkout((self.phone, 2), (self.case, 2))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            [(line['product_id'], line['available']) for line in response.json()['inventory']],
+            [(str(self.case.pk), '1')],
+        )
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.inventory, 3)
+        self.assertFalse(Order.objects.exists())
+
+    def test_cancel_releases_inventory_once(self):
+        order_id = self.checkout((self.phone, 3)).data['id']
+        self.assertEqual(self.client.post(f'/api/orders/{order_id}/cancel/').status_code, 200)
+        self.assertEqual(self.client.post(f'/api/orders/{order_id}/cancel/').status_code, 400)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.inventory, 3)
+
+    def test_admin_status_changes_release_inventory(self):
+        failed, paid = self.checkout((self.phone, 2)).data['id'], self.checkout((self.phone, 1)).data['id']
+        self.client.force_authenticate(get_user_model().objects.create_user(email='staff@example.com', is_staff=True))
+        self.assertEqual(self.client.patch(f'/api/orders/{failed}/', {'pending_status': 'F'}).status_code, 200)
+        self.assertEqual(self.client.patch(f'/api/orders/{paid}/', {'pending_status': 'C'}).status_code, 200)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.inventory, 2)
+        # Leaving a final status would reserve or release the stock again
+        for order_id, status in ((failed, 'P'), (failed, 'X'), (paid, 'F')):
+            response = self.client.patch(f'/api/orders/{order_id}/', {'pending_status': status})
+            self.assertEqual(response.status_code, 400)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.inventory, 2)
+        self.assertEqual(Order.objects.get(pk=failed).pending_status, 'F')
+
+
+class BulkCartItemTests(APITestCase):
+    def test_bulk_upsert_sets_quantities(self):
+        products = [Product.objects.create(name=f'P{i}', old_price=10) for i in range(3)]
+        cart = Cart.objects.create(session_id='s')
+        Cartitems.objects.create(cart=cart, product=products[0], quantity=5)
+        items = [{'product_id': str(product.pk), 'quantity': 2} for product in products]
+        items.append({'product_id': str(products[1].pk), 'quantity': 1})
+
+        response = self.client.post(f'/api/carts/{cart.pk}/items/bulk/', {'items': items}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(
+            sorted(Cartitems.objects.filter(cart=cart).values_list('quantity', flat=True)), [2, 2, 3])
+        self.assertEqual(response.data['grand_total'], 70.0)
+
+    def test_add_increments_single_line(self):
+        product = Product.objects.create(name='P', old_price=10)
+        cart = Cart.objects.create(session_id='s')
+        url = f'/api/carts/{cart.pk}/items/'
+        first = self.client.post(url, {'product_id': str(product.pk), 'quantity': 2}, format='json')
+        second = self.client.post(url, {'product_id': str(product.pk), 'quantity': 3}, format='json')
+        self.assertEqual((first.status_code, second.status_code), (201, 201))
+        self.assertEqual(first.data['id'], second.data['id'])
+        self.assertEqual(second.data['quantity'], 5)
+        cart.refresh_from_db()
+        self.assertEqual((cart.item_count, cart.subtotal), (5, 50.0))
+
+    def test_adds_are_capped(self):
+        product = Product.objects.create(name='P', old_price=1)
+        cart = Cart.objects.create(session_id='s')
+        url = f'/api/carts/{cart.pk}/items/'
+        self.client.post(url, {'product_id': str(product.pk), 'quantity': 30000}, format='json')
+        response = self.client.post(url, {'product_id': str(product.pk), 'quantity': 30000}, format='json')
+        self.assertEqual(response.data['quantity'], Cartitems.MAX_QUANTITY)
+        response = self.client.post(url, {'product_id': str(product.pk), 'quantity': 40000}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_fallback_path_refreshes_totals_once(self):
+        # The path for databases without INSERT ... ON CONFLICT ... RETURNING
+        product = Product.objects.create(name='P', old_price=10)
+        cart = Cart.objects.create(session_id='s')
+        for quantity, total in [(2, 2), (3, 5), (Cartitems.MAX_QUANTITY, Cartitems.MAX_QUANTITY)]:
+            with CaptureQueriesContext(connection) as ctx:
+                item = Cartitems.objects.all()._increment_or_create(cart.pk, product.pk, quantity)
+            self.assertEqual(item.quantity, total)
+            refreshes = [q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "storeapp_cart"')]
+            self.assertEqual(len(refreshes), 1)
+        cart.refresh_from_db()
+        self.assertEqual(cart.item_count, Cartitems.MAX_QUANTITY)
+        self.assertIsNone(Cartitems.objects.all()._increment_or_create(cart.pk, uuid.uuid4(), 1))
+
+
+class CartTotalsTests(APITestCase):
+    """Cart.item_count/subtotal follow every write to the lines and prices"""
+
+    def setUp(self):
+        self.phone = Product.objects.create(name='Phone', old_price=10)
+        self.case = Product.objects.create(name='Case', old_price=4, discount=True)
+        self.cart = Cart.objects.create(session_id='s')
+        self.url = f'/api/carts/{self.cart.pk}/items/'
+
+    def assertTotals(self, item_count, subtotal):
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.item_count, item_count)
+        self.assertAlmostEqual(self.cart.subtotal, subtotal)
+        self.assertAlmostEqual(self.client.get(f'/api/carts/{self.cart.pk}/').data['grand_total'], subtotal)
+
+    def test_line_writes(self):
+        self.client.post(self.url, {'product_id': self.phone.pk, 'quantity': 2})
+        self.client.post(self.url, {'product_id': self.case.pk, 'quantity': 1})
+        self.assertTotals(3, 2 * 10 + self.case.price)
+
+        line = Cartitems.objects.get(cart=self.cart, product=self.phone)
+        self.client.patch(f'{self.url}{line.pk}/', {'quantity': 5})
+        self.assertTotals(6, 5 * 10 + self.case.price)
+
+        self.client.delete(f'{self.url}{line.pk}/')
+        self.assertTotals(1, self.case.price)
+        self.client.post(f'{self.url}bulk/', {'items': [{'product_id': str(self.phone.pk), 'quantity': 3}]},
+                         format='json')
+        self.assertTotals(4, 3 * 10 + self.case.price)
+
+    def test_price_changes(self):
+        Cartitems.objects.create(cart=self.cart, product=self.phone, quantity=2)
+        Cartitems.objects.create(cart=self.cart, product=self.case, quantity=1)
+        updated = Cart.objects.get(pk=self.cart.pk).updated
+
+        self.phone.old_price = 20
+        self.phone.save()
+        self.assertTotals(3, 40 + self.case.price)
+        Product.objects.filter(pk=self.case.pk).update(discount=False)
+        self.assertTotals(3, 44)
+        self.case.old_price = 6
+        Product.objects.bulk_update([self.case], ['old_price'])
+        self.assertTotals(3, 46)
+        # Repricing is not shopper activity (storeapp.retention)
+        self.assertEqual(self.cart.updated, updated)
+
+        self.phone.delete()
+        self.assertTotals(1, 6)
+
+
+class DerivedColumnsTests(APITestCase):
+    """effective_price and search_document match the fields they derive from"""
+
+    def assertInSync(self, *products):
+        for product in Product.objects.filter(pk__in=[p.pk for p in products]):
+            self.assertAlmostEqual(product.effective_price, product.price)
+            self.assertEqual(product.search_document, product.build_search_document())
+
+    def test_every_write_path(self):
+        phone, case = Product.objects.bulk_create([
+            Product(name='Phone', description='Smart', old_price=10),
+            Product(name='Case', old_price=4, discount=True),
+        ])
+        self.assertInSync(phone, case)
+        self.assertEqual(Product.objects.get(pk=case.pk).search_document, 'Case ')
+
+        phone.discount = True
+        phone.name = 'Phone X'
+        phone.save(update_fields=['discount', 'name'])
+        self.assertInSync(phone)
+        self.assertAlmostEqual(Product.objects.get(pk=phone.pk).effective_price, 7)
+
+        Product.objects.filter(pk=case.pk).update(old_price=F('old_price') * 2, description='Leather')
+        self.assertInSync(case)
+        self.assertEqual(Product.objects.get(pk=case.pk).search_document, 'Case Leather')
+
+        phone.old_price, case.name = 20, 'Wallet case'
+        Product.objects.bulk_update([phone, case], ['old_price'])
+        Product.objects.bulk_update([case], ['name'])
+        self.assertInSync(phone, case)
+        Product.objects.update(old_price=1, discount=False)
+        self.assertEqual(set(Product.objects.values_list('effective_price', flat=True)), {1})
+
+
+class SearchBackendTests(APITestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.stand = Product.objects.create(name='Phone', description='Phone stand for any phone')
+        self.case = Product.objects.create(
+            name='Leather case', description='Fits every phone model sold in the last ten years, in five colours')
+        self.cable = Product.objects.create(name='Cable', description='USB-C')
+
+    def backends(self):
+        yield search.ContainsSearchBackend()
+        if connection.vendor == 'postgresql':
+            yield search.PostgresSearchBackend()
+        if isinstance(search.get_search_backend(), search.SQLiteSearchBackend):
+            yield search.SQLiteSearchBackend()
+
+    def test_backends_match_and_rank(self):
+        for backend in self.backends():
+            def names(query):
+                return [product.name for product in backend.search(Product.objects.all(), query)]
+            with self.subTest(backend=type(backend).__name__):
+                self.assertEqual(sorted(names('pho')), ['Leather case', 'Phone'])
+                self.assertEqual(names('PHONE leather'), ['Leather case'])
+                self.assertEqual(names('usb'), ['Cable'])
+                self.assertEqual(names('tablet'), [])
+                if not isinstance(backend, search.ContainsSearchBackend):
+                    self.assertEqual(names('phone'), ['Phone', 'Leather case'])
+
+        # Later writes are searchable (FTS triggers, search_document upkeep)
+        Product.objects.filter(pk=self.cable.pk).update(description='Phone charging cable')
+        self.case.delete()
+        for backend in self.backends():
+            results = backend.search(Product.objects.all(), 'phone')
+            self.assertEqual({product.pk for product in results}, {self.stand.pk, self.cable.pk})
+
+    def test_search_param_orders_by_relevance(self):
+        response = self.client.get('/api/products/', {'search': 'phone'})
+        names = [product['name'] for product in response.data['results']]
+        if isinstance(search.get_search_backend(), search.ContainsSearchBackend):
+            self.assertEqual(sorted(names), ['Leather case', 'Phone'])
+        else:
+            self.assertEqual(names, ['Phone', 'Leather case'])
+        response = self.client.get('/api/products/', {'search': 'phone', 'ordering': '-old_price'})
+        self.assertEqual(len(response.data['results']), 2)
+
+
+class AsyncCatalogTests(APITestCase):
+    def setUp(self):
+        self.category = Category.objects.create(title='Phones', slug='phones')
+        self.products = Product.objects.bulk_create(
+            Product(name=f'Phone {i}', old_price=10 + i, category=self.category) for i in range(5)
+        )
+        ProductImage.objects.create(product=self.products[0], image='img/p.png')
+        Review.objects.create(product=self.products[0], name='r')
+
+    def test_matches_sync_endpoints(self):
+        get_cache().clear()
+        for sync_url, async_url in [
+            ('/api/products/?pagination=cursor&ordering=-old_price&page_size=2',
+             '/api/async/products/?ordering=-old_price&page_size=2'),
+            ('/api/products/?pagination=cursor&category=%s' % self.category.pk,
+             '/api/async/products/?category=%s' % self.category.pk),
+            (f'/api/products/{self.products[0].pk}/', f'/api/async/products/{self.products[0].pk}/'),
+            (f'/api/products/{self.products[0].pk}/reviews/',
+             f'/api/async/products/{self.products[0].pk}/reviews/'),
+        ]:
+            expected = self.client.get(sync_url).json()
+            actual = self.client.get(async_url).json()
+            self.assertEqual(actual.get('results', actual), expected.get('results', expected), async_url)
+
+    def test_cursor_walk_and_errors(self):
+        seen = []
+        url = '/api/async/products/?page_size=2'
+        while url:
+            page = self.client.get(url).json()
+            seen += [product['id'] for product in page['results']]
+            url = page['next']
+        self.assertEqual(sorted(seen), sorted(str(product.pk) for product in self.products))
+        self.assertEqual(self.client.get('/api/async/categories/').json()['results'][0]['slug'], 'phones')
+        self.assertEqual(self.client.get('/api/async/products/?cursor=bogus').status_code, 404)
+        self.assertEqual(self.client.get('/api/async/products/?old_price__gt=x').status_code, 400)
+
+
+class KeysetPaginationTests(APITestCase):
+    def setUp(self):
+        get_cache().clear()
+
+    @staticmethod
+    def cursor(**position):
+        raw = json.dumps({'o': 'old_price', 'v': 10, 'id': str(uuid.uuid4()), 'r': 0, **position})
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def walk(self, url, link='next'):
+        pages = []
+        while url:
+            page = self.client.get(url).json()
+            pages.append([product['id'] for product in page['results']])
+            url = page[link]
+        return pages
+
+    def test_cursors_round_trip_over_ties(self):
+        # Three prices for seven products: most pages end inside a tie
+        Product.objects.bulk_create(Product(name=f'P{i}', old_price=10 + i % 3) for i in range(7))
+        for ordering in ('old_price', '-old_price'):
+            tiebreak = '-id' if ordering.startswith('-') else 'id'
+            expected = [str(pk) for pk in Product.objects.order_by(ordering, tiebreak).values_list('pk', flat=True)]
+            pages = self.walk(f'/api/products/?pagination=cursor&page_size=3&ordering={ordering}')
+            self.assertEqual([len(page) for page in pages], [3, 3, 1])
+            self.assertEqual(sum(pages, []), expected, ordering)
+
+            # From the last page back to the first, through the previous links
+            last = self.client.get(f'/api/products/?pagination=cursor&page_size=3&ordering={ordering}')
+            while last.json()['next']:
+                last = self.client.get(last.json()['next'])
+            back = self.walk(last.json()['previous'], link='previous')
+            self.assertEqual(back, pages[-2::-1], ordering)
+
+    def test_malformed_cursor_values_are_404(self):
+        self.assertEqual(self.client.get(
+            '/api/products/', {'ordering': 'old_price', 'cursor': self.cursor()}).status_code, 200)
+        for position in [{'id': 'not-a-uuid'}, {'v': 'cheap'}, {'v': None}, {'id': [1]}, {'o': 'name'}]:
+            response = self.client.get('/api/products/', {'ordering': 'old_price', 'cursor': self.cursor(**position)})
+            self.assertEqual(response.status_code, 404, position)
+        response = self.client.get('/api/async/products/', {'cursor': self.cursor(o='id', id='x', v='x')})
+        self.assertEqual(response.status_code, 404)
+
+
+class ProductExportTests(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(
+            get_user_model().objects.create_user(email='staff@example.com', is_staff=True))
+        self.products = [Product.objects.create(name=f'P{i}', old_price=10) for i in range(5)]
+        ProductImage.objects.create(product=self.products[0], image='img/p.png')
+
+    def export(self, query=''):
+        response = self.client.get('/api/products/export/' + query)
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_resume_and_incremental(self):
+        rows = self.export()
+        expected = Product.objects.order_by('updated_at', 'id').values_list('id', flat=True)
+        self.assertEqual([row['id'] for row in rows], [str(pk) for pk in expected])
+        images = next(row['images'] for row in rows if row['id'] == str(self.products[0].pk))
+        self.assertTrue(images[0].startswith('http://testserver/'), images)
+
+        last = rows[2]
+        resumed = self.export('?' + urlencode({'updated_since': last['updated_at'], 'after': last['id']}))
+        self.assertEqual(resumed, rows[3:])
+
+        since = rows[-1]['updated_at']
+        Product.objects.filter(pk=rows[0]['id']).update(inventory=1)
+        changed = self.export('?' + urlencode({'updated_since': since, 'after': rows[-1]['id']}))
+        self.assertEqual([(row['id'], row['inventory']) for row in changed], [(rows[0]['id'], 1)])
+
+    def test_csv_gzip(self):
+        response = self.client.get('/api/products/export/?fmt=csv&gzip=true')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(self.client.get('/api/products/export/?fmt=xml').status_code, 400)
+
+
+class ChangeFeedTests(APITestCase):
+    def setUp(self):
+        self.client.force_authenticate(
+            get_user_model().objects.create_user(email='staff@example.com', is_staff=True))
+
+    def feed(self, since=0, **params):
+        response = self.client.get('/api/changes/', {'since': since, **params})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_feed_follows_writes(self):
+        product = Product.objects.create(name='Phone', inventory=5)
+        image = ProductImage.objects.create(product=product, image='img/p.png')
+        start = self.feed()['next']
+
+        # Stock moves are not catalog changes
+        Product.objects.filter(pk=product.pk).update(inventory=4)
+        self.assertEqual(self.feed(start)['results'], [])
+        image_id = image.pk
+        image.delete()
+        cart = Cart.objects.create(session_id='s')
+        Cartitems.objects.create(cart=cart, product=product, quantity=1)
+        order_id = self.client.post('/api/orders/', {'cart_id': str(cart.pk)}, format='json').data['id']
+
+        page = self.feed(start, models='product,order')
+        changes = [(entry['model'], entry['object_id'], entry['action']) for entry in page['results']]
+        self.assertIn(('product', str(product.pk), 'U'), changes)
+        self.assertIn(('order', str(order_id), 'U'), changes)
+        self.assertEqual({entry['model'] for entry in page['results']}, {'product', 'order'})
+        self.assertIn(('productimage', str(image_id), 'D'),
+                      [(e['model'], e['object_id'], e['action']) for e in self.feed(start)['results']])
+        self.assertEqual(self.feed(page['next'], wait=0)['results'], [])
+
+    def test_gaps_are_held_until_filled_or_rolled_back(self):
+        first, second, third, fourth = [entry.seq for entry in ChangeLog.objects.record(Category, 'abcd')]
+        ChangeLog.objects.filter(seq__in=[second, third]).delete()
+        # Seen at 5 while a transaction from before 5 is still running
+        entries, since, gaps = ChangeLog.objects.read(0, 10, horizon=(5, 4))
+        self.assertEqual([e.seq for e in entries], [first, fourth])
+        self.assertEqual((since, gaps), (fourth, {second: 5, third: 5}))
+        self.assertEqual(ChangeLog.objects.read(since, 10, gaps, horizon=(6, 4)), ([], since, gaps))
+
+        # One commits late, the other rolled back
+        ChangeLog.objects.create(seq=second, model='category', object_id='b')
+        entries, since, gaps = ChangeLog.objects.read(since, 10, gaps, horizon=(7, 5))
+        self.assertEqual(([e.seq for e in entries], since, gaps), ([second], fourth, {}))
+
+    def test_next_carries_pending_gaps(self):
+        first, second, third = [entry.seq for entry in ChangeLog.objects.record(Category, 'abc')]
+        ChangeLog.objects.filter(seq=second).delete()
+        # As on a database where the gap may still be in flight (on SQLite it is final at once)
+        with mock.patch.object(ChangeLogQuerySet, 'transaction_horizon', return_value=(5, 4)):
+            page = self.feed(first - 1)
+            self.assertEqual([entry['seq'] for entry in page['results']], [first, third])
+            ChangeLog.objects.create(seq=second, model='category', object_id='b')
+            page = self.feed(page['next'])
+        self.assertEqual([entry['seq'] for entry in page['results']], [second])
+        self.assertEqual(page['next'], str(third))
+        response = self.client.get('/api/changes/', {'since': 'bogus'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'since': 'Not a position returned by this feed.'})
+
+    def test_requires_staff(self):
+        self.client.force_authenticate(None)
+        response = self.client.get('/api/changes/')
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(response.has_header('WWW-Authenticate'))
+        self.client.force_authenticate(get_user_model().objects.create_user(email='shopper@example.com'))
+        self.assertEqual(self.client.get('/api/changes/').status_code, 403)
+
+
+class ProductImportTests(APITestCase):
+    csv_rows = (
+        'slug,name,old_price,inventory,category\n'
+        'phone,Phone,200,3,Phones\n'
+        'case,Case,-1,1,Phones\n'
+        'cable,Cable,5,,Accessories\n'
+    )
+
+    def setUp(self):
+        media = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        self.client.force_authenticate(
+            get_user_model().objects.get_or_create(email='staff@example.com', is_staff=True)[0])
+
+    def upload(self, content, name='products.csv'):
+        upload = SimpleUploadedFile(name, content.encode())
+        response = self.client.post('/api/products/import/', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 202, response.content)
+        self.assertEqual(response.data['status'], 'queued')
+        self.assertEqual(response['Location'], response.data['status_url'])
+        taskqueue.run_pending()
+        status = self.client.get(response.data['status_url']).data
+        self.assertEqual(status['status'], 'done', status)
+        return status['result']
+
+    def test_import_is_idempotent_on_slug(self):
+        result = self.upload(self.csv_rows)
+        self.assertEqual((result['created'], result['failed']), (2, 1))
+        self.assertEqual(result['errors'][0]['line'], 3)
+        self.assertIn('old_price', result['errors'][0]['errors'])
+        self.assertEqual(Category.objects.get(slug='phones').title, 'Phones')
+        self.assertEqual(
+            set(ChangeLog.objects.filter(model='category').values_list('object_id', flat=True)),
+            {str(pk) for pk in Category.objects.values_list('pk', flat=True)},
+        )
+        self.assertEqual(Product.objects.get(slug='cable').inventory, 5)
+
+        again = self.upload(self.csv_rows.replace('phone,Phone,200', 'phone,Phone,150'))
+        self.assertEqual((again['created'], again['updated'], again['unchanged']), (0, 1, 1))
+        self.assertEqual(Product.objects.filter(slug='phone').get().price, 150)
+        self.assertEqual(Category.objects.count(), 2)
+        # The uploads are removed once imported
+        self.assertEqual(default_storage.listdir('imports'), ([], []))
+
+    def test_status_is_staff_only(self):
+        self.upload(self.csv_rows)
+        task = Task.objects.get(name=IMPORT_PRODUCTS)
+        self.client.force_authenticate(get_user_model().objects.create_user(email='shopper@example.com'))
+        self.assertEqual(self.client.get(f'/api/products/import/{task.pk}/').status_code, 403)
+        self.client.force_authenticate(get_user_model().objects.get(email='staff@example.com'))
+        self.assertEqual(self.client.get(f'/api/products/import/{task.pk + 1}/').status_code, 404)
+
+    def test_new_categories_reach_the_feed_and_the_caches(self):
+        generation = get_generation()
+        categories = ProductImporter().get_categories([{'category': 'Garden'}])
+        self.assertNotEqual(get_generation(), generation)
+        self.assertTrue(ChangeLog.objects.filter(model='category', object_id=str(categories['garden'].pk)).exists())
+
+    def test_concurrent_import_of_a_slug_is_matched_under_the_lock(self):
+        # Another import created the product after this batch first looked
+        real = ProductImporter.get_existing
+        calls = iter([({}, set())])
+        with mock.patch.object(ProductImporter, 'get_existing',
+                               side_effect=lambda slugs: next(calls, None) or real(slugs)):
+            Product.objects.create(name='Old phone', slug='phone')
+            result = import_products(io.StringIO(self.csv_rows), 'csv', workers=0)
+        self.assertEqual((result.created, result.updated), (1, 1))
+        self.assertEqual(Product.objects.filter(slug='phone').count(), 1)
+
+    def test_upload_is_kept_until_the_last_attempt(self):
+        upload = SimpleUploadedFile('products.csv', b'slug,name\n\xff\xfe,bad\n')
+        self.client.post('/api/products/import/', {'file': upload}, format='multipart')
+        task = Task.objects.get(name=IMPORT_PRODUCTS)
+        taskqueue.run_pending()
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.STATUS_QUEUED)
+        self.assertTrue(default_storage.exists(task.payload['path']))
+
+        Task.objects.filter(pk=task.pk).update(run_after=timezone.now(), max_attempts=2)
+        taskqueue.run_pending()
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.STATUS_FAILED)
+        self.assertFalse(default_storage.exists(task.payload['path']))
+
+    def test_image_urls_must_be_public(self):
+        def resolve(host, *args, **kwargs):
+            address = {'cdn.example.com': '93.184.216.34', 'metadata.example.com': '169.254.169.254'}.get(host, host)
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, 80))]
+
+        redirect = mock.MagicMock(is_redirect=True, headers={'location': 'http://metadata.example.com/latest'})
+        redirect.__enter__.return_value = redirect
+        with mock.patch('socket.getaddrinfo', side_effect=resolve), \
+                mock.patch('requests.get', return_value=redirect) as get:
+            for url in ('http://127.0.0.1/a.png', 'http://[::1]/a.png', 'http://10.0.0.8/a.png',
+                        'http://169.254.169.254/latest', 'http://metadata.example.com/x.png'):
+                self.assertIn('non-public', process_image(url)[1])
+            # A public host redirecting to an internal one is refused too
+            self.assertIn('metadata.example.com resolves to a non-public address',
+                          process_image('http://cdn.example.com/a.png')[1])
+            self.assertEqual(get.call_count, 1)
+            self.assertFalse(get.call_args.kwargs['allow_redirects'])
+
+            with override_settings(IMPORT_IMAGE_HOSTS=['images.example.com']):
+                self.assertIn('not an allowed image host', process_image('http://cdn.example.com/a.png')[1])
+            self.assertEqual(get.call_count, 1)
+
+    def test_images_are_stored_once(self):
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            PILImage.new('RGB', (4, 4), 'red').save(os.path.join(media, 'red.png'))
+            rows = io.StringIO(
+                json.dumps({'slug': 'a', 'name': 'A', 'images': ['red.png', 'red.png']}) + '\n'
+                + json.dumps({'slug': 'b', 'name': 'B', 'image': 'missing.png'}) + '\n'
+                + 'not json\n'
+            )
+            result = import_products(rows, 'ndjson', workers=0, allow_local_images=True, images_dir=media)
+            self.assertEqual((result.created, result.images, result.failed), (2, 1, 2))
+            product = Product.objects.get(slug='a')
+            self.assertEqual(product.image.name, product.images.get().image.name)
+            self.assertTrue(os.path.exists(product.image.path))
+
+        with self.assertRaises(ValueError):
+            import_products(io.StringIO(''), 'xml', workers=0)
+
+
+class ImageVariantTests(APITestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=self.media.name))
+        buffer = io.BytesIO()
+        PILImage.new('RGBA', (800, 600), (255, 0, 0, 128)).save(buffer, 'PNG')
+        self.name = default_storage.save('img/big.png', ContentFile(buffer.getvalue()))
+
+    def test_variants_are_generated_by_the_task_queue(self):
+        product = Product.objects.create(name='Phone', image=self.name)
+        task = Task.objects.get(name=imaging.GENERATE_VARIANTS)
+        self.assertEqual(task.payload, {'model': 'storeapp.product', 'pks': [str(product.pk)]})
+
+        taskqueue.run_pending()
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.STATUS_DONE)
+        product.refresh_from_db()
+        self.assertFalse(imaging.needs_variants(product))
+        formats = product.image_variants['formats']
+        self.assertEqual(sorted(formats['webp']), ['160', '320', '640'])
+        with default_storage.open(formats['webp']['160']) as fh, PILImage.open(fh) as thumb:
+            self.assertEqual(thumb.size, (160, 120))
+
+        get_cache().clear()
+        srcset = self.client.get(f'/api/products/{product.pk}/').data['image_srcset']
+        self.assertTrue(srcset['thumbnail'].endswith('-320w.jpg'))
+        self.assertEqual(srcset['srcset']['webp'].count('w,'), 2)
+
+    @override_settings(HOTCACHE_ENABLED=True)
+    def test_variants_evict_one_product_and_are_queued_once(self):
+        product = Product.objects.create(name='Phone', image=self.name)
+        product.save()
+        self.assertEqual(Task.objects.filter(name=imaging.GENERATE_VARIANTS).count(), 1)
+        other = Product.objects.create(name='Case')
+        hotcache.get_products([product.pk, other.pk])
+        generation = get_generation()
+
+        taskqueue.run_pending()
+        self.assertEqual(get_generation(), generation)
+        self.assertEqual(list(hotcache.products.entries), [other.pk])
+        self.assertTrue(hotcache.get_product(product.pk).image_variants['formats'])
+        # The next image is a new job
+        product.image = default_storage.save('img/other.png', ContentFile(default_storage.open(self.name).read()))
+        product.save()
+        self.assertEqual(Task.objects.filter(name=imaging.GENERATE_VARIANTS).count(), 2)
+
+    def test_image_rows_touch_product(self):
+        product = Product.objects.create(name='Phone')
+        image = ProductImage.objects.create(product=product, image=self.name)
+        since = ChangeLog.objects.order_by('seq').last().seq
+        imaging.update_variants(ProductImage, image.pk)
+        self.assertTrue(ChangeLog.objects.filter(seq__gt=since, model='product', object_id=str(product.pk)).exists())
+        self.assertIsNone(self.client.get(f'/api/products/{Product.objects.create(name="x").pk}/').data['image_srcset'])
+
+
+@override_settings(PAYMENT_GATEWAY='api.payments.FakeGateway', FRONTEND_URL='http://shop')
+class PaymentTaskTests(APITestCase):
+    def setUp(self):
+        FakeGateway.sessions, FakeGateway.paid = {}, True
+        self.user = get_user_model().objects.create_user(email='buyer@example.com')
+        self.client.force_authenticate(self.user)
+        self.order = Order.objects.create(owner=self.user)
+        OrderItem.objects.create(order=self.order, product=Product.objects.create(name='P'), quantity=1, unit_price=20)
+
+    def test_checkout_runs_in_the_background(self):
+        url = f'/api/orders/{self.order.pk}/'
+        response = self.client.post(url + 'pay/')
+        self.assertEqual((response.status_code, response.data['checkout_status']), (202, 'queued'))
+        self.client.post(url + 'pay/')
+        self.assertEqual(taskqueue.run_pending(), 1)
+
+        status = self.client.get(url + 'payment/').data
+        self.assertTrue(status['session_url'].startswith('http://shop/orders/'))
+        self.order.refresh_from_db()
+        self.assertEqual(FakeGateway.sessions[self.order.payment_session_id]['amount'], 20)
+
+        self.assertEqual(self.client.post(url + 'success_payment/').status_code, 202)
+        self.assertEqual(self.client.get(url).data['pending_status'], 'P')
+        self.assertEqual(taskqueue.run_pending(), 2)
+        self.assertEqual(self.client.get(url).data['pending_status'], 'C')
+        self.assertEqual(mail.outbox[0].to, ['buyer@example.com'])
+
+    def test_expired_session_releases_inventory(self):
+        product = self.order.items.get().product
+        reserved = product.inventory
+        FakeGateway.paid = False
+        self.client.post(f'/api/orders/{self.order.pk}/pay/')
+        taskqueue.run_pending()
+        with mock.patch.object(FakeGateway, 'expired', True):
+            self.client.post(f'/api/orders/{self.order.pk}/success_payment/')
+            taskqueue.run_pending()
+        self.order.refresh_from_db()
+        product.refresh_from_db()
+        self.assertEqual((self.order.pending_status, product.inventory), ('F', reserved + 1))
+
+    def test_unpaid_session_is_retried_with_backoff(self):
+        FakeGateway.paid = False
+        self.client.post(f'/api/orders/{self.order.pk}/pay/')
+        taskqueue.run_pending()
+        self.client.post(f'/api/orders/{self.order.pk}/success_payment/')
+        taskqueue.run_pending()
+
+        task = Task.objects.get(name='orders.confirm_payment')
+        self.assertEqual((task.status, task.attempts), (Task.STATUS_QUEUED, 1))
+        self.assertGreater(task.run_after, timezone.now())
+        self.assertIn('not paid yet', task.last_error)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.pending_status, 'P')
+
+    def test_heartbeat_extends_the_lease_until_it_is_lost(self):
+        Task.objects.all().delete()
+        seen = []
+
+        @taskqueue.task('tests.heartbeat', lease=3600)
+        def beat():
+            task = Task.objects.get(name='tests.heartbeat')
+            seen.append(task.locked_until - timezone.now())
+            Task.objects.filter(pk=task.pk).update(locked_until=timezone.now())
+            taskqueue.heartbeat()
+            seen.append(Task.objects.get(pk=task.pk).locked_until - timezone.now())
+            # Another worker claimed it meanwhile
+            Task.objects.filter(pk=task.pk).update(attempts=F('attempts') + 1)
+            taskqueue.heartbeat()
+
+        self.addCleanup(taskqueue.registry.pop, 'tests.heartbeat')
+        taskqueue.enqueue('tests.heartbeat')
+        taskqueue.run_pending()
+        self.assertTrue(all(timedelta(minutes=59) < lease <= timedelta(hours=1) for lease in seen), seen)
+        task = Task.objects.get(name='tests.heartbeat')
+        # The outcome belongs to the worker holding the lease
+        self.assertEqual((task.status, task.attempts), (Task.STATUS_RUNNING, 2))
+
+    def test_failed_task_gives_up_then_requeues(self):
+        Task.objects.all().delete()
+        task = taskqueue.enqueue('orders.send_order_confirmation', {'order_id': 0}, idempotency_key='k')
+        Task.objects.filter(pk=task.pk).update(max_attempts=1)
+        taskqueue.run_pending()
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.STATUS_FAILED)
+        self.assertEqual(taskqueue.enqueue('orders.send_order_confirmation', {'order_id': 0}, idempotency_key='k').pk, task.pk)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.STATUS_QUEUED, 0))
+
+
+@override_settings(PAYMENT_GATEWAY='api.payments.FakeGateway', STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeWebhookTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='buyer@example.com')
+        self.product = Product.objects.create(name='P', inventory=5)
+        self.orders = []
+        for session_id in ('cs_1', 'cs_2', 'cs_3'):
+            order = Order.objects.create(owner=self.user, payment_session_id=session_id)
+            OrderItem.objects.create(order=order, product=self.product, quantity=2, unit_price=10)
+            self.orders.append(order)
+
+    def deliver(self, event_id, event_type, order, session_id=None, signature=None, **session):
+        session = {'id': session_id or order.payment_session_id, 'metadata': {'order_id': str(order.pk)},
+                   'payment_status': 'paid', **session}
+        payload = json.dumps({'id': event_id, 'type': event_type, 'data': {'object': session}}).encode()
+        return self.client.post('/api/stripe/webhook/', payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=signature or FakeGateway.sign(payload))
+
+    def statuses(self):
+        return [Order.objects.get(pk=order.pk).pending_status for order in self.orders]
+
+    def test_paid_event_is_applied_once(self):
+        self.assertEqual(self.deliver('evt_1', 'checkout.session.completed', self.orders[0]).data['duplicate'], False)
+        self.assertEqual(self.deliver('evt_1', 'checkout.session.completed', self.orders[0]).data['duplicate'], True)
+        taskqueue.run_pending()
+        self.assertEqual(self.statuses(), ['C', 'P', 'P'])
+        self.assertEqual(StripeEvent.objects.get().outcome, f'order {self.orders[0].pk} paid')
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_bad_signature_is_rejected(self):
+        response = self.deliver('evt_1', 'checkout.session.completed', self.orders[0], signature='t=1,v1=00')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_events_are_applied_in_batches(self):
+        self.deliver('evt_1', 'checkout.session.completed', self.orders[0])
+        self.deliver('evt_2', 'checkout.session.expired', self.orders[1])
+        # An old session of order 3 expiring leaves its current one payable
+        self.deliver('evt_3', 'checkout.session.expired', self.orders[2], session_id='cs_old')
+        self.deliver('evt_4', 'checkout.session.completed', self.orders[2], payment_status='unpaid')
+        self.deliver('evt_5', 'customer.created', self.orders[2])
+
+        self.assertEqual(webhooks.process_pending(batch_size=2), (5, [self.orders[0].pk]))
+        self.assertEqual(self.statuses(), ['C', 'F', 'P'])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.inventory, 7)
+        self.assertEqual(
+            list(StripeEvent.objects.order_by('id').values_list('outcome', flat=True)),
+            [f'order {self.orders[0].pk} paid', f'order {self.orders[1].pk} failed', 'no change', 'ignored', 'ignored'],
+        )
+        self.assertEqual(webhooks.process_pending(), (0, []))
+
+
+class CartRetentionTests(APITestCase):
+    def make_cart(self, age, items=0, **fields):
+        cart = Cart.objects.create(session_id='s', **fields)
+        if items:
+            Cartitems.objects.create(cart=cart, product=self.product, quantity=items)
+        then = timezone.now() - age
+        Cart.objects.filter(pk=cart.pk).update(created=then, updated=then)
+        return cart.pk
+
+    def test_purge_keeps_live_carts(self):
+        self.product = Product.objects.create(name='P')
+        old, week = timedelta(days=40), timedelta(days=7)
+        purged = [self.make_cart(week), self.make_cart(week), self.make_cart(week, items=1, completed=True),
+                  self.make_cart(old, items=2), self.make_cart(old, items=1)]
+        kept = [self.make_cart(timedelta(hours=1)), self.make_cart(week, items=1)]
+        # Created long ago but the shopper is still adding to it
+        active = self.make_cart(old)
+        self.client.post(f'/api/carts/{active}/items/', {'product_id': self.product.pk, 'quantity': 1})
+
+        self.assertEqual(retention.count(), {'empty': 2, 'completed': 1, 'abandoned': 2})
+        result = retention.purge_carts(batch_size=2)
+        self.assertEqual(result.carts, {'empty': 2, 'completed': 1, 'abandoned': 2})
+        self.assertEqual((result.items, result.batches), (3, 3))
+        self.assertFalse(Cart.objects.filter(pk__in=purged).exists())
+        self.assertEqual(set(Cart.objects.values_list('pk', flat=True)), {*kept, active})
+        self.assertEqual(Cartitems.objects.count(), 2)
+        self.assertEqual(retention.purge_carts().total, 0)
+
+
+class CartRendererTests(APITestCase):
+    def render(self, request):
+        context = cart_renderer(request)
+        return context['cart'].num_of_items
+
+    def test_page_views_do_not_create_carts(self):
+        request = RequestFactory().get('/')
+        request.session = {}
+        with self.assertNumQueries(0):
+            cart_renderer(request)
+            self.assertEqual(self.render(request), 0)
+        self.assertFalse(Cart.objects.exists())
+
+        cart = Cart.objects.create(session_id='s')
+        request.session[CART_ID_KEY] = str(cart.pk)
+        Cartitems.objects.create(cart=cart, product=Product.objects.create(name='P'), quantity=3)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.render(request), 3)
+
+    def test_stale_and_legacy_sessions(self):
+        legacy = Cart.objects.create(session_id='legacy')
+        request = RequestFactory().get('/')
+        request.session = {'nonuser': 'legacy'}
+        self.assertEqual(get_session_cart(request), legacy)
+        self.assertEqual(request.session[CART_ID_KEY], str(legacy.pk))
+
+        legacy.delete()
+        self.assertIsNone(get_session_cart(request).pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render(request), 0)
+
+
+@modify_settings(MIDDLEWARE={'prepend': 'api.instrumentation.InstrumentationMiddleware'})
+class InstrumentationTests(APITestCase):
+    def setUp(self):
+        instrumentation.registry.reset()
+        get_cache().clear()
+        Product.objects.create(name='P')
+
+    def test_server_timing_and_metrics(self):
+        response = self.client.get('/api/products/')
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn('serialize;dur=', timing)
+        self.assertIn('cache;dur=', timing)
+
+        metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",route="product-list",le="+Inf"} 1', metrics)
+        self.assertIn('http_requests_total{method="GET",route="product-list",status="200"} 1', metrics)
+        self.assertIn('serializer_seconds_total{serializer="ProductRows"}', metrics)
+        self.assertIn('api_cache_lookups_total{result="miss",view="product"} 1', metrics)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 403)
+
+    def test_nothing_is_hooked_in_without_the_middleware(self):
+        with override_settings(INSTRUMENTATION_ENABLED=False), self.assertRaises(MiddlewareNotUsed):
+            instrumentation.InstrumentationMiddleware(lambda request: HttpResponse())
+        with mock.patch.object(instrumentation, 'install') as install:
+            # A new client loads the middleware chain again
+            with modify_settings(MIDDLEWARE={'remove': 'api.instrumentation.InstrumentationMiddleware'}):
+                APIClient().get('/api/products/')
+            install.assert_not_called()
+            APIClient().get('/api/products/')
+            install.assert_called_once_with()
+
+    async def test_async_requests_stay_on_the_event_loop(self):
+        async def get_response(request):
+            return HttpResponse()
+        self.assertTrue(iscoroutinefunction(instrumentation.InstrumentationMiddleware(get_response)))
+
+        response = await AsyncClient().get('/api/async/products/')
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="\d+ queries"')
+        metrics = instrumentation.registry.render()
+        self.assertIn('http_requests_total{method="GET",route="async-product-list",status="200"} 1', metrics)
+
+    @override_settings(SLOW_REQUEST_SECONDS=0)
+    def test_slow_requests_log_their_sql(self):
+        with self.assertLogs('api.instrumentation.slow', 'WARNING') as logs:
+            self.client.get('/api/categories/')
+        self.assertIn('GET /api/categories/ (category-list)', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+
+class BenchmarkTests(APITestCase):
+    def test_scenarios_run_and_compare(self):
+        sizes = benchmark.SeedSizes(products=30, categories=3, users=2, carts=5, orders=5)
+        self.assertEqual(benchmark.seed(sizes)['products'], 30)
+        ctx = benchmark.load_context()
+        client = benchmark.InProcessClient()
+        results = [
+            benchmark.run_scenario(client, ctx, name, iterations=3, warmup=1).as_dict()
+            for name in benchmark.SCENARIOS
+        ]
+        for row in results:
+            self.assertEqual((row['requests'], row['errors']), (3, 0), row['scenario'])
+            self.assertIsNotNone(row['p95_ms'])
+
+        baseline = {'results': {row['scenario']: {**row, 'queries_per_request': 0} for row in results}}
+        regressions = {row['scenario']: row['regressions'] for row in benchmark.compare(results, baseline, 10)}
+        self.assertEqual(regressions['staff_orders'], ['queries'])
+
+        benchmark.clear()
+        self.assertIsNone(benchmark.load_context())
+
+
+# One test process: LocMemCache is as good as a shared cache here
+@override_settings(HOTCACHE_ENABLED=True)
+class HotCacheTests(APITestCase):
+    def setUp(self):
+        hotcache.clear()
+        self.category = Category.objects.create(title='Phones', slug='phones')
+        self.product = Product.objects.create(name='P', old_price=10, category=self.category)
+        self.cart = Cart.objects.create(session_id='s')
+
+    def test_hot_products_skip_the_database(self):
+        url = f'/api/carts/{self.cart.pk}/items/'
+        self.client.post(url, {'product_id': self.product.pk, 'quantity': 1})
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(url, {'product_id': self.product.pk, 'quantity': 1})
+            response = self.client.get(f'/api/carts/{self.cart.pk}/')
+        self.assertFalse([q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT')
+                          and 'FROM "storeapp_product"' in q['sql']])
+        self.assertEqual(response.data['items'][0]['product']['price'], 10)
+        self.assertEqual(response.data['items'][0]['sub_total'], 20)
+
+        # Writes in this process invalidate at once
+        self.product.old_price = 12
+        self.product.save()
+        self.assertEqual(hotcache.get_product(self.product.pk).price, 12)
+
+    def test_other_workers_invalidate_through_the_generation(self):
+        Product.objects.filter(pk=self.product.pk).update(name='Renamed')
+        with override_settings(HOTCACHE_CHECK_INTERVAL=0):
+            hotcache.sync()
+            # What a worker that missed the local signal would still hold
+            hotcache.products.set(self.product.pk, hotcache.get_product(self.product.pk)._replace(name='Stale'))
+            self.assertEqual(hotcache.get_product(self.product.pk).name, 'Stale')
+            bump_generation()
+            self.assertEqual(hotcache.get_product(self.product.pk).name, 'Renamed')
+
+    def stale(self, product, **changes):
+        """What a worker that has not seen the change yet would still hold"""
+        record = hotcache.get_product(product.pk)
+        with override_settings(HOTCACHE_CHECK_INTERVAL=0):
+            hotcache.sync()
+        hotcache.products.set(product.pk, record._replace(**changes))
+
+    @override_settings(HOTCACHE_CHECK_INTERVAL=3600)
+    def test_stale_entries_neither_break_adds_nor_totals(self):
+        url = f'/api/carts/{self.cart.pk}/items/'
+        self.client.post(url, {'product_id': self.product.pk, 'quantity': 2})
+        self.stale(self.product, price=99)
+        cart = self.client.get(f'/api/carts/{self.cart.pk}/').data
+        self.assertEqual([item['sub_total'] for item in cart['items']], [20])
+        self.assertEqual(cart['grand_total'], 20)
+        items = self.client.get(url).json()
+        items = items['results'] if isinstance(items, dict) else items
+        self.assertEqual([item['sub_total'] for item in items], [20])
+
+        gone = Product.objects.create(name='Gone', old_price=1)
+        record = hotcache.get_product(gone.pk)
+        gone.delete()
+        hotcache.products.set(record.id, record)
+        response = self.client.post(url, {'product_id': record.id, 'quantity': 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('product_id', response.data)
+
+        response = self.client.post(f'{url}bulk/', {'items': [{'product_id': str(record.id), 'quantity': 1}]},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('items', response.data)
+
+    def test_product_deleted_after_bulk_validation_is_a_400(self):
+        gone = Product.objects.create(name='Gone', old_price=1)
+        serializer = BulkCartItemSerializer(data={'items': [{'product_id': str(gone.pk), 'quantity': 1}]},
+                                            context={'cart_id': self.cart.pk})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        gone.delete()
+        with self.assertRaises(ValidationError):
+            serializer.save()
+        self.assertFalse(Cartitems.objects.filter(cart=self.cart).exclude(product=self.product).exists())
+
+    @override_settings(HOTCACHE_ENABLED=None)
+    def test_off_without_a_shared_cache(self):
+        self.assertFalse(hotcache.is_enabled())
+        self.assertEqual(hotcache.check_shared_cache(), [])
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                self.assertEqual(hotcache.get_product(self.product.pk).name, 'P')
+        self.assertEqual(len(hotcache.products), 0)
+        with override_settings(HOTCACHE_ENABLED=True):
+            self.assertEqual([warning.id for warning in hotcache.check_shared_cache()], ['api.W001'])
+
+    def test_stock_moves_evict_only_their_products(self):
+        other = Product.objects.create(name='Q', old_price=5, inventory=4)
+        self.product.inventory = 4
+        self.product.save()
+        hotcache.get_products([self.product.pk, other.pk])
+        generation = get_generation()
+
+        Product.objects.reserve({self.product.pk: 3})
+        self.assertEqual(get_generation(), generation)
+        self.assertEqual(len(hotcache.products), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(hotcache.get_product(self.product.pk).inventory, 1)
+        Product.objects.release({self.product.pk: 3})
+        self.assertEqual(hotcache.get_product(self.product.pk).inventory, 4)
+        Product.objects.filter(pk=other.pk).update(inventory=0)
+        self.assertEqual(hotcache.get_product(other.pk).inventory, 0)
+        self.assertEqual(get_generation(), generation)
+
+    def test_lru_bounds_and_categories(self):
+        lru = hotcache.LRUCache(2, ttl=60)
+        for key in 'abc':
+            lru.set(key, key)
+        self.assertEqual((lru.get('a'), lru.get('c'), len(lru)), (hotcache.MISSING, 'c', 2))
+        self.assertEqual(hotcache.get_category_ids(), {self.category.pk})
+        with self.assertNumQueries(0):
+            hotcache.get_categories()
+        response = self.client.get(f'/api/products/?category={uuid.uuid4()}')
+        self.assertEqual(response.status_code, 400)
+
+
+class FastPathParityTests(APITestCase):
+    """api.fastpath must render exactly what the ModelSerializers render"""
+
+    def setUp(self):
+        get_cache().clear()
+        self.user = get_user_model().objects.create_user(email='staff@example.com', is_staff=True)
+        category = Category.objects.create(title='Phones', slug='phones')
+        variants = {'width': 640, 'height': 480, 'formats': {
+            'jpeg': {'160': 'img/v/p-160.jpg', '320': 'img/v/p-320.jpg'},
+            'webp': {'320': 'img/v/p-320.webp', '160': 'img/v/p-160.webp'},
+        }}
+        products = [
+            Product.objects.create(name='Caf\u00e9 \u2028 "quoted"', old_price=19.99, discount=True,
+                                   category=category, image='img/p.png', image_variants=variants),
+            Product.objects.create(name='Plain', description=None, old_price=7, image=''),
+            Product.objects.create(name='Third', description='d', old_price=0.1, inventory=0),
+        ]
+        ProductImage.objects.create(product=products[0], image='img/a.png', image_variants=variants)
+        ProductImage.objects.create(product=products[0], image='img/b.png')
+        ProductImage.objects.create(product=products[2], image=None)
+        for status, product in zip('PCX', products):
+            order = Order.objects.create(owner=self.user, pending_status=status)
+            OrderItem.objects.create(order=order, product=product, quantity=2,
+                                     unit_price=product.price, product_name=product.name)
+        # A line from before checkout snapshots
+        OrderItem.objects.create(order=order, product=products[0], quantity=1)
+
+    def assertSameBytes(self, url):
+        fast = self.client.get(url)
+        get_cache().clear()
+        with override_settings(API_FAST_LISTS=False):
+            slow = self.client.get(url)
+        get_cache().clear()
+        self.assertEqual(fast.status_code, 200, fast.content)
+        self.assertEqual(fast.content, slow.content)
+        return fast
+
+    def test_product_lists(self):
+        response = self.assertSameBytes('/api/products/')
+        self.assertEqual(len(response.data['results']), 3)
+        for url in ('/api/products/?ordering=-effective_price', '/api/products/?page_size=2&page=2',
+                    '/api/products/?pagination=cursor&page_size=2&ordering=old_price',
+                    '/api/products/?search=plain', '/api/products/?effective_price__lte=10'):
+            self.assertSameBytes(url)
+        cursor = self.client.get('/api/products/?pagination=cursor&page_size=2').data['next']
+        self.assertSameBytes(cursor)
+
+    def test_order_list(self):
+        self.client.force_authenticate(self.user)
+        data = self.assertSameBytes('/api/orders/').json()
+        orders = data['results'] if isinstance(data, dict) else data
+        self.assertEqual([order['status_label'] for order in orders], ['Cancelled', 'Complete', 'Pending'])
+        self.assertEqual(orders[0]['items'][1]['product']['name'], orders[2]['items'][0]['product']['name'])
+        self.assertSameBytes('/api/orders/?ordering=total_amount')
+
+    def test_unmapped_fields_must_have_an_extractor(self):
+        class Rows(fastpath.RowSerializer):
+            serializer_class = CartSerializer
+
+        with self.assertRaises(ImproperlyConfigured):
+            Rows()
+
+    def test_renderer_matches_json_renderer(self):
+        data = {'a': [1.5, None, True, 'caf\u00e9 \u2029'], 'id': uuid.uuid4(), 'when': timezone.now()}
+        self.assertEqual(fastpath.FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(fastpath.FastJSONRenderer().render(data, 'application/json; indent=2'),
+                         JSONRenderer().render(data, 'application/json; indent=2'))
+
+
+class ResponseCacheTests(APITestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.category = Category.objects.create(title='Phones', slug='phones')
+        self.product = Product.objects.create(name='Phone', old_price=10, category=self.category)
+
+    def test_catalog_writes_bump_the_generation(self):
+        writes = [
+            lambda: Product.objects.create(name='Case'),
+            lambda: self.product.save(),
+            lambda: Product.objects.filter(pk=self.product.pk).update(name='Phone X'),
+            lambda: Product.objects.bulk_update([self.product], ['old_price']),
+            lambda: ProductImage.objects.create(product=self.product, image='img/p.png'),
+            lambda: Category.objects.create(title='Cases', slug='cases'),
+            lambda: Category.objects.filter(slug='cases').delete(),
+        ]
+        for write in writes:
+            generation = get_generation()
+            write()
+            self.assertNotEqual(get_generation(), generation)
+
+        generation = get_generation()
+        Review.objects.create(product=self.product, name='r')
+        Cart.objects.create(session_id='s')
+        self.assertEqual(get_generation(), generation)
+
+    def test_hits_until_the_catalog_changes(self):
+        url = '/api/products/?ordering=-old_price&category=%s' % self.category.pk
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            # Same params in another order: same entry
+            hit = self.client.get('/api/products/?category=%s&ordering=-old_price' % self.category.pk)
+        self.assertEqual(hit.json(), first.json())
+        self.assertEqual(hit['ETag'], first['ETag'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+        Product.objects.filter(pk=self.product.pk).update(name='Phone X')
+        miss = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(miss.status_code, 200)
+        self.assertEqual(miss.json()['results'][0]['name'], 'Phone X')
+
+    def test_views_without_validators_hash_the_data(self):
+        class Categories(CachedResponseMixin, ListModelMixin, GenericViewSet):
+            queryset = Category.objects.order_by('title')
+            serializer_class = CategorySerializer
+            pagination_class = None
+
+        view = Categories.as_view({'get': 'list'}, basename='plain-category')
+        response = view(RequestFactory().get('/categories/'))
+        self.assertEqual(response['ETag'], compute_etag(response.data))
+        with self.assertNumQueries(0):
+            response = view(RequestFactory().get('/categories/', HTTP_IF_NONE_MATCH=response['ETag']))
+        self.assertEqual(response.status_code, 304)
+
+
+class ConditionalGetTests(APITestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.user = get_user_model().objects.create_user(email='staff@example.com', is_staff=True)
+        self.product = Product.objects.create(name='P', old_price=10)
+
+    def test_catalog_revalidation(self):
+        response = self.client.get('/api/products/')
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+
+        # Cached entries keep the validators
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response['ETag']), (304, etag))
+        get_cache().clear()
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+
+        # Images are part of the product
+        ProductImage.objects.create(product=self.product, image='img/p.png')
+        response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get('/api/products/not-a-uuid/').status_code, 404)
+
+    def test_if_modified_since_and_deletes(self):
+        reviews = [Review.objects.create(product=self.product, name=name) for name in 'ab']
+        url = f'/api/products/{self.product.pk}/reviews/'
+        response = self.client.get(url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        # Same newest timestamp, one row less
+        reviews[0].delete()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        Review.objects.filter(pk=reviews[1].pk).update(updated_at=timezone.now() + timedelta(hours=1))
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+    def test_orders_are_private_and_follow_status_moves(self):
+        order = Order.objects.create(owner=self.user)
+        OrderItem.objects.create(order=order, product=self.product, quantity=1, unit_price=10)
+        self.client.force_authenticate(self.user)
+        url = f'/api/orders/{order.pk}/'
+        response = self.client.get(url)
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        order.mark_paid()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    @override_settings(API_CACHE_CONTROL={'category': 'public, max-age=3600'})
+    def test_cache_control_is_configurable(self):
+        Category.objects.create(title='Phones', slug='phones')
+        self.assertEqual(self.client.get('/api/categories/')['Cache-Control'], 'public, max-age=3600')
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class InventoryStressTests(TransactionTestCase):
+    """Many buyers race for one hot SKU; stock must never be oversold"""
+    stock = 10
+    buyers = 30
+
+    def test_hot_sku_is_not_oversold(self):
+        user = get_user_model().objects.create_user(email='buyer@example.com')
+        product = Product.objects.create(name='Flash sale', inventory=self.stock, flash_sales=True)
+        carts = [Cart.objects.create(session_id=str(i)) for i in range(self.buyers)]
+        for cart in carts:
+            Cartitems.objects.create(cart=cart, product=product, quantity=1)
+
+        outcomes = []
+
+        def buy(cart):
+            # Exceptions come back as 500s (e.g. a lock timeout): a failed,
+            # not an oversold, checkout
+            client = APIClient(raise_request_exception=False)
+            client.force_authenticate(user)
+            try:
+                response = client.post('/api/orders/', {'cart_id': str(cart.pk)}, format='json')
+                outcomes.append(response.status_code)
+            finally:
+                connection.close()
+
+        started = time.monotonic()
+        threads = [threading.Thread(target=buy, args=(cart,)) for cart in carts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        product.refresh_from_db()
+        sold = outcomes.count(201)
+        self.assertEqual(len(outcomes), self.buyers)
+        self.assertLessEqual(sold, self.stock)
+        self.assertEqual(product.inventory, self.stock - sold)
+        self.assertEqual(OrderItem.objects.filter(product=product).count(), sold)
+        self.assertLess(elapsed, 30, f'{self.buyers} checkouts took {elapsed:.1f}s')
+
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class ConcurrentAddToCartTests(TransactionTestCase):
+    """Parallel add-to-cart clicks must neither lose increments nor duplicate lines"""
+    clicks = 20
+
+    def test_parallel_adds(self):
+        product = Product.objects.create(name='P', old_price=10)
+        cart = Cart.objects.create(session_id='s')
+        outcomes = []
+
+        def add():
+            client = APIClient(raise_request_exception=False)
+            try:
+                response = client.post(
+                    f'/api/carts/{cart.pk}/items/',
+                    {'product_id': str(product.pk), 'quantity': 1}, format='json')
+                outcomes.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=add) for _ in range(self.clicks)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        added = outcomes.count(201)
+        self.assertEqual(len(outcomes), self.clicks)
+        self.assertEqual(
+            list(Cartitems.objects.filter(cart=cart).values_list('quantity', flat=True)), [added])